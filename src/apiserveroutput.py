@@ -6,6 +6,11 @@ from webbrowser import get
 # supplies a list of available job-names under http://localhost:8080/jobs
 # supplies data for a job under http://localhost:8080/job/<job-name>/lastBuild/api/json
 #
+# requests are handled by a bounded pool of maxWorkers threads with HTTP/1.1 keep-alive. A kept alive connection
+# occupies its worker, it is closed if idle for more than keepAliveTimeoutSec or as soon as it is idle while other
+# connections wait for a worker. So more clients than workers are served, the ones waiting at most for a request to end.
+# A new connection not sending its first request within a second is closed the same way.
+#
 
 __author__ = 'florianseidl'
 
@@ -14,7 +19,10 @@ import re
 import json
 import logging
 import sys
-from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, RLock, Lock
+import select
+import time
 from time import sleep
 from datetime import datetime
 from output import NameFilter
@@ -25,14 +33,20 @@ logger = logging.getLogger(__name__)
 default_host = "localhost"
 default_port = 8080
 default_views = {"all" : re.compile(r'.*')}
+default_max_workers = 8
+default_keep_alive_timeout_sec = 5
+idle_poll_sec = 0.1
+first_request_timeout_sec = 1
 
 def create(configuration, key=None):
     """Create an instance (called by cimon.py)"""
-    global host, port, created, views
+    global host, port, created, views, max_workers, keep_alive_timeout_sec
     if created: # safeguard against double creation since we use global variables
         raise ValueError("There is allready one API server configured, only one is allwowed")
     host = configuration.get("host", default_host)
     port = configuration.get("port", default_port)
+    max_workers = configuration.get("maxWorkers", default_max_workers)
+    keep_alive_timeout_sec = configuration.get("keepAliveTimeoutSec", default_keep_alive_timeout_sec)
     views_from_config = configuration.get("views", {}) # view: pattern
     for view_name, pattern in views_from_config.items():
         views[view_name] =  re.compile(pattern if pattern else r'.*')
@@ -43,6 +57,8 @@ def create(configuration, key=None):
 created = False
 host = default_host
 port = default_port
+max_workers = default_max_workers
+keep_alive_timeout_sec = default_keep_alive_timeout_sec
 __shared_status__ = {}
 server = None
 server_lock = RLock()
@@ -55,8 +71,8 @@ def start_http_server_if_not_started():
         server_lock.acquire()
         global server
         if not server:
-            server = HTTPServer((host, port), ApiServerRequestHandler)
-            logger.info("Starting http server at %s:%d", host, port)
+            server = ApiHttpServer((host, port), ApiServerRequestHandler, max_workers=max_workers, keep_alive_timeout_sec=keep_alive_timeout_sec)
+            logger.info("Starting http server at %s:%d with %d workers", host, port, max_workers)
             Thread(target=server.serve_forever).start()
     finally:
         server_lock.release()
@@ -67,6 +83,7 @@ def stop_http_server():
         global server # ignore race conditions as they should not apply (server is only acessed here in cimon loop and on start)
         if server:
             server.shutdown()
+            server.server_close()
             logger.info("Stopped http server")
         server = None
     finally:
@@ -83,6 +100,9 @@ class ApiServerOutput():
     def __init__(self, build_filter_pattern=None, collector_filter_pattern=None):
         self.build_filter = NameFilter(collector_pattern=collector_filter_pattern,job_name_pattern=build_filter_pattern)
 
+    def route(self, key):
+        return self.build_filter.matches_key(key)
+
     def on_update(self, status):
         start_http_server_if_not_started()
         set_shared_status(self.__filter_status__(status))
@@ -178,9 +198,84 @@ class ApiServer():
             jenkins_response["actions"] = [{"causes": [{"shortDescription": job_status.cause}]}]
         return jenkins_response
 
+class ApiHttpServer(HTTPServer):
+    """ Http server handling each connection in a bounded pool of worker threads.
+    Connections exceeding the workers are queued until a worker is free. """
+
+    def __init__(self, server_address, request_handler_class, max_workers=default_max_workers, keep_alive_timeout_sec=default_keep_alive_timeout_sec):
+        super().__init__(server_address, request_handler_class)
+        self.keep_alive_timeout_sec = keep_alive_timeout_sec
+        self.workers = ThreadPoolExecutor(max_workers=max_workers)
+        self.__waiting = 0
+        self.__waiting_lock = Lock()
+
+    def connections_waiting(self):
+        """ the number of connections waiting for a worker """
+        return self.__waiting
+
+    def process_request(self, request, client_address):
+        with self.__waiting_lock:
+            self.__waiting += 1
+        self.workers.submit(self.__process_request_in_worker__, request, client_address)
+
+    def __process_request_in_worker__(self, request, client_address):
+        with self.__waiting_lock:
+            self.__waiting -= 1
+        # same as ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=False)
+
 class ApiServerRequestHandler(BaseHTTPRequestHandler):
     """ A shallow adapter to the Python http request handler as it is hard to test"""
     api_server = ApiServer()
+    protocol_version = "HTTP/1.1" # keep alive, requires the Content-Length on each response
+    disable_nagle_algorithm = True # headers and body are written separately, do not wait for the ack of the headers on a kept alive connection
+
+    def setup(self):
+        # a client not sending a complete request within the timeout is disconnected
+        self.timeout = getattr(self.server, "keep_alive_timeout_sec", None)
+        super().setup()
+
+    def handle(self):
+        # same as BaseHTTPRequestHandler.handle, but only waits for the next request while no other connection waits
+        self.close_connection = True
+        # a connection not sending any request does not hold the worker for the whole keep alive timeout
+        if not self.__wait_for_next_request__(min(first_request_timeout_sec, self.timeout or first_request_timeout_sec)):
+            return
+        self.handle_one_request()
+        while not self.close_connection and self.__wait_for_next_request__(self.timeout or default_keep_alive_timeout_sec):
+            self.handle_one_request()
+
+    def __wait_for_next_request__(self, timeout_sec):
+        """ True as soon as the next request arrives, False if idle for timeout_sec or others wait for a worker """
+        if self.__request_buffered__():
+            return True
+        end = time.monotonic() + timeout_sec
+        while time.monotonic() < end:
+            if select.select([self.connection], [], [], min(max(end - time.monotonic(), 0), idle_poll_sec))[0]:
+                return True
+            if getattr(self.server, "connections_waiting", lambda: 0)():
+                logger.debug("Closing idle connection, other connections are waiting")
+                return False
+        return False
+
+    def __request_buffered__(self):
+        # a request already read (pipelined by the client) is not seen by select, peek without blocking
+        self.connection.setblocking(False)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def do_GET(self):
         try:
@@ -195,10 +290,12 @@ class ApiServerRequestHandler(BaseHTTPRequestHandler):
             self.wfile.flush()
 
     def send_ok(self, code, jenkins_response):
+        body = json.dumps(jenkins_response).encode("utf-8")
         self.send_response(code)
         self.send_header("Content-type","application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(jenkins_response).encode("utf-8"))
+        self.wfile.write(body)
 
 if  __name__ =='__main__':
     logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
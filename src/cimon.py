@@ -16,6 +16,7 @@ from argparse import ArgumentParser
 from copy import deepcopy
 from enum import Enum
 from concurrent import futures
+from threading import Lock
 
 # The Masterboxcontrolprogram of the ci monitor scripts.
 #
@@ -32,6 +33,9 @@ from concurrent import futures
 #       return current_status_as_collected_in_a_dict
 # and the field
 #   type = "foo" # the type of collection, for instance type = "build"
+# and can implement the method (optional):
+#   def set_trigger(self, trigger):
+#       store the trigger and call trigger() to request collection and output right now (for instance on a pushed update)
 #
 # Any implementations of an Output has to implement the method
 #   def on_update(self, status):
@@ -41,6 +45,9 @@ from concurrent import futures
 # and can implement the method (optional):
 #   def reset(self):
 #       reset_the_output_here_if_required
+#   def route(self, key):
+#       return False if the job with the given key (collector_name, job_name) is never displayed by this output,
+#       the output then does not get this job in the status. Called once per key, the result is reused.
 
 # append the user home directory to sys.path
 sys.path.append("%s/cimon/plugins" % os.path.expanduser("~"))
@@ -100,6 +107,56 @@ class JobStatus():
     def __repr__(self):
         return str(self.__dict__)
 
+class StatusSnapshot(dict):
+    """ The status of one collection as handed to the outputs. Each output gets its own (deep) copy of the status,
+    but all copies share the summaries, so a summary computed by one output is reused by the others """
+    def __init__(self, *args, summaries=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.summaries = summaries if summaries is not None else SharedCache()
+
+class SharedCache():
+    """ A thread safe cache not copied by deepcopy """
+    def __init__(self):
+        self.__lock = Lock()
+        self.__values = {}
+
+    def get_or_compute(self, key, compute):
+        with self.__lock:
+            if key in self.__values:
+                return self.__values[key]
+        value = compute() # outside of the lock, at worst it is computed twice
+        with self.__lock:
+            return self.__values.setdefault(key, value)
+
+    def __deepcopy__(self, memo):
+        return self
+
+class RoutingIndex():
+    """ Maps each key in the status to the outputs it is routed to (outputs implementing route(key)).
+    Computed once when a key appears first and reused afterwards, so routing the status is a lookup per key.
+    Keys not in the status anymore are dropped as soon as they outnumber the current ones. """
+    def __init__(self, outputs):
+        self.outputs = tuple(outputs)
+        self.__routes = {}
+
+    def routes(self, key):
+        routes = self.__routes.get(key, None)
+        if routes is None:
+            routes = tuple(i for i, output in enumerate(self.outputs) if not hasattr(output, "route") or output.route(key))
+            self.__routes[key] = routes
+        return routes
+
+    def route(self, status):
+        """ split the status in one status per output, all sharing the same summaries """
+        summaries = SharedCache()
+        routed = [StatusSnapshot(summaries=summaries) for output in self.outputs]
+        for key, job_status in status.items():
+            for i in self.routes(key):
+                routed[i][key] = job_status
+        if len(self.__routes) > 2 * len(status):
+            self.__routes = {key: routes for key, routes in self.__routes.items() if key in status}
+        return routed
+
 class Cimon():
     """ Start and configuration of the build monitor """
     def __init__(self,
@@ -113,9 +170,13 @@ class Cimon():
         self.polling_interval_sec=int(polling_interval_sec)
         self.collectors=collectors
         self.outputs=outputs
+        self.routing_index=RoutingIndex(outputs)
         self.operating_hours=sorted(operating_hours)
         self.operating_days=sorted(operating_days)
         self.max_threads=max_threads
+        for collector in self.collectors:
+            if hasattr(collector, "set_trigger"):
+                collector.set_trigger(self.trigger)
 
     def close(self):
         for target in self.outputs + self.collectors:
@@ -128,6 +189,13 @@ class Cimon():
         self.rescheduler.start()
         logger.debug("Started cimon")
 
+    def trigger(self):
+        # collect and output now instead of waiting for the polling interval
+        rescheduler = self.rescheduler
+        if rescheduler:
+            logger.debug("Triggered collection and output")
+            rescheduler.trigger()
+
     def stop(self,**kwargs): # has to accept extra params from signal (signal and frame)
         if self.rescheduler:
             logger.debug("Stopping cimon...")
@@ -172,8 +240,10 @@ class Cimon():
         return status
 
     def __output_async__(self, status):
+        routed = self.routing_index.route(status)
         with futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures_output = [executor.submit(output.on_update, deepcopy(status)) for output in self.outputs]
+            futures_output = [executor.submit(output.on_update, deepcopy(routed_status))
+                              for output, routed_status in zip(self.outputs, routed)]
         futures.wait(futures_output)
 
     def sec_to_next_operating(self, now):
@@ -2,27 +2,37 @@
 # Python 3.4
 __author__ = 'florianseidl'
 
-from output import AbstractBuildAmpel, default_signal_error_threshold
+from output import AbstractBuildAmpel, default_signal_error_threshold, default_command_timeout_sec, device_executor, flash_scheduler
 import os
-from threading import Thread, Condition
-from datetime import datetime, timedelta
+from threading import Condition
 import logging
-import platform
+import time
+import glob
 from time import sleep
 
 default_flash_interval_sec=1.5
 default_absoulte_every_sec=300
+default_backend="auto"
+cleware_vendor_id="00000D50"
 
 logger = logging.getLogger(__name__)
 
 # controll the cleware usb ampel (http://www.cleware-shop.de/epages/63698188.sf/de_DE/?ObjectPath=/Shops/63698188/Products/43/SubProducts/43-1)
 # uses the shell cleware tool (as user) as no python binding worked. Unfortunately this is kind of slow.
+# Therefore the HID reports can be written directly to the hidraw device of the ampel (linux only), the file is kept open.
+# backend: "hidraw" writes to the hidraw device, "clewarecontrol" calls the shell tool, "auto" (default) uses the hidraw
+# device if found and writable and else the shell tool. The hidraw device is found automatically or configured using
+# hidrawDevice (for instance /dev/hidraw0). The user needs write permission on the device (udev rule).
+# The clewarecontrol tool is killed after commandTimeoutSec (default 10) in case the device hangs.
 # Extends AbstractBuildAmpel. See AbstractBuildAmpel for explaination of the logic (when does which light turn on)
 def create(configuration, aesKey=None):
     return ClewareBuildAmpel(device=configuration.get("device", None),
                              signal_error_threshold=configuration.get("signalErrorThreshold", default_signal_error_threshold),
                              flash_interval_sec=configuration.get("flashIntervalSec", default_flash_interval_sec),
                              absoulte_every_sec=configuration.get("absoulteEverySec", default_absoulte_every_sec),
+                             backend=configuration.get("backend", default_backend),
+                             hidraw_device=configuration.get("hidrawDevice", None),
+                             command_timeout_sec=configuration.get("commandTimeoutSec", default_command_timeout_sec),
                              build_filter_pattern=configuration.get("buildFilterPattern", None),
                              collector_filter_pattern=configuration.get("collectorFilterPattern", None))
 
@@ -34,131 +44,188 @@ class ClewareBuildAmpel(AbstractBuildAmpel):
                  signal_error_threshold=default_signal_error_threshold,
                  flash_interval_sec=default_flash_interval_sec,
                  absoulte_every_sec=default_absoulte_every_sec,
+                 backend=default_backend,
+                 hidraw_device=None,
+                 command_timeout_sec=default_command_timeout_sec,
                  build_filter_pattern=None,
                  collector_filter_pattern=None):
-        super().__init__(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern,collector_filter_pattern=collector_filter_pattern)
-        self.cleware_ampel=ClewarecontrolClewareAmpel(device=device, flash_interval_sec=flash_interval_sec, absoulte_every_sec=absoulte_every_sec)
+        # an unchanged signal is repeated as absolute output every absoulte_every_sec (every time if absoulte_every_sec is 0)
+        super().__init__(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern,collector_filter_pattern=collector_filter_pattern,
+                         refresh_every=1 if absoulte_every_sec <= 0 else 0, refresh_every_sec=absoulte_every_sec)
+        # a failed output is repeated with the next signal
+        self.cleware_ampel=ClewarecontrolClewareAmpel(device=device, flash_interval_sec=flash_interval_sec, backend=backend, hidraw_device=hidraw_device,
+                                                      command_timeout_sec=command_timeout_sec, on_failure=self.invalidate_last_signal)
 
     def signal(self, red, yellow, green, flash=False):
         self.cleware_ampel.display(red=red, yellow=yellow, green=green, flash=flash)
 
+    def refresh_signal(self, red, yellow, green, flash=False):
+        self.cleware_ampel.display(red=red, yellow=yellow, green=green, flash=flash, absolute=True)
+
     def close(self):
         super().close()
         self.cleware_ampel.wait_for_display()
         self.cleware_ampel.stop()
+        self.cleware_ampel.close()
 
 class ClewarecontrolClewareAmpel():
-    """control the cleware ampel using the clewarecontrol shell command """
+    """control the cleware ampel using the clewarecontrol shell command or the hidraw device """
     red_light=0
     yellow_light=1
     green_light=2
 
-    def __init__(self, device=None, flash_interval_sec=default_flash_interval_sec, absoulte_every_sec=default_absoulte_every_sec):
+    def __init__(self, device=None, flash_interval_sec=default_flash_interval_sec, backend="clewarecontrol", hidraw_device=None,
+                 command_timeout_sec=default_command_timeout_sec, scheduler=None, on_failure=None):
+        if backend not in ("auto", "hidraw", "clewarecontrol"):
+            raise ValueError("Unknown cleware backend %s" % backend)
         self.device=device
+        self.backend = backend
+        self.executor = device_executor(("clewarecontrol", device), timeout_sec=command_timeout_sec)
+        self.hidraw = None
+        if backend == "hidraw" or (backend == "auto" and (hidraw_device or not device)):
+            # the serial number of the device is only used by clewarecontrol
+            hidraw_device = hidraw_device or find_cleware_hidraw()
+            if hidraw_device:
+                self.hidraw = HidrawClewareDevice(hidraw_device)
+            elif backend == "hidraw":
+                raise ValueError("No cleware hidraw device found")
         self.flash_interval_sec = flash_interval_sec
         self.to_display = (False, False, False)
-        self.__stopped = True
+        self.flash = False
         self.condition = Condition() # condition has its own (r)lock
-        self.udpated = False
         self.current_display = (None, None, None)
-        self.absolute_every = timedelta(seconds=absoulte_every_sec)
-        self.__absolute_next = datetime.now() + self.absolute_every
+        self.on_failure = on_failure
+        self.command = None # the future of the last clewarecontrol command
+        # flashing is timed by the scheduler shared by all outputs
+        self.scheduler = scheduler if scheduler else flash_scheduler()
 
     def wait_for_display(self, timeout=7):
-        end = datetime.now() + timedelta(seconds=timeout)
+        end = time.monotonic() + timeout
         with self.condition:
-            while datetime.now() < end and self.current_display != self.to_display:
-                self.condition.wait(timeout=max((end - datetime.now()).total_seconds(), 0.01)) # wait for at least 10 milliseonds to release lock
+            while time.monotonic() < end and self.current_display != self.to_display:
+                self.condition.wait(timeout=max(end - time.monotonic(), 0.01)) # wait for at least 10 milliseonds to release lock
 
     def stop(self):
-        with self.condition:
-            self.__stopped = True
-            self.condition.notify_all()
-            logger.debug("Output Thread stop")
+        self.scheduler.cancel(self)
+        logger.debug("Output stopped")
 
-    def display(self, red=False, yellow=False, green=False, flash=False):
+    def display(self, red=False, yellow=False, green=False, flash=False, absolute=False):
+        """ only the lights changed are switched, if absolute all lights are switched """
         with self.condition:
             logger.debug("New values...." + str(locals()))
             self.to_display =  (red, yellow, green)
             self.flash = flash
-            self.updated = True
-            # start the output thread if required...
-            if self.__stopped:
-                self.__stopped = False
-                Thread(target=self.output_loop).start()
-            self.condition.notify_all()
+            if absolute:
+                self.current_display = (None, None, None)
+        # display now, the next flash is scheduled by the output
+        self.scheduler.schedule(self, 0, lambda: self.__output__(first=True))
 
-    def output_loop(self):
-        flash_state = False
-        logger.debug("Starting Clewareampel Output Thread....")
-        while not self.__stopped:
-            with self.condition:
-                logger.debug("flashinterval %s %s" % (str(self.flash_interval_sec), str(self.flash)))
-                if self.flash_interval_sec >= 0 and self.flash:
-                    logger.debug("Output with flash...")
-                    wait_until, flash_state = self.__do_output_flash__(flash_state)
+    def __output__(self, first=False):
+        with self.condition:
+            if self.flash_interval_sec > 0 and self.flash:
+                on, next_change = self.scheduler.flash_phase(self.flash_interval_sec)
+                # a new status is shown at once, then flashes in sync with the other outputs
+                if on or first:
+                    logger.debug("Flash on: %s", self.to_display)
+                    self.__output_to_cleware__(*self.to_display)
                 else:
-                    logger.debug("Output without flash...")
-                    wait_until, flash_state = self.__do_output_no_flash__()
-                while not self.__stopped and not self.updated and (not wait_until or wait_until > datetime.now()):
-                    # if no flashing, wait forever, else wait for the next flash signal
-                    # in any case wait at least 10 millis to release the lock and allow for signalling
-                    timeout = (wait_until - datetime.now()).total_seconds() if wait_until else None
-                    logger.debug("Waiting with timeout %s", str(timeout))
-                    self.condition.wait(timeout=timeout)
-        logger.info("Clewareampel Output Thread stopped.")
-
-
-    def __do_output_no_flash__(self):
-        logger.debug("Switch on: %s", self.to_display)
-        self.__output_to_cleware__(*self.to_display)
-        self.updated = False
-        return None, False
-
-    def __do_output_flash__(self, flash_state):
-        if flash_state:
-            logger.debug("Flash off")
-            self.__output_to_cleware__(red=False, yellow=False, green=False)
-        else:
-            logger.debug("Flash on: %s", self.to_display)
-            self.__output_to_cleware__(*self.to_display)
-        self.updated = False
-        # if currently off (flash state True as it is the previous state) then show for 1/5, else if on for 4/5 of the time
-        interval = self.flash_interval_sec * 0.2 if flash_state else self.flash_interval_sec * 0.8
-        return datetime.now() + timedelta(seconds=interval), not flash_state
+                    logger.debug("Flash off")
+                    self.__output_to_cleware__(red=False, yellow=False, green=False)
+                self.scheduler.schedule_at(self, next_change, self.__output__)
+            else:
+                logger.debug("Switch on: %s", self.to_display)
+                self.__output_to_cleware__(*self.to_display)
+            self.condition.notify_all()
 
     def __output_to_cleware__(self, red, yellow, green):
-        if datetime.now() >= self.__absolute_next:
-            logger.debug("Absolute output to cleware ampel")
-            if self.__call_clewarecontrol__((self.red_light, red), (self.yellow_light, yellow), (self.green_light, green)):
-                self.current_display = (red, yellow, green)
-                self.__absolute_next = datetime.now() + self.absolute_every
-        elif self.current_display != (red, yellow, green):
+        # the lights are unknown (None) at start, after an absolute display or a failure, so all of them are switched
+        if self.command and not (self.command.done() and self.command.result()):
+            # the last command is not run yet (it may be superseded by this one) or failed, its lights are unknown
+            self.current_display = (None, None, None)
+        if self.current_display != (red, yellow, green):
             switches = [(light, on) for (light, on, current) in ((self.red_light, red, self.current_display[0]),
                                                                  (self.yellow_light, yellow, self.current_display[1]),
                                                                  (self.green_light, green, self.current_display[2])) if on != current]
-            logger.debug("Relative output to cleware ampel")
+            logger.debug("Output to cleware ampel: %s", switches)
             if self.__call_clewarecontrol__(*switches):
                 self.current_display = (red, yellow, green)
+            else:
+                self.__output_failed__()
         else:
-            logger.debug("No change and not time for absolute output, doing nothing.")
+            logger.debug("No change, doing nothing.")
+
+    def close(self):
+        # wait for the commands submitted, for instance switching off
+        self.executor.wait(timeout=self.executor.timeout_sec)
+        if self.hidraw:
+            self.hidraw.close()
 
     def __call_clewarecontrol__(self, *light_on):
-        # enable null device on Windows for test purposees
-        nulldevice = "NUL" if platform.system() == "Windows" else "/dev/null"
-        device_str = "-d %s " % self.device if self.device else ""
-        command = ""
-        for light, on in light_on:
-            if command:
-                command += " && "
-            command += "clewarecontrol %s-c 1 -as %s %s > %s 2>&1" % (device_str, light, int(on), nulldevice)
-        logger.debug(command)
-        rc = os.system(command)
-        if rc != 0:
-            logger.warning("clewarecontrol returned %s", rc)
-            return False
+        if self.hidraw:
+            if self.hidraw.write(*light_on):
+                return True
+            if self.backend == "auto" and not self.hidraw.opened:
+                logger.warning("Cannot open %s, using clewarecontrol", self.hidraw.path)
+                self.hidraw = None
+            else:
+                return False
+        return self.__run_clewarecontrol__(*light_on)
+
+    def __run_clewarecontrol__(self, *light_on):
+        device_args = ["-d", str(self.device)] if self.device else []
+        commands = [["clewarecontrol"] + device_args + ["-c", "1", "-as", str(light), str(int(on))] for light, on in light_on]
+        # does not wait as the scheduler serves all outputs, if the command fails (or is superseded) all lights are output next time
+        self.command = self.executor.submit(*commands)
+        self.command.add_done_callback(lambda result: result.result() or self.__output_failed__())
         return True
 
+    def __output_failed__(self):
+        with self.condition:
+            self.current_display = (None, None, None)
+        if self.on_failure:
+            self.on_failure()
+
+class HidrawClewareDevice():
+    """ writes the HID output reports switching the lights directly to the hidraw device, the device is kept open """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.opened = False # opened at least once
+
+    def write(self, *light_on):
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY)
+                self.opened = True
+            for light, on in light_on:
+                # report id 0, the switch 0x10 + light and the state
+                os.write(self.fd, bytes((0x00, 0x10 + light, int(on))))
+            return True
+        except OSError as e:
+            logger.warning("Writing to %s failed: %s", self.path, e)
+            self.close() # reopen with the next write
+            return False
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+def find_cleware_hidraw(sys_class_hidraw="/sys/class/hidraw"):
+    """ the first hidraw device of the vendor cleware, None if there is none """
+    for uevent in sorted(glob.glob(os.path.join(sys_class_hidraw, "hidraw*", "device", "uevent"))):
+        try:
+            with open(uevent) as f:
+                if any(line.startswith("HID_ID=") and line.split(":")[1].upper() == cleware_vendor_id for line in f):
+                    return os.path.join("/dev", uevent.split(os.sep)[-3])
+        except (OSError, IndexError):
+            logger.debug("Cannot read %s", uevent)
+    return None
+
 if  __name__ =='__main__':
     """smoke test"""
     a = ClewareBuildAmpel()
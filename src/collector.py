@@ -5,8 +5,10 @@ __author__ = 'florianseidl'
 from base64 import b64encode
 from urllib import request
 from urllib.request import urlopen, HTTPError, URLError, ContentTooShortError, Request
-from time import sleep
-from threading import Condition
+from urllib.parse import urlparse
+from time import sleep, monotonic
+from threading import Condition, Lock
+from collections import OrderedDict, deque
 import logging
 import ssl
 import sys
@@ -16,26 +18,38 @@ from cimon import find_config_file_path
 
 logger = logging.getLogger(__name__)
 
-def create_http_client(base_url, username = None, password = None, jwt_login_url= None, saml_login_url=None, fixed_headers=None, verify_ssl=True, client_cert=None):
+default_cache_max_size = 1000
+default_cache_ttl_sec = 7 * 24 * 3600
+default_not_found_ttl_sec = 0 # off, a new job, view or folder would be hidden until the entry expires
+
+def create_http_client(base_url, username = None, password = None, jwt_login_url= None, saml_login_url=None, fixed_headers=None, verify_ssl=True, client_cert=None, not_found_ttl_sec=None):
     ssl_config = SslConfig(verify_ssl, client_cert)
+    not_found_cache = shared_not_found_cache(base_url, not_found_ttl_sec) if not_found_ttl_sec else None
     if jwt_login_url:
-        return HttpClient(base_url=base_url,
-                          authentication_handler=JwtAuthenticationHandler(username=username, password=password, jwt_login_url=jwt_login_url, ssl_config=ssl_config),
-                          ssl_config=ssl_config)
+        authentication_handler = JwtAuthenticationHandler(username=username, password=password, jwt_login_url=jwt_login_url, ssl_config=ssl_config)
     elif saml_login_url:
-        return HttpClient(base_url=base_url,
-                          authentication_handler=SamlAuthenticationHandler(username=username, password=password, saml_login_url=saml_login_url, ssl_config=ssl_config),
-                          ssl_config=ssl_config)
+        authentication_handler = SamlAuthenticationHandler(username=username, password=password, saml_login_url=saml_login_url, ssl_config=ssl_config)
     elif username:
-        return HttpClient(base_url=base_url,
-                          authentication_handler=BasicAuthenticationHandler(username=username, password=password),
-                          ssl_config=ssl_config)
+        authentication_handler = BasicAuthenticationHandler(username=username, password=password)
     elif fixed_headers:
-        return HttpClient(base_url=base_url,
-                          authentication_handler=FixedHeaderAuthenticationHandler(headers=fixed_headers),
-                          ssl_config=ssl_config)
+        authentication_handler = FixedHeaderAuthenticationHandler(headers=fixed_headers)
     else:
-        return HttpClient(base_url=base_url, ssl_config=ssl_config)
+        authentication_handler = EmptyAuthenticationHandler()
+    return HttpClient(base_url=base_url,
+                      authentication_handler=authentication_handler,
+                      ssl_config=ssl_config,
+                      not_found_cache=not_found_cache)
+
+__not_found_caches__ = {}
+__not_found_caches_lock__ = Lock()
+
+def shared_not_found_cache(base_url, ttl_sec):
+    """ one not found cache per host (and ttl), shared by all collectors requesting the same host """
+    key = (urlparse(base_url).netloc, ttl_sec)
+    with __not_found_caches_lock__:
+        if key not in __not_found_caches__:
+            __not_found_caches__[key] = NotFoundCache(ttl_sec=ttl_sec)
+        return __not_found_caches__[key]
 
 # Base classes to build collectors.
 #
@@ -187,45 +201,59 @@ class HttpClient:
     - SamlAuthentication: SAML using a specific Login URL and HTTP Set-Cookie and Cookie Headers for use with SBB Webservice Gateway (WSG) - access from outside SBB LAN
     Will retry status code 5xx and if told so by authentication handler max_retries times (default 3 times)"""
 
-    def __init__(self, base_url, authentication_handler=EmptyAuthenticationHandler(), max_retries=3, retry_delay_sec=3, ssl_config=SslConfig()):
+    def __init__(self, base_url, authentication_handler=EmptyAuthenticationHandler(), max_retries=3, retry_delay_sec=3, ssl_config=SslConfig(), not_found_cache=None):
         self.base_url = base_url
         self.authentication_handler = authentication_handler
         self.max_retries = max_retries
         self.retry_delay_sec = retry_delay_sec
         self.ssl_config = ssl_config
+        self.not_found_cache = not_found_cache
         logger.debug("Created http client")
 
-    def open_and_read(self, request_path=None):
-        response = self.open(request_path)
-        return response.read().decode(response.headers.get_content_charset() or "utf-8")
+    def open_and_read(self, request_path=None, data=None, cache_not_found=True):
+        return self.open_and_read_with_headers(request_path, data, cache_not_found)[0]
+
+    def open_and_read_with_headers(self, request_path=None, data=None, cache_not_found=True):
+        """ returns the contents and the response headers, for instance to follow the links to the next pages """
+        response = self.open(request_path, data=data, cache_not_found=cache_not_found)
+        return response.read().decode(response.headers.get_content_charset() or "utf-8"), response.headers
 
-    def open(self, request_path=None, retry=0):
+    def open(self, request_path=None, retry=0, data=None, timeout_sec=None, cache_not_found=True):
+        # requests for resources that exist soon (for instance the first build of a new job) are not cached
+        cache_not_found = cache_not_found and self.not_found_cache and not data
+        if cache_not_found and self.not_found_cache.is_not_found(self.__request_url__(request_path)):
+            logger.debug("Not found (cached): %s", self.__request_url__(request_path))
+            raise HTTPError(self.__request_url__(request_path), 404, "Not Found (cached)", None, None)
         request_headers = self.authentication_handler.request_headers()
         try:
-            request = Request(self.__request_url__(request_path))
+            request = Request(self.__request_url__(request_path), data=data)
             logger.debug("Request to %s", self.__request_url__(request_path))
             for key, value in request_headers.items():
                 request.add_header(key, value)
+            if data:
+                request.add_header("Content-Type", "application/json;charset=utf-8")
             logger.debug("Request headers: %s" % request.headers.keys()) # do not log contents to avoid leak
-            return self.__open__(request)
+            return self.__open__(request, timeout_sec)
         except HTTPError as e:
             if e.code in (401,402,403,407,408) and retry < self.max_retries and self.authentication_handler.handle_forbidden(request_headers, e.code): # maybe authentication issue
-                return self.__retry__("Potential authentication status code %d" % e.code, request_path, retry);
+                return self.__retry__("Potential authentication status code %d" % e.code, request_path, retry, data, timeout_sec, cache_not_found);
             elif e.code >= 500 and retry < self.max_retries: # retry server side error (may be temporary), max 3 attempts
-                return self.__retry__("Temporary error %d %s" % (e.code, e.reason), request_path, retry);
+                return self.__retry__("Temporary error %d %s" % (e.code, e.reason), request_path, retry, data, timeout_sec, cache_not_found);
             else:
+                if e.code == 404 and cache_not_found:
+                    self.not_found_cache.add(self.__request_url__(request_path))
                 self.__try__log_contents__(e)
                 raise e
         except (URLError, ContentTooShortError) as e:
             if retry < self.max_retries:
-                return self.__retry__("Error %s" % str(e), request_path, retry)
+                return self.__retry__("Error %s" % str(e), request_path, retry, data, timeout_sec, cache_not_found)
             else:
                 raise e
 
-    def __retry__(self, text, request_path, retry):
+    def __retry__(self, text, request_path, retry, data=None, timeout_sec=None, cache_not_found=True):
         logger.info("%s requesting %s, retry %s", text, self.__request_url__(request_path), retry)
         sleep(retry *  self.retry_delay_sec) # back off after first time
-        return self.open(request_path, retry + 1)
+        return self.open(request_path, retry + 1, data, timeout_sec, cache_not_found)
 
     def __request_url__(self, request_path):
         if request_path:
@@ -233,10 +261,12 @@ class HttpClient:
         else:
             return self.base_url
 
-    def __open__(self, request):
+    def __open__(self, request, timeout_sec=None):
+        # without timeout_sec the default socket timeout applies
+        timeout = {"timeout" : timeout_sec} if timeout_sec else {}
         if not self.ssl_config.ctx:
-            return urlopen(request)
-        return urlopen(request, context=self.ssl_config.ctx)
+            return urlopen(request, **timeout)
+        return urlopen(request, context=self.ssl_config.ctx, **timeout)
 
     def __try__log_contents__(self, e):
         try:
@@ -244,3 +274,211 @@ class HttpClient:
             logger.info("Response contents %s" % e.file.read())
         except:
             pass # ignore
+
+class BoundedCache:
+    """ A thread safe cache bounded in size and age: if there are more than max_size entries the least recently used
+    entries are evicted, entries not used for ttl_sec seconds expire (or not put for ttl_sec if renew_on_get is False).
+    Counts evictions and expirations. """
+
+    def __init__(self, max_size=default_cache_max_size, ttl_sec=default_cache_ttl_sec, renew_on_get=True, clock=monotonic):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.renew_on_get = renew_on_get
+        self.clock = clock
+        self.evictions = 0
+        self.expirations = 0
+        self.__entries = OrderedDict() # key: (value, last used), least recently used first
+        self.__lock = Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__entries:
+                return default
+            now = self.clock()
+            value, last_used = self.__entries[key]
+            if self.__is_expired__(last_used, now):
+                del self.__entries[key]
+                self.expirations += 1
+                return default
+            if self.renew_on_get:
+                self.__entries[key] = (value, now)
+                self.__entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            now = self.clock()
+            self.__entries[key] = (value, now)
+            self.__entries.move_to_end(key)
+            self.__evict__(now)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        return {"size" : len(self.__entries), "maxSize" : self.max_size, "evictions" : self.evictions, "expirations" : self.expirations}
+
+    def __evict__(self, now):
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+        # the least recently used entries are first, stop at the first one not expired
+        while self.__entries and self.__is_expired__(next(iter(self.__entries.values()))[1], now):
+            self.__entries.popitem(last=False)
+            self.expirations += 1
+
+    def __is_expired__(self, last_used, now):
+        return self.ttl_sec is not None and now - last_used > self.ttl_sec
+
+class KeyCache:
+    """ The keys used in the current and the last collection. A key used in the last collection is reused in the current one,
+    keys not used in a whole collection are dropped. So the cache holds all the jobs collected - however many there are -
+    and does not need a lock (single dict operations are atomic). """
+
+    def __init__(self):
+        self.__current = {}
+        self.__last = {}
+
+    def get(self, key, default=None):
+        value = self.__current.get(key, None)
+        if value is None:
+            value = self.__last.get(key, None)
+            if value is None:
+                return default
+            self.__current[key] = value
+        return value
+
+    def put(self, key, value):
+        self.__current[key] = value
+
+    def next_collection(self):
+        self.__last, self.__current = self.__current, {}
+
+    def __len__(self):
+        return len(self.__current)
+
+    def stats(self):
+        return {"size" : len(self.__current), "lastSize" : len(self.__last)}
+
+class NotFoundCache:
+    """ Remembers the urls answered with 404 not found for ttl_sec seconds, after that they are requested again (revalidated) """
+
+    def __init__(self, ttl_sec, max_size=default_cache_max_size, clock=monotonic):
+        self.cache = BoundedCache(max_size=max_size, ttl_sec=ttl_sec, renew_on_get=False, clock=clock)
+
+    def add(self, url):
+        logger.debug("Caching not found for %s", url)
+        self.cache.put(url, True)
+
+    def is_not_found(self, url):
+        return self.cache.get(url, False)
+
+def server_sent_events(lines):
+    """ parse a stream of server sent events (content type text/event-stream) line by line,
+    yields a tuple (event name, data) for each complete event. Comments (for instance heartbeats) are skipped."""
+    event, data = None, []
+    for line in lines:
+        line = line.decode("utf-8") if isinstance(line, bytes) else line
+        line = line.rstrip("\r\n")
+        if not line: # empty line terminates the event
+            if data:
+                yield (event or "message", "\n".join(data))
+            event, data = None, []
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+class TaskQueue:
+    """ A single work queue for all requests of a collector, backed by one bounded executor.
+    Each task returns a dict (for instance build status), the results of all tasks are merged.
+    A running task may submit further tasks it discovered, this never blocks the worker - so workers do not wait for each other."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.__condition = Condition()
+        self.__pending = 0
+        self.__result = {}
+        self.__error = None
+
+    def submit(self, method, *params):
+        with self.__condition:
+            self.__pending += 1
+        try:
+            self.executor.submit(self.__run__, method, params)
+        except:
+            self.__done__()
+            raise
+
+    def add(self, result):
+        """ add a result known allready without running a task """
+        with self.__condition:
+            self.__result.update(result)
+
+    def join(self):
+        """ wait until all tasks including the ones submitted by other tasks are done and return the merged result """
+        with self.__condition:
+            while self.__pending > 0:
+                self.__condition.wait()
+            if self.__error:
+                raise self.__error
+            return self.__result
+
+    def __run__(self, method, params):
+        try:
+            result = method(*params)
+            if result:
+                with self.__condition:
+                    self.__result.update(result)
+        except Exception as e:
+            logger.exception("Task %s failed", method)
+            with self.__condition:
+                self.__error = self.__error or e
+        finally:
+            self.__done__()
+
+    def __done__(self):
+        with self.__condition:
+            self.__pending -= 1
+            self.__condition.notify_all()
+
+
+class LimitedTaskQueue:
+    """ Submits to a shared task queue, but runs at most max_parallel of its tasks at the same time (for instance per host).
+    Tasks over the limit are parked and submitted when a running one is done, so they never block a worker of the shared executor """
+
+    def __init__(self, tasks, max_parallel):
+        self.tasks = tasks
+        self.max_parallel = max(max_parallel, 1)
+        self.__lock = Lock()
+        self.__running = 0
+        self.__parked = deque()
+
+    def submit(self, method, *params):
+        with self.__lock:
+            if self.__running >= self.max_parallel:
+                self.__parked.append((method, params))
+                return
+            self.__running += 1
+        self.tasks.submit(self.__run__, method, params)
+
+    def add(self, result):
+        self.tasks.add(result)
+
+    def __run__(self, method, params):
+        try:
+            return method(*params)
+        finally:
+            # submit the next parked task before this one is done, so the shared queue never runs empty while tasks are parked
+            with self.__lock:
+                next_task = self.__parked.popleft() if self.__parked else None
+                if not next_task:
+                    self.__running -= 1
+            if next_task:
+                self.tasks.submit(self.__run__, *next_task)
@@ -2,11 +2,11 @@
 # Python 3.4
 __author__ = 'florianseidl'
 
-from output import AbstractBuildAmpel, default_signal_error_threshold
-from os import system
+from output import AbstractBuildAmpel, default_signal_error_threshold, default_command_timeout_sec, device_executor, flash_scheduler
 import logging
 
 default_repeat_every = 15
+default_flash_interval_sec = -1
 
 default_colors={1 : "red", 2: "yellow", 3: "green", 4: "red"}
 
@@ -14,7 +14,7 @@ logger = logging.getLogger(__name__)
 
 # output to the Energenie Power socket
 # treats the Energenie as an Ampel, see AbstractBuildAmpel for the logic.
-# uses the sispmctl command line tool (as user).
+# uses the sispmctl command line tool (as user), run in the background with a timeout of commandTimeoutSec (default 10).
 # The Energenie has 4 controllable outputs, 1-4.
 # assignment is configurable, default is:
 #   1: red
@@ -23,13 +23,17 @@ logger = logging.getLogger(__name__)
 #   4: red (second red for instance for a rotating light)
 # colors not assigned will not be switched
 # both red will be switched together
+# flashing is off by default (flashIntervalSec -1) as not every device connected is made for it, if flashIntervalSec is
+# given the sockets flash while a build is active, in sync with other outputs flashing at the same interval
 def create(configuration, aesKey=None):
     return EnergenieBuildAmpel(device_nr=configuration.get("deviceNr", None),
                                signal_error_threshold=configuration.get("signalErrorThreshold", default_signal_error_threshold),
                                repeat_every=configuration.get("repeatEvery", default_repeat_every),
                                build_filter_pattern=configuration.get("buildFilterPattern", None),
                                collector_filter_pattern=configuration.get("collectorFilterPattern", None),
-                               colors=configuration.get("colors", default_colors))
+                               colors=configuration.get("colors", default_colors),
+                               command_timeout_sec=configuration.get("commandTimeoutSec", default_command_timeout_sec),
+                               flash_interval_sec=configuration.get("flashIntervalSec", default_flash_interval_sec))
 
 
 class EnergenieBuildAmpel(AbstractBuildAmpel):
@@ -41,48 +45,61 @@ class EnergenieBuildAmpel(AbstractBuildAmpel):
                  repeat_every=default_repeat_every,
                  build_filter_pattern=None,
                  collector_filter_pattern=None,
-                 colors=default_colors):
-        super(EnergenieBuildAmpel, self).__init__(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern, collector_filter_pattern=collector_filter_pattern)
-        self.energenie = Energenie(device_nr=device_nr, repeat_every=repeat_every)
+                 colors=default_colors,
+                 command_timeout_sec=default_command_timeout_sec,
+                 flash_interval_sec=default_flash_interval_sec):
+        # an unchanged signal is repeated every repeat_every times (every time if 1 or less)
+        super(EnergenieBuildAmpel, self).__init__(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern, collector_filter_pattern=collector_filter_pattern,
+                                                  refresh_every=max(repeat_every, 1))
+        self.energenie = Energenie(device_nr=device_nr, command_timeout_sec=command_timeout_sec)
         self.colors=colors
+        self.flash_interval_sec = flash_interval_sec
+        self.socket_on = []
+        self.scheduler = flash_scheduler()
 
-    def signal(self, red, yellow, green, flash=False): # igonre flash, this feature is not supported
+    def signal(self, red, yellow, green, flash=False): # flash only if a flash interval is configured
         signal=locals()
-        self.energenie.switch([(k, signal[v]) for k,v in self.colors.items()])
+        self.socket_on = [(k, signal[v]) for k,v in self.colors.items()]
+        if flash and self.flash_interval_sec > 0:
+            self.scheduler.schedule(self, 0, lambda: self.__flash__(first=True))
+        else:
+            self.scheduler.cancel(self)
+            self.energenie.switch(self.socket_on)
+
+    def __flash__(self, first=False):
+        on, next_change = self.scheduler.flash_phase(self.flash_interval_sec)
+        self.energenie.switch(self.socket_on if on or first else [(socket, False) for socket, socket_on in self.socket_on])
+        self.scheduler.schedule_at(self, next_change, self.__flash__)
+
+    def close(self):
+        self.scheduler.cancel(self)
+        super().close()
+        self.energenie.close()
 
 class Energenie():
     """ control the energenie socket using the sispmctl script """
 
-    def __init__(self, device_nr=None, repeat_every=default_repeat_every):
+    def __init__(self, device_nr=None, command_timeout_sec=default_command_timeout_sec):
         self.__device_nr=device_nr
-        self.__last_state=None
-        self.repeat_every=repeat_every
-        self.__repeat_count = 0
+        self.executor = device_executor(("sispmctl", device_nr), timeout_sec=command_timeout_sec)
 
     def switch(self, socket_on):
         if socket_on:
-            self.__switch_if_changed__(*socket_on)
-
-    def __switch_if_changed__(self, *socket_on):
-        if socket_on != self.__last_state or self.__repeat_count >= self.repeat_every:
-            logger.debug("Change or time to repeat output to energenie: %s", str(socket_on))
-            self.__last_state = socket_on
+            logger.debug("Output to energenie: %s", str(socket_on))
             self.__call_sispmctl__(*socket_on)
-            self.__repeat_count = 1
-        else:
-            logger.debug("Ignoring repeated output to energenie")
-            self.__repeat_count += 1
+
+    def close(self):
+        self.executor.wait(timeout=self.executor.timeout_sec)
 
     def __call_sispmctl__(self, *socket_on):
-        device_str = "-d %s" % self.__device_nr if self.__device_nr else ""
-        switches = ""
+        command = ["sispmctl", "-q"]
+        if self.__device_nr:
+            command += ["-d", str(self.__device_nr)]
         for socket, on in socket_on:
-           switches += " %s %s" % ("-o" if on else "-f", socket)
-        command = "sispmctl -q %s%s" % (device_str, switches)
-        logger.debug(command)
-        rc = system(command)
-        if rc != 0:
-            logger.warning("Energenie output: sispmctl returned %s", rc)
+            command += ["-o" if on else "-f", str(socket)]
+        # does not wait for the command, a state not switched yet is replaced by the next one for the same sockets
+        # (several outputs may switch different sockets of the same device)
+        self.executor.submit(command, key=tuple(sorted(socket for socket, on in socket_on)))
 
 if  __name__ =='__main__':
     """smoke test"""
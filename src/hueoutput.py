@@ -67,15 +67,46 @@ CONFIGURATION:
   Note that each job can only be assigned to one group. A group can consist of one or more jobs. Each group can have
   one or more lamps assigned, but each lamp can only be assigned to one job.
   transitiontimeMillis is optional, default is 400 
+  absoluteEverySec is optional, default is 300: only lamps changed are sent to the bridge, every absoluteEverySec seconds
+  all lamps are sent (in case they were switched by someone else). Put 0 to send all lamps every time.
+  useGroups is optional, default is True: a hue group named "cimon <group name>" is created (or updated) on the bridge for
+  each mapping with more than one lamp, all lamps of a mapping changing to the same colour are switched by one group command.
+  lightCommandsPerSec and groupCommandsPerSec are optional, default is 10 and 1 as documented for the hue bridge:
+  the commands sent to the bridge are limited to these rates.
+  connectRetries and connectRetryDelaySec are optional, default is 3 and 10: the bridge is connected in the background,
+  cimon starts without waiting for it. If the bridge is not reachable, connecting is retried connectRetries times every
+  connectRetryDelaySec seconds, then again with the next status. The status is displayed as soon as the bridge is connected.
+
+  Several bridges can be driven by one output, each with its own lamps and mappings:
+
+  - implementation: hueoutput
+    transitiontimeMillis: 400
+    bridges:
+      - ipaddress: '<ip-address of hue bridge 1>'
+        lamps: [<list-of-ids for your lamps on bridge 1>]
+        unused: [<list-of-ids of unused lamps on bridge 1>]
+        mappings:
+          ...
+      - ipaddress: '<ip-address of hue bridge 2>'
+        ...
+
+  All other settings can be given for all bridges or per bridge. The mappings of all bridges are evaluated once per
+  update, on each bridge a job belongs to the first mapping it matches. Each bridge has its own rate limits.
+
+  The lamps are sent to each bridge by a thread of the output, on_update returns immediately. If a new status arrives while
+  the lamps are being sent, the sending of the older one stops and the newest status is sent instead.
+  Lamps of active builds flash. As flashing stops after 15 seconds, the output re-arms the flashing of these lamps every
+  15 seconds until the build is no longer active, independent of the collection interval.
 """
 
 import logging.config
 import time
+from threading import Lock, Thread, Condition, current_thread
 
 from phue import Bridge
 
 from cimon import RequestStatus, Health
-from output import NameFilter
+from output import NameFilter, HealthSummary, cached_summary, default_max_matched_keys, flash_scheduler
 
 LAMP_OFF = {'on': False, 'transitiontime': 0, 'alert': 'none'}
 # hue lamp colours, determined by experimentation, not all of them are used
@@ -91,8 +122,18 @@ COLOUR_VIOLET = {'on': True, 'sat': 254, 'bri': 127, 'hue': 55000}
 COLOUR_PINK = {'on': True, 'sat': 254, 'bri': 127, 'hue': 60000}
 # will flash the lamp between two brightnesses with the current colour, only lasts 15 seconds
 FLASHING_15SEC = {'alert': 'lselect'}
+FLASHING_SEC = 15
 # 400 ms is the hue default
 DEFAULT_TRANSITIONTIME_MILLIS = 400
+DEFAULT_ABSOLUTE_EVERY_SEC = 300
+# the hue bridge can handle about 10 light commands and 1 group command per second
+DEFAULT_LIGHT_COMMANDS_PER_SEC = 10
+DEFAULT_GROUP_COMMANDS_PER_SEC = 1
+DEFAULT_CONNECT_RETRIES = 3
+DEFAULT_CONNECT_RETRY_DELAY_SEC = 10
+# a sender blocked by a bridge not answering is left behind when stopping, it ends (or continues) after its command
+STOP_SENDER_TIMEOUT_SEC = 10
+GROUP_NAME_PREFIX = "cimon "
 
 logger = logging.getLogger(__name__)
 
@@ -102,7 +143,38 @@ def create(configuration, key=None):
                      lamps=configuration.get("lamps", []),
                      unused=configuration.get("unused", []),
                      mappings=configuration.get("mappings", []),
-                     transitiontimeMillis=configuration.get("transitiontimeMillis", DEFAULT_TRANSITIONTIME_MILLIS))
+                     transitiontimeMillis=configuration.get("transitiontimeMillis", DEFAULT_TRANSITIONTIME_MILLIS),
+                     absoluteEverySec=configuration.get("absoluteEverySec", DEFAULT_ABSOLUTE_EVERY_SEC),
+                     useGroups=configuration.get("useGroups", True),
+                     lightCommandsPerSec=configuration.get("lightCommandsPerSec", DEFAULT_LIGHT_COMMANDS_PER_SEC),
+                     groupCommandsPerSec=configuration.get("groupCommandsPerSec", DEFAULT_GROUP_COMMANDS_PER_SEC),
+                     connectRetries=configuration.get("connectRetries", DEFAULT_CONNECT_RETRIES),
+                     connectRetryDelaySec=configuration.get("connectRetryDelaySec", DEFAULT_CONNECT_RETRY_DELAY_SEC),
+                     bridges=configuration.get("bridges", None))
+
+
+class TokenBucket():
+    """ Limits to rate commands per second on average, allowing bursts of up to burst commands.
+        acquire() waits until the next command is allowed """
+
+    def __init__(self, rate, burst=None, clock=None, sleep=None):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self.clock = clock if clock else time.monotonic
+        self.sleep = sleep if sleep else lambda sec: time.sleep(sec)
+        self.tokens = self.burst
+        self.last = self.clock()
+        self.__lock = Lock()
+
+    def acquire(self):
+        with self.__lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1 # reserved even if waiting, so the next one waits longer
+        if wait > 0:
+            self.sleep(wait)
 
 
 """ Represents the output of builds to a lamp or a group of lamps switched synchronously"""
@@ -118,39 +190,96 @@ class Mapping():
     def matches(self, url, job):
         return job in self.builds or self.filter.matches(url, job)
 
+    def key(self):
+        # the summaries are looked up by the mapping name
+        return (self.name, tuple(self.builds), self.filter.key())
 
-class HueOutput():
-    def __init__(self, ipaddress, lamps, unused, mappings, transitiontimeMillis):
+
+class HueBridgeOutput():
+    """ Sends the target state of the lamps to one hue bridge, the lamps are sent by a sender thread per bridge """
+
+    def __init__(self, ipaddress, lamps, unused, mappings, transitiontimeMillis=DEFAULT_TRANSITIONTIME_MILLIS,
+                 absoluteEverySec=DEFAULT_ABSOLUTE_EVERY_SEC, useGroups=True,
+                 lightCommandsPerSec=DEFAULT_LIGHT_COMMANDS_PER_SEC, groupCommandsPerSec=DEFAULT_GROUP_COMMANDS_PER_SEC,
+                 connectRetries=DEFAULT_CONNECT_RETRIES, connectRetryDelaySec=DEFAULT_CONNECT_RETRY_DELAY_SEC):
         if not ipaddress:
             raise ValueError("No ipaddress configured in hueoutput")
 
         self.ipaddress = ipaddress
         self.lamps = lamps
         self.unused = unused
-        self.mappings = mappings
         self.mappings = self.createMappings(mappings)
         self.transitiontime = {'transitiontime': transitiontimeMillis // 100 } # given in 10th of seconds
-        logger.debug("--- HueOutput.init() start ---")
+        # the state last sent to each lamp, only lamps with a different target state are sent except every absoluteEverySec
+        self.lampStates = {}
+        # the time to re-arm the flashing for each lamp flashing, the sender is woken by the scheduler shared by all outputs
+        self.rearmAt = {}
+        self.scheduler = flash_scheduler()
+        self.absoluteEverySec = absoluteEverySec
+        self.absoluteNext = time.monotonic() + absoluteEverySec
+        self.useGroups = useGroups
+        self.groups = {} # mapping name: hue group id
+        self.lightLimiter = TokenBucket(lightCommandsPerSec)
+        self.groupLimiter = TokenBucket(groupCommandsPerSec)
+        self.connectRetries = connectRetries
+        self.connectRetryDelaySec = connectRetryDelaySec
+        self.bridge = None # connected by the sender thread
+        # the target state of the lamps to be sent by the sender thread, newer targets replace the ones not sent yet
+        self.condition = Condition()
+        self.toSend = None
+        self.sending = False
+        self.sender = None
+        self.__stopped = True
+        logger.debug("--- HueBridgeOutput.init() start ---")
         logger.debug(" - ipaddress: {}".format(self.ipaddress))
         logger.debug(" - lamps: {}".format(self.lamps))
         logger.debug(" - unused: {}".format(self.unused))
         logger.debug(" - mappings: {}".format(self.mappings))
         logger.debug(" - transitiontime: {}".format(self.transitiontime))
+        logger.debug(" - absoluteEverySec: {}".format(self.absoluteEverySec))
 
-        # initialise bridge connection
-        self.bridge = Bridge(ipaddress)
-        logger.debug("Connected to hue bridge")
-
-        # turn off unused lamps, don't touch the others
-        self.setLamps(unused, LAMP_OFF)
-        logger.debug("Turned off unused lamps")
-        logger.debug("--- HueOutput.init() done ---")
+        # connect to the bridge in the background, the lamps are sent as soon as the bridge is connected
+        with self.condition:
+            self.startSender()
+        logger.debug("--- HueBridgeOutput.init() done ---")
 
     def close(self):
-        logger.debug("--- HueOutput.close() start ---")
-        self.setLamps(self.lamps, LAMP_OFF)
-        logger.debug("Turned off all lamps")
-        logger.debug("--- HueOutput.close() done ---")
+        self.stopSender()
+        if self.bridge:
+            self.setLamps(self.lamps, LAMP_OFF)
+            logger.debug("Turned off all lamps of hue bridge {}".format(self.ipaddress))
+
+    """ connects to the bridge, creates the groups and turns off the unused lamps
+        retries connectRetries times, returns false if the bridge is not connected
+    """
+
+    def connect(self):
+        for attempt in range(self.connectRetries + 1):
+            if attempt > 0 and not self.waitToRetry():
+                return False
+            try:
+                self.bridge = Bridge(self.ipaddress)
+                logger.info("Connected to hue bridge {}".format(self.ipaddress))
+                if self.useGroups:
+                    self.groups = self.createGroups()
+                    logger.debug("Hue groups: {}".format(self.groups))
+                # turn off unused lamps, don't touch the others
+                self.setLamps(self.unused, LAMP_OFF)
+                logger.debug("Turned off unused lamps")
+                return True
+            except Exception:
+                logger.exception("Could not connect to hue bridge {} (attempt {} of {})".format(
+                    self.ipaddress, attempt + 1, self.connectRetries + 1))
+                self.bridge = None
+        return False
+
+    def waitToRetry(self):
+        """ wait connectRetryDelaySec unless stopped, returns false if stopped """
+        end = time.monotonic() + self.connectRetryDelaySec
+        with self.condition:
+            while not self.__stopped and time.monotonic() < end:
+                self.condition.wait(timeout=end - time.monotonic())
+            return not self.__stopped
 
     """ maps jenkins job ids to mapping groups """
 
@@ -167,54 +296,204 @@ class HueOutput():
             mappings.append(mapping)
         return mappings
 
+    """ creates a hue group for each mapping with more than one lamp or updates the lamps of the existing group
+        returns the group id per mapping name, mappings without group are switched lamp by lamp
+    """
+
+    def createGroups(self):
+        groups = {}
+        try:
+            existing = {group["name"]: (groupId, group.get("lights", [])) for groupId, group in self.bridge.get_group().items()}
+        except Exception:
+            logger.exception("Could not read hue groups, switching lamp by lamp")
+            return groups
+        for mapping in self.mappings:
+            if len(mapping.lamps) < 2:
+                continue
+            try:
+                groupId = self.createGroup(GROUP_NAME_PREFIX + mapping.name, mapping.lamps, existing)
+            except Exception:
+                logger.exception("Could not create hue group for %s, switching its lamps one by one", mapping.name)
+                continue
+            if groupId is not None:
+                groups[mapping.name] = groupId
+        return groups
+
+    """ creates or updates the group, returns its id or None if the bridge responds with an error """
+
+    def createGroup(self, name, lamps, existing):
+        lights = [str(lamp) for lamp in lamps]
+        self.groupLimiter.acquire()
+        if name in existing:
+            groupId = existing[name][0]
+            if sorted(existing[name][1]) != sorted(lights):
+                self.bridge.set_group(int(groupId), 'lights', lamps)
+            return int(groupId)
+        response = self.bridge.create_group(name, lamps)[0]
+        if "error" in response:
+            logger.error("Could not create hue group %s, switching its lamps one by one: %s", name, response["error"])
+            return None
+        return int(response["success"]["id"])
+
     """ sets the colour for a list of lamps
-        as the bridge can only handle a limited number of lamps (depending on the amount of "colour" being sent)
-        we will break down large lamp lists into lists of 6 lamps and then wait until the bridge has
-        processed theses commands before sending the data for the next 6 lamps
+        as the bridge can only handle a limited number of commands per second the lamps are sent at the rate of the light limiter
     """
 
     def setLamps(self, lamps, colour):
-        if len(lamps) > 0:
-            for i in range(0, len(lamps), 6):
-                self.bridge.set_light(lamps[i:i + 6], colour)
-                time.sleep(0.5)
-
-    """ handle the state of one single jenkinds build job
-        this will also collate the "worst case" status if several jobs belong to one group
-        the result will be written into the states dictionary for later output to the lamps
+        for lamp in lamps:
+            if self.isSuperseded():
+                return
+            self.lightLimiter.acquire()
+            self.bridge.set_light(lamp, colour)
+            self.lampsSent([lamp], colour)
+
+    def setGroup(self, groupId, lamps, colour):
+        if self.isSuperseded():
+            return
+        self.groupLimiter.acquire()
+        self.bridge.set_group(groupId, colour)
+        self.lampsSent(lamps, colour)
+
+    """ remembers the state sent and when to re-arm lamps flashing, re-arming only sets the alert and keeps the state """
+
+    def lampsSent(self, lamps, colour):
+        now = time.monotonic()
+        for lamp in lamps:
+            if 'on' in colour:
+                self.lampStates[lamp] = colour
+            if colour.get('alert', 'none') != 'none':
+                self.rearmAt[lamp] = now + FLASHING_SEC
+            else:
+                self.rearmAt.pop(lamp, None)
+
+    """ sends the target colour of each lamp, but only for the lamps not in the target state allready
+        lamps flashing are re-armed by the sender thread as flashing stops after 15 seconds
+        every absoluteEverySec seconds all lamps are sent
     """
 
-    def treatBuild(self, states, url, job, jobStatus):
-        mapping = self.mappingpForJob(url, job)
-        if mapping:
-            logger.debug("   - treating build: {}".format(job))
-            logger.debug("     jobStatus: {}".format(jobStatus))
-            logger.debug("     --> mapped build")
-            status = jobStatus.request_status
-            health = jobStatus.health
-            active = jobStatus.active
-            logger.debug("     request status: {}".format(status))
-            logger.debug("     build health: {}".format(health))
-            logger.debug("     build active: {}".format(active))
-            logger.debug("     build belongs to mapping: {}".format(mapping.name))
-            logger.debug("     mapping covers builds: {}".format(mapping.builds))
-            logger.debug("     mapping controls lamps: {}".format(mapping.lamps))
-            if mapping.name not in states:
-                states[mapping.name] = {}
-                states[mapping.name]["lamps"] = mapping.lamps
-                states[mapping.name]["status"] = status
-                states[mapping.name]["health"] = health
-                states[mapping.name]["active"] = active
-            # consolidate for "worst" value if multiple builds contribute to one group
-            if status.value > states[mapping.name]["status"].value:
-                states[mapping.name]["status"] = status
-            if health.value > states[mapping.name]["health"].value:
-                states[mapping.name]["health"] = health
-            if active:
-                states[mapping.name]["active"] = True
-
-    def mappingpForJob(self, url, job):
-        return next((mapping for mapping in self.mappings if mapping.matches(url, job)), None)
+    def sendLamps(self, targets):
+        if time.monotonic() >= self.absoluteNext:
+            logger.debug("   - absolute output of all lamps")
+            self.lampStates = {}
+            self.absoluteNext = time.monotonic() + self.absoluteEverySec
+        lampsByColour = {} # a command per colour
+        for lamp, colour in targets.items():
+            if self.lampStates.get(lamp, None) != colour:
+                key = tuple(sorted(colour.items()))
+                lampsByColour.setdefault(key, (colour, []))[1].append(lamp)
+        logger.debug("   - {} of {} lamps changed".format(sum(len(lamps) for colour, lamps in lampsByColour.values()), len(targets)))
+        for colour, lamps in lampsByColour.values():
+            self.setLamps(self.setGroups(lamps, colour), colour)
+
+    """ hands the target state to the sender thread, replacing targets not sent yet """
+
+    def sendLampsAsync(self, targets):
+        with self.condition:
+            if self.toSend is not None:
+                logger.debug("   - superseding targets not sent yet")
+            self.toSend = targets
+            if self.__stopped:
+                self.startSender()
+            self.condition.notify_all()
+
+    def startSender(self):
+        """ start the sender thread, connecting the bridge first if not connected """
+        self.__stopped = False
+        if self.sender and self.sender.is_alive():
+            return # left behind by a stop timing out, it sends the targets after its command instead of a second sender
+        self.sending = True
+        self.sender = Thread(target=self.senderLoop, daemon=True)
+        self.sender.start()
+
+    def senderLoop(self):
+        logger.debug("Hue sender thread started")
+        try:
+            if not self.bridge and not self.connect():
+                logger.error("Could not connect to hue bridge {}, retrying with the next status".format(self.ipaddress))
+        finally:
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+        while True:
+            with self.condition:
+                while self.toSend is None and not self.__stopped and not self.lampsToRearm():
+                    self.condition.wait()
+                if self.__stopped:
+                    self.sender = None
+                    break
+                targets, self.toSend = self.toSend, None
+                self.sending = True
+            try:
+                if not self.bridge and not self.connect():
+                    logger.error("Could not connect to hue bridge {}, the status is not displayed".format(self.ipaddress))
+                elif targets is not None:
+                    self.sendLamps(targets)
+                else:
+                    self.rearmLamps(self.lampsToRearm())
+            except Exception:
+                # the lamps not sent keep their previous state, so they are sent with the next status
+                logger.exception("Error sending lamps to the hue bridge")
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.scheduleRearm()
+                    self.condition.notify_all()
+        logger.debug("Hue sender thread stopped")
+
+    def lampsToRearm(self):
+        now = time.monotonic()
+        return [lamp for lamp, rearmAt in self.rearmAt.items() if rearmAt <= now]
+
+    def scheduleRearm(self):
+        if self.rearmAt:
+            self.scheduler.schedule_at(self, min(self.rearmAt.values()), self.wakeSender)
+        else:
+            self.scheduler.cancel(self)
+
+    def wakeSender(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    """ restarts the flashing of the given lamps, all lamps of a mapping flash synchronously as they are re-armed by group """
+
+    def rearmLamps(self, lamps):
+        logger.debug("   - re-arm flashing of lamps {}".format(lamps))
+        for lamp in lamps: # if the bridge fails, retry with the next re-arm
+            self.rearmAt[lamp] = time.monotonic() + FLASHING_SEC
+        self.setLamps(self.setGroups(lamps, FLASHING_15SEC), FLASHING_15SEC)
+
+    def isSuperseded(self):
+        """ stop sending older targets when newer ones are queued or the sender is stopped """
+        return self.sending and (self.toSend is not None or self.__stopped)
+
+    def waitForLamps(self, timeout=30):
+        """ wait until all targets are sent """
+        end = time.monotonic() + timeout
+        with self.condition:
+            while (self.toSend is not None or self.sending) and time.monotonic() < end:
+                self.condition.wait(timeout=max(end - time.monotonic(), 0.01))
+
+    def stopSender(self):
+        """ stop the sender thread, targets not sent yet are dropped """
+        with self.condition:
+            self.__stopped = True
+            self.toSend = None
+            self.scheduler.cancel(self)
+            self.condition.notify_all()
+            sender = self.sender
+        if sender and sender is not current_thread():
+            sender.join(timeout=STOP_SENDER_TIMEOUT_SEC) # the sender is restarted with the next update
+            if sender.is_alive():
+                logger.warning("Hue sender thread of bridge {} did not stop within {} seconds".format(self.ipaddress, STOP_SENDER_TIMEOUT_SEC))
+
+    """ switches the mappings with all lamps in the given list by group, returns the remaining lamps """
+
+    def setGroups(self, lamps, colour):
+        for mapping in self.mappings:
+            if mapping.name in self.groups and all(lamp in lamps for lamp in mapping.lamps):
+                self.setGroup(self.groups[mapping.name], mapping.lamps, colour)
+                lamps = [lamp for lamp in lamps if lamp not in mapping.lamps]
+        return lamps
 
     """ determine lamp colour depending on request_status and health """
 
@@ -246,7 +525,7 @@ class HueOutput():
     """ iterate over the state of all groups and set the lamps accordingly """
 
     def updateLamps(self, states):
-        treated = []
+        targets = {}
         logger.debug("   - lamps: {}".format(self.lamps))
         logger.debug("   - states: {}".format(states))
         for build in states:
@@ -257,13 +536,105 @@ class HueOutput():
             logger.debug("   lamps: {}".format(lamps))
             colour = self.getColour(state)
             logger.debug("   colour: {}".format(colour))
-            self.setLamps(lamps, colour)
-            treated = treated + lamps
-        untreated = [x for x in self.lamps if x not in self.unused and x not in treated]
+            for lamp in lamps:
+                targets[lamp] = colour
+        untreated = [x for x in self.lamps if x not in self.unused and x not in targets]
         logger.debug("   - set untreated lamps to white: {}".format(untreated))
-        self.setLamps(untreated, COLOUR_WHITE)
+        for lamp in untreated:
+            targets[lamp] = COLOUR_WHITE
         logger.debug("   - set unused lamps off: {}".format(self.unused))
-        self.setLamps(self.unused, LAMP_OFF)
+        for lamp in self.unused:
+            targets[lamp] = LAMP_OFF
+        self.sendLampsAsync(targets)
+
+
+class HueOutput():
+    """ Evaluates the mappings of all bridges once per update, the lamps are sent to all bridges in parallel """
+
+    def __init__(self, ipaddress=None, lamps=None, unused=None, mappings=None, transitiontimeMillis=DEFAULT_TRANSITIONTIME_MILLIS,
+                 absoluteEverySec=DEFAULT_ABSOLUTE_EVERY_SEC, useGroups=True, lightCommandsPerSec=DEFAULT_LIGHT_COMMANDS_PER_SEC,
+                 groupCommandsPerSec=DEFAULT_GROUP_COMMANDS_PER_SEC, connectRetries=DEFAULT_CONNECT_RETRIES,
+                 connectRetryDelaySec=DEFAULT_CONNECT_RETRY_DELAY_SEC, bridges=None):
+        logger.debug("--- HueOutput.init() start ---")
+        defaults = {"ipaddress": ipaddress, "lamps": lamps or [], "unused": unused or [], "mappings": mappings or {},
+                    "transitiontimeMillis": transitiontimeMillis, "absoluteEverySec": absoluteEverySec, "useGroups": useGroups,
+                    "lightCommandsPerSec": lightCommandsPerSec, "groupCommandsPerSec": groupCommandsPerSec,
+                    "connectRetries": connectRetries, "connectRetryDelaySec": connectRetryDelaySec}
+        # the settings given for all bridges are the defaults of each bridge
+        self.bridges = [HueBridgeOutput(**dict(defaults, **bridge)) for bridge in (bridges if bridges else [{}])]
+        self.mappingsByKey = {} # the mappings of each job, evaluated once per job
+        logger.debug("--- HueOutput.init() done ---")
+
+    def close(self):
+        logger.debug("--- HueOutput.close() start ---")
+        for bridge in self.bridges:
+            bridge.close()
+        logger.debug("--- HueOutput.close() done ---")
+
+    def waitForLamps(self, timeout=30):
+        for bridge in self.bridges:
+            bridge.waitForLamps(timeout)
+
+    def stopSender(self):
+        for bridge in self.bridges:
+            bridge.stopSender()
+
+    """ collate the "worst case" status of all jobs per mapping group in one pass for all bridges,
+        on each bridge each job belongs to the first group it matches
+        the result is the state per group of each bridge for the output to the lamps
+    """
+
+    def mappingStates(self, status):
+        summaries = cached_summary(status,
+                                   ("hue", tuple(tuple(mapping.key() for mapping in bridge.mappings) for bridge in self.bridges)),
+                                   lambda: self.summarizeMappings(status))
+        states = []
+        for index, bridge in enumerate(self.bridges):
+            bridgeStates = {}
+            for mapping in bridge.mappings:
+                if (index, mapping.name) in summaries:
+                    summary = summaries[(index, mapping.name)]
+                    logger.debug("   - mapping {} controls lamps {}: {}".format(mapping.name, mapping.lamps, summary))
+                    bridgeStates[mapping.name] = {"lamps": mapping.lamps,
+                                                  "status": summary.max_request_status(),
+                                                  "health": summary.max_health,
+                                                  "active": summary.active}
+            states.append(bridgeStates)
+        return states
+
+    def summarizeMappings(self, status):
+        summaries = {}
+        for key, jobStatus in status.items():
+            for index, mapping in self.mappingsForKey(key):
+                summaries.setdefault((index, mapping.name), HealthSummary()).add(jobStatus)
+        return summaries
+
+    def mappingsForJob(self, url, job):
+        """ the first mapping matching on each bridge as (bridge index, mapping) """
+        mappings = []
+        for index, bridge in enumerate(self.bridges):
+            mapping = next((mapping for mapping in bridge.mappings if mapping.matches(url, job)), None)
+            if mapping:
+                mappings.append((index, mapping))
+        return tuple(mappings)
+
+    def mappingsForKey(self, key):
+        if key not in self.mappingsByKey:
+            if len(self.mappingsByKey) >= default_max_matched_keys:
+                self.mappingsByKey = {}
+            self.mappingsByKey[key] = self.mappingsForJob(key[0], key[1])
+        return self.mappingsByKey[key]
+
+    """ jobs not belonging to any mapping are not routed to this output """
+
+    def route(self, key):
+        return len(self.mappingsForKey(key)) > 0
+
+    """ hands the lamps to the sender of each bridge, the bridges are sent in parallel """
+
+    def updateLamps(self, states):
+        for bridge, bridgeStates in zip(self.bridges, states):
+            bridge.updateLamps(bridgeStates)
 
     """ main method called by cimon.py when jenkins updates have been received """
 
@@ -284,13 +655,8 @@ class HueOutput():
         """
         logger.debug("--- HueOutput.onUpdate start ---")
         logger.debug("- status contains {} entries".format(len(status)))
-        states = {}
-        items = status.items()
         logger.debug("-> Evaluating Jobs")
-        for key, value in items:
-            url = key[0]
-            job = key[1]
-            self.treatBuild(states, url, job, value)
+        states = self.mappingStates(status)
         logger.debug("-> Updating Lamps")
         self.updateLamps(states)
         logger.debug("--- HueOutput.onUpdate done ---")
@@ -6,14 +6,21 @@ __author__ = 'florianseidl'
 import json
 import logging
 import re
+import socket
 import sys
 from concurrent import futures
+from copy import copy
 from datetime import datetime
+from threading import Lock, Thread, current_thread
+from time import sleep
+from uuid import uuid4
+from zlib import crc32
 from urllib.parse import urlparse
 from urllib.error import HTTPError, URLError
 
 from cimon import JobStatus, RequestStatus, Health
-from collector import create_http_client, configure_client_cert
+from collector import create_http_client, configure_client_cert, TaskQueue, LimitedTaskQueue, BoundedCache, KeyCache, \
+    server_sent_events, default_cache_max_size, default_cache_ttl_sec, default_not_found_ttl_sec
 from configutil import decrypt
 
 # Collect the build status in jenins via rest requests.
@@ -28,14 +35,54 @@ from configutil import decrypt
 # the "request_status" allways has to be checked first, only if it is OK the further values are contained
 # { (<hostname>, <job_name_as_string>) : JobStatus }
 #
+# in mode "push" the status is kept up to date by the job events of the jenkins sse gateway plugin,
+# jobs, views and folders are only polled after (re)connecting to the event stream
+#
+# with a list of "jenkins" instead of one "url" many jenkins masters are collected together: they share one bounded
+# pool of maxParallelRequest threads, each master is limited to maxParallelRequestPerHost requests at the same time
+# and the masters are started staggered by staggerStartSec. The keys are qualified by the name (hostname) of each master.
+#
 default_max_parallel_requests = 7
 default_update_views_every = 50
 default_view_depth = 0
+default_mode = "poll"
+default_reconnect_delay_sec = 10
+default_event_read_timeout_sec = 60
+default_warm_poll_every = 1
+default_cold_poll_every = 1
+default_max_parallel_requests_per_host = 4
+default_stagger_start_sec = 0.2
+default_hot_cycles = 3
+default_warm_cycles = 10
 
 logger = logging.getLogger(__name__)
 
 
 def create(configuration, key=None):
+    if "jenkins" in configuration:
+        return create_federated(configuration, key)
+    return create_single(configuration, key)
+
+
+def create_federated(configuration, key=None):
+    # each jenkins entry is configured like a single jenkins collector, the keys on top level are the defaults for all
+    defaults = {k: v for k, v in configuration.items() if k not in ("jenkins", "implementation")}
+    collectors = []
+    for jenkins_configuration in configuration["jenkins"]:
+        member_configuration = dict(defaults, **jenkins_configuration)
+        if member_configuration.get("mode", default_mode) != "poll":
+            raise ValueError("Federated jenkins collector supports poll mode only: %s" % member_configuration["url"])
+        collectors.append(create_single(member_configuration, key))
+    return FederatedJenkinsCollector(collectors=collectors,
+                                     max_parallel_requests=configuration.get("maxParallelRequest",
+                                                                             default_max_parallel_requests),
+                                     max_parallel_requests_per_host=configuration.get(
+                                         "maxParallelRequestPerHost", default_max_parallel_requests_per_host),
+                                     stagger_start_sec=configuration.get("staggerStartSec",
+                                                                         default_stagger_start_sec))
+
+
+def create_single(configuration, key=None):
     jenkins = JenkinsClient(http_client=create_http_client(base_url=configuration["url"],
                                                            username=configuration.get("user", None),
                                                            password=configuration.get("password", None) or decrypt(
@@ -44,23 +91,40 @@ def create(configuration, key=None):
                                                            saml_login_url=configuration.get("samlLoginUrl", None),
                                                            verify_ssl=configuration.get("verifySsl", True),
                                                            client_cert=configure_client_cert(
-                                                               configuration.get("clientCert", None), key), ),
+                                                               configuration.get("clientCert", None), key),
+                                                           not_found_ttl_sec=configuration.get(
+                                                               "notFoundCacheTtlSec", default_not_found_ttl_sec)),
                             view_depth=configuration.get("viewDepth", default_view_depth))
-    return JenkinsCollector(jenkins=jenkins,
-                            base_url=configuration["url"],
-                            job_names=configuration.get("jobs", ()),
-                            view_names=configuration.get("views", ()),
-                            folder_names=configuration.get("folders", []) +
-                                         configuration.get("orgFolders", []),
-                            multibranch_pipeline_names=configuration.get("multibranch_pipelines", []) +
-                                                       configuration.get("multibranchPipelines", []) +
-                                                       configuration.get("plainFolders", []),
-                            max_parallel_requests=configuration.get("maxParallelRequest",
-                                                                    default_max_parallel_requests),
-                            name=configuration.get('name', None),
-                            job_name_from_url_pattern=configuration.get('jobNameFromUrlPattern', None),
-                            job_name_from_url_pattern_match_group=configuration.get('jobNameFromUrlPatternMatchGroup',
-                                                                                    1))
+    collector_configuration = dict(jenkins=jenkins,
+                                   base_url=configuration["url"],
+                                   job_names=configuration.get("jobs", ()),
+                                   view_names=configuration.get("views", ()),
+                                   folder_names=configuration.get("folders", []) +
+                                                configuration.get("orgFolders", []),
+                                   multibranch_pipeline_names=configuration.get("multibranch_pipelines", []) +
+                                                              configuration.get("multibranchPipelines", []) +
+                                                              configuration.get("plainFolders", []),
+                                   max_parallel_requests=configuration.get("maxParallelRequest",
+                                                                           default_max_parallel_requests),
+                                   name=configuration.get('name', None),
+                                   job_name_from_url_pattern=configuration.get('jobNameFromUrlPattern', None),
+                                   job_name_from_url_pattern_match_group=configuration.get(
+                                       'jobNameFromUrlPatternMatchGroup', 1),
+                                   cache_max_size=configuration.get("cacheMaxSize", default_cache_max_size),
+                                   cache_ttl_sec=configuration.get("cacheTtlSec", default_cache_ttl_sec),
+                                   warm_poll_every=configuration.get("warmPollEvery", default_warm_poll_every),
+                                   cold_poll_every=configuration.get("coldPollEvery", default_cold_poll_every))
+    mode = configuration.get("mode", default_mode)
+    if mode == "poll":
+        return JenkinsCollector(**collector_configuration)
+    elif mode == "push":
+        return JenkinsPushCollector(reconnect_delay_sec=configuration.get("reconnectDelaySec",
+                                                                          default_reconnect_delay_sec),
+                                    event_read_timeout_sec=configuration.get("eventReadTimeoutSec",
+                                                                             default_event_read_timeout_sec),
+                                    **collector_configuration)
+    else:
+        raise ValueError("Unknown mode of jenkins collector: %s" % mode)
 
 
 class JenkinsCollector:
@@ -76,7 +140,11 @@ class JenkinsCollector:
                  max_parallel_requests=default_max_parallel_requests,
                  name=None,
                  job_name_from_url_pattern=None,
-                 job_name_from_url_pattern_match_group=1):
+                 job_name_from_url_pattern_match_group=1,
+                 cache_max_size=default_cache_max_size,
+                 cache_ttl_sec=default_cache_ttl_sec,
+                 warm_poll_every=default_warm_poll_every,
+                 cold_poll_every=default_cold_poll_every):
         self.job_names = tuple(job_names)
         self.view_names = tuple(view_names)
         self.folder_names = tuple(folder_names)
@@ -88,48 +156,305 @@ class JenkinsCollector:
             NameFromUrlPatternExtractor(job_name_from_url_pattern,
                                         job_name_from_url_pattern_match_group) if job_name_from_url_pattern \
                 else NoNameFromUrlPatternExtractor()
+        # all per job caches are bounded, as jobs (for instance branches) come and go. The keys are kept for the jobs of the
+        # last collection, a bound below the number of jobs would resolve them again each collection
         self.job_reader = JobReader(
             name=name,
             jenkins=jenkins,
-            name_from_url_pattern_extractor=name_from_url_pattern_extractor)
+            name_from_url_pattern_extractor=name_from_url_pattern_extractor,
+            keys=KeyCache(),
+            last_results=BoundedCache(max_size=cache_max_size, ttl_sec=cache_ttl_sec))
+        self.job_tiers = JobTiers(warm_poll_every=warm_poll_every,
+                                  cold_poll_every=cold_poll_every,
+                                  history=BoundedCache(max_size=cache_max_size, ttl_sec=cache_ttl_sec))
+        self.cycle = 0
         self.view_reader = ViewReader(
             name=name,
             jenkins=jenkins,
-            name_from_url_pattern_extractor=name_from_url_pattern_extractor)
+            name_from_url_pattern_extractor=name_from_url_pattern_extractor,
+            keys=KeyCache())
         self.folder_reader = FolderAndMultibranchPipelineReader(
             name=name,
             jenkins=jenkins,
-            name_from_url_pattern_extractor=name_from_url_pattern_extractor)
+            name_from_url_pattern_extractor=name_from_url_pattern_extractor,
+            keys=KeyCache())
         logger.info("configured jenkins collector %s", self.__dict__)
 
     def collect(self):
-        method_param = [(self.job_reader.collect_job, job_name) for job_name in self.job_names] + \
-                       [(self.view_reader.collect_view, view_name) for view_name in self.view_names] + \
-                       [(self.collect_folder, folder_name) for folder_name in self.folder_names] + \
-                       [(self.folder_reader.collect_multibranch_pipeline_standalone, multibranch_pipeline_name) for
-                        multibranch_pipeline_name in self.multibranch_pipeline_names]
-
-        builds = self.collect_async(method_param)
+        with futures.ThreadPoolExecutor(max_workers=self.max_parallel_requests) as executor:
+            tasks = TaskQueue(executor)
+            self.submit_tasks(tasks)
+            builds = tasks.join()
         logger.debug("Build status collected: %s", builds)
+        logger.debug("Cache stats: %s", self.cache_stats())
+        return builds
+
+    def cache_stats(self):
+        return {"lastResults": self.job_reader.last_results.stats(),
+                "jobTiers": self.job_tiers.history.stats(),
+                "keys": {"jobs": self.job_reader.keys.stats(),
+                         "views": self.view_reader.keys.stats(),
+                         "folders": self.folder_reader.keys.stats()}}
+
+    def submit_tasks(self, tasks):
+        # all requests (jobs, views, folders, pipelines) go to the same bounded queue, views and folders
+        # submit the nested views and pipelines they find to the queue instead of opening a thread pool of their own
+        cycle = self.cycle
+        self.cycle += 1
+        for reader in (self.job_reader, self.view_reader, self.folder_reader):
+            reader.keys.next_collection()
+        for job_name in self.job_names:
+            builds_not_due = self.job_tiers.builds_if_not_due(job_name, cycle)
+            if builds_not_due:  # not polled this time, use the last result
+                tasks.add(builds_not_due)
+            else:
+                tasks.submit(self.__collect_job_and_record__, job_name, cycle)
+        self.view_reader.collect_views(self.view_names, tasks)
+        for folder_name in self.folder_names:
+            tasks.submit(self.collect_folder, folder_name, tasks)
+        for multibranch_pipeline_name in self.multibranch_pipeline_names:
+            tasks.submit(self.folder_reader.collect_multibranch_pipeline_standalone, multibranch_pipeline_name)
+
+    def __collect_job_and_record__(self, job_name, cycle):
+        builds = self.job_reader.collect_job(job_name)
+        self.job_tiers.record(job_name, builds, cycle)
         return builds
 
-    def collect_folder(self, folder_name):
+    def collect_folder(self, folder_name, tasks):
         folder = self.folder_reader.read_folder(folder_name)
-        method_param = [(self.folder_reader.collect_multibranch_pipeline_in_folder, (folder_name, multibranch["name"]))
-                        for
-                        multibranch in folder["jobs"]]
-        return self.collect_async(method_param)
+        if not folder:
+            return {self.folder_reader.qualified_job_name(folder_name, None): JobStatus(request_status=RequestStatus.ERROR)}
+        for multibranch in folder["jobs"]:
+            tasks.submit(self.folder_reader.collect_multibranch_pipeline_in_folder, (folder_name, multibranch["name"]))
 
-    def collect_async(self, method_param):
-        with futures.ThreadPoolExecutor(max_workers=self.max_parallel_requests) as executor:
-            future_requests = {executor.submit(method, params):
-                                   (method, params) for method, params in method_param}
 
-        builds = {}
-        for future_request in futures.as_completed(future_requests):
-            builds.update(future_request.result())
+class FederatedJenkinsCollector:
+    """ Collects many jenkins masters at once. All requests go to one shared bounded executor, as python urllib does not
+    pool connections the thread pool is the shared resource to bound. Each master is limited to
+    max_parallel_requests_per_host so a slow master cannot occupy all the threads, and the masters are started staggered
+    in order not to hit all of them in the same instant. """
+
+    def __init__(self,
+                 collectors,
+                 max_parallel_requests=default_max_parallel_requests,
+                 max_parallel_requests_per_host=default_max_parallel_requests_per_host,
+                 stagger_start_sec=default_stagger_start_sec):
+        self.collectors = tuple(collectors)
+        names = [collector.job_reader.name for collector in self.collectors]
+        if len(set(names)) != len(names):
+            raise ValueError("Names of federated jenkins collectors are not unique: %s" % names)
+        self.max_parallel_requests = max_parallel_requests
+        self.max_parallel_requests_per_host = max_parallel_requests_per_host
+        self.stagger_start_sec = stagger_start_sec
+        logger.info("configured federated jenkins collector for %s", names)
+
+    def collect(self):
+        with futures.ThreadPoolExecutor(max_workers=self.max_parallel_requests) as executor:
+            tasks = TaskQueue(executor)
+            for i, collector in enumerate(self.collectors):
+                if i > 0 and self.stagger_start_sec > 0:
+                    sleep(self.stagger_start_sec)
+                collector.submit_tasks(LimitedTaskQueue(tasks, self.max_parallel_requests_per_host))
+            builds = tasks.join()
+        logger.debug("Build status collected: %s", builds)
+        logger.debug("Cache stats: %s", self.cache_stats())
         return builds
 
+    def cache_stats(self):
+        return {collector.job_reader.name: collector.cache_stats() for collector in self.collectors}
+
+
+class JobTiers():
+    """ Classifies the jobs polled one by one by their recent history in order to poll the ones changing often more often:
+    - hot: building, in error or changed within the last hot_cycles polls - polled every time
+    - warm: not healthy or changed within the last warm_cycles polls - polled every warm_poll_every times
+    - cold: healthy and stable - polled every cold_poll_every times
+    The polls of warm and cold jobs are spread over the cycles by job name. """
+    hot = "hot"
+    warm = "warm"
+    cold = "cold"
+
+    def __init__(self, warm_poll_every=default_warm_poll_every, cold_poll_every=default_cold_poll_every,
+                 hot_cycles=default_hot_cycles, warm_cycles=default_warm_cycles, history=None):
+        self.poll_every = {self.hot: 1, self.warm: max(warm_poll_every, 1), self.cold: max(cold_poll_every, 1)}
+        self.hot_cycles = hot_cycles
+        self.warm_cycles = warm_cycles
+        self.history = history if history is not None else BoundedCache()
+
+    def builds_if_not_due(self, job_name, cycle):
+        """ the last builds of the job if it is not to be polled in the given cycle, else None """
+        history = self.history.get(job_name)
+        if not history:
+            return None
+        poll_every = self.poll_every[self.tier(history, cycle)]
+        return history[0] if (cycle + crc32(job_name.encode("utf-8"))) % poll_every else None
+
+    def tier(self, history, cycle):
+        builds, last_changed = history
+        cycles_since_change = cycle - last_changed
+        for status in builds.values():
+            if status.request_status != RequestStatus.OK or status.active or cycles_since_change < self.hot_cycles:
+                return self.hot
+            if status.health != Health.HEALTHY or cycles_since_change < self.warm_cycles:
+                return self.warm
+        return self.cold
+
+    def record(self, job_name, builds, cycle):
+        previous = self.history.get(job_name)
+        changed = not previous or self.__signature__(previous[0]) != self.__signature__(builds)
+        self.history.put(job_name, (builds, cycle if changed else previous[1]))
+
+    def __signature__(self, builds):
+        return [(key, status.request_status, status.health, status.active) for key, status in builds.items()]
+
+
+class JenkinsPushCollector(JenkinsCollector):
+    """ Keeps a live status table updated by the job events of the jenkins sse gateway plugin.
+    Polls jobs, views and folders only while not connected to the event stream and once after (re)connecting.
+    Triggers the cimon to collect and output as soon as a tracked job changes. """
+
+    def __init__(self, jenkins, base_url, reconnect_delay_sec=default_reconnect_delay_sec,
+                 event_read_timeout_sec=default_event_read_timeout_sec, **kwargs):
+        super().__init__(jenkins, base_url, **kwargs)
+        self.jenkins = jenkins
+        self.base_url = base_url
+        self.reconnect_delay_sec = reconnect_delay_sec
+        self.event_read_timeout_sec = event_read_timeout_sec
+        self.client_id = "cimon-%s" % uuid4()
+        self.__lock = Lock()
+        self.__status = {}
+        self.__connected = False
+        self.__poll_required = True
+        self.__events_while_polling = None
+        self.__trigger = None
+        self.__listener = None
+
+    def set_trigger(self, trigger):
+        self.__trigger = trigger
+
+    def collect(self):
+        self.__start_listener_if_not_started__()
+        with self.__lock:
+            poll = self.__poll_required or not self.__connected
+            if poll:
+                # cleared before polling so a reconnect while polling requires the next poll, set again if the poll fails
+                self.__poll_required = False
+                self.__events_while_polling = []
+        if poll:
+            self.__poll__()
+        with self.__lock:
+            return dict(self.__status)
+
+    def close(self):
+        # the listener thread stops reading as soon as the next event or heartbeat arrives or the read times out
+        with self.__lock:
+            listener, self.__listener = self.__listener, None
+            self.__connected = False
+            self.__poll_required = True
+        if listener:
+            logger.info("Stopping jenkins event listener")
+
+    def __poll__(self):
+        builds = None
+        try:
+            builds = super().collect()
+        finally:
+            with self.__lock:
+                events, self.__events_while_polling = self.__events_while_polling, None
+                if builds is None or any(status.request_status == RequestStatus.ERROR for status in builds.values()):
+                    self.__poll_required = True
+                if builds is not None:
+                    self.__status = builds
+                    # events received while polling are newer than the polled status
+                    for event in events:
+                        self.__apply_event__(event)
+
+    def __start_listener_if_not_started__(self):
+        with self.__lock:
+            if self.__listener:
+                return
+            self.__listener = Thread(target=self.__listen__, daemon=True)
+            self.__listener.start()
+
+    def __is_listening__(self):
+        # a listener thread stops as soon as it is not the current listener any more (closed or replaced)
+        return self.__listener is current_thread()
+
+    def __listen__(self):
+        logger.info("Starting jenkins event listener")
+        while self.__is_listening__():
+            try:
+                for event, data in server_sent_events(self.jenkins.connect_events(self.client_id, self.event_read_timeout_sec)):
+                    if not self.__is_listening__():
+                        break
+                    self.__on_event__(event, json.loads(data))
+            except socket.timeout:
+                if self.__is_listening__():
+                    logger.warning("No jenkins event or heartbeat within %s seconds", self.event_read_timeout_sec)
+            except Exception:
+                if self.__is_listening__():
+                    logger.exception("Error reading jenkins events")
+            if self.__is_listening__():
+                with self.__lock:
+                    self.__connected = False
+                    self.__poll_required = True
+                logger.info("Disconnected from jenkins events, reconnecting in %s seconds", self.reconnect_delay_sec)
+                sleep(self.reconnect_delay_sec)
+        logger.info("Stopped jenkins event listener")
+
+    def __on_event__(self, event, data):
+        if event == "open":
+            with self.__lock:
+                self.__connected = True
+                self.__poll_required = True  # status may have changed while not connected
+            self.jenkins.subscribe_events(data["dispatcherId"], "job")
+            logger.info("Connected to jenkins events, subscribed to job events")
+        elif event == "job":
+            with self.__lock:
+                if self.__events_while_polling is not None:
+                    self.__events_while_polling.append(data)
+                changed = self.__apply_event__(data)
+            if changed and self.__trigger:
+                self.__trigger()
+
+    def __event_key__(self, event):
+        # same key as polled: the name from the job url if configured, else the full name (as of folders and pipelines)
+        name_from_url = self.job_reader.name_from_url_pattern_extractor.extract_name(self.__event_job_url__(event))
+        job_name = event.get("job_name", None)
+        return (self.job_reader.name, intern_if_str(name_from_url or (job_name.replace("%2F", "/") if job_name else job_name)))
+
+    def __event_job_url__(self, event):
+        # the object url is relative to jenkins, the url of a run ends with the build number
+        object_url = event.get("jenkins_object_url", None)
+        if not object_url:
+            return None
+        if event.get("jenkins_event", None) in ("job_run_started", "job_run_ended"):
+            object_url = re.sub(r"[0-9]+/?$", "", object_url)
+        return "%s/%s" % (self.base_url.rstrip("/"), object_url.lstrip("/"))
+
+    def __apply_event__(self, event):
+        key = self.__event_key__(event)
+        current = self.__status.get(key, None)
+        if not current:  # not a tracked job
+            return False
+        updated = copy(current)
+        jenkins_event = event.get("jenkins_event", None)
+        if jenkins_event == "job_run_started":
+            updated.active = True
+        elif jenkins_event == "job_run_ended":
+            updated.active = False
+            updated.health = self.job_reader.jenkins_result_to_result.get(event.get("job_run_status", None), Health.OTHER)
+        elif jenkins_event == "job_crud_deleted":
+            updated = JobStatus(request_status=RequestStatus.NOT_FOUND)
+        if updated.request_status == RequestStatus.OK and jenkins_event in ("job_run_started", "job_run_ended") \
+                and str(event.get("jenkins_object_id", "")).isdigit():
+            updated.number = int(event["jenkins_object_id"])
+        if updated == current:
+            return False
+        logger.debug("Job event %s changed status of %s to %s", jenkins_event, key, updated)
+        self.__status[key] = updated
+        return True
+
 
 class BaseReader():
     colors_to_result = {"red": Health.SICK,
@@ -138,14 +463,26 @@ class BaseReader():
                         "notbuilt": Health.UNDEFINED,
                         "aborted": Health.UNDEFINED}
 
-    def __init__(self, name, jenkins, name_from_url_pattern_extractor):
-        self.name = name
+    def __init__(self, name, jenkins, name_from_url_pattern_extractor, keys=None):
+        self.name = intern_if_str(name)
         self.jenkins = jenkins
         self.name_from_url_pattern_extractor = name_from_url_pattern_extractor
+        # the key of a job is resolved once and then reused, so each cycle returns the identical (interned) key objects
+        self.keys = keys if keys is not None else KeyCache()
 
     def qualified_job_name(self, job_name, url):
+        return self.cached_key(("job", job_name, url), self.__resolve_qualified_job_name__)
+
+    def cached_key(self, cache_key, resolve):
+        key = self.keys.get(cache_key)
+        if key is None:
+            key = (self.name, intern_if_str(resolve(*cache_key[1:])))
+            self.keys.put(cache_key, key)
+        return key
+
+    def __resolve_qualified_job_name__(self, job_name, url):
         name_from_url = self.name_from_url_pattern_extractor.extract_name(url)
-        return self.name, name_from_url if name_from_url else job_name
+        return name_from_url if name_from_url else job_name
 
     def status_from_color(self, job):
         if "color" in job:
@@ -161,9 +498,9 @@ class BaseReader():
 
 
 class JobReader(BaseReader):
-    def __init__(self, name, jenkins, name_from_url_pattern_extractor):
-        super().__init__(name, jenkins, name_from_url_pattern_extractor)
-        self.last_results = {}
+    def __init__(self, name, jenkins, name_from_url_pattern_extractor, keys=None, last_results=None):
+        super().__init__(name, jenkins, name_from_url_pattern_extractor, keys)
+        self.last_results = last_results if last_results is not None else BoundedCache()
 
     jenkins_result_to_result = {"SUCCESS": Health.HEALTHY,
                                 "UNSTABLE": Health.UNWELL,
@@ -217,34 +554,33 @@ class JobReader(BaseReader):
         if jenkins_result:
             result = self.jenkins_result_to_result[
                 jenkins_result] if jenkins_result in self.jenkins_result_to_result else Health.OTHER
-            self.last_results[job_name] = result
+            self.last_results.put(job_name, result)
             return result
         else:
-            return self.last_results[job_name] if job_name in self.last_results else Health.OTHER
+            return self.last_results.get(job_name, Health.OTHER)
 
 
 class ViewReader(BaseReader):
-    def collect_view(self, view_name):
-        # separate method because default parameter does not work easily with future
-        return self.__collect_view_recursive__(view_name, set())
-
-    def __collect_view_recursive__(self, view_name, allready_visited):
-        if view_name in allready_visited:  # guard against infinite loops
-            return {}
-        allready_visited.add(view_name)
-
+    def collect_views(self, view_names, tasks):
+        # breadth first: every view read submits its nested views to the task queue at once,
+        # so the time needed is bounded by the depth of the view tree and not its size
+        visited = VisitedSet()
+        for view_name in view_names:
+            self.__submit_if_not_visited__(view_name, visited, tasks)
+
+    def __submit_if_not_visited__(self, view_name, visited, tasks):
+        if visited.add_if_not_visited(view_name):
+            tasks.submit(self.__collect_view__, view_name, visited, tasks)
+
+    def __collect_view__(self, view_name, visited, tasks):
         view = self.__view__(view_name)
-        if view:
-            # add the builds to the existing ones (from recursion)
-            builds = self.__extract_job__status__(view)
-            if "views" in view:
-                nested_views = self.__extract_nested_view_names__(view)
-                for nested_view in nested_views:
-                    # recurse for all nested views
-                    builds.update(self.__collect_view_recursive__(nested_view, allready_visited))
-            return builds
-        else:
+        if not view:
             return {self.qualified_job_name(view_name, None): JobStatus(request_status=RequestStatus.ERROR)}
+        # submit the nested views first, they are read while the jobs of this view are extracted
+        if "views" in view:
+            for nested_view in self.__extract_nested_view_names__(view):
+                self.__submit_if_not_visited__(nested_view, visited, tasks)
+        return self.__extract_job__status__(view)
 
     def __extract_job__status__(self, view):
         builds = {}
@@ -301,6 +637,21 @@ class ViewReader(BaseReader):
             logger.exception("Error occured requesting info for view %s" % view_name)
 
 
+class VisitedSet():
+    """ thread safe set of the views allready visited, guards against infinite loops in nested views """
+
+    def __init__(self):
+        self.__visited = set()
+        self.__lock = Lock()
+
+    def add_if_not_visited(self, name):
+        with self.__lock:
+            if name in self.__visited:
+                return False
+            self.__visited.add(name)
+            return True
+
+
 class FolderAndMultibranchPipelineReader(BaseReader):
     def collect_multibranch_pipeline_in_folder(self, folder_multibranch_pipeline_name):
         return self.map_multibranch_pipeline(
@@ -319,8 +670,7 @@ class FolderAndMultibranchPipelineReader(BaseReader):
         builds = {}
         for job in pipeline["jobs"]:
             status = self.__status_multibranch_job__(job)
-            builds[(self.name,
-                    self.__pipeline_job_name__(pipeline_name, job["url"]))] = status
+            builds[self.cached_key(("pipeline", pipeline_name, job["url"]), self.__pipeline_job_name__)] = status
             logger.debug("Converted Mulitbranch pipeline build result: %s", str(status))
         return builds
 
@@ -414,7 +764,8 @@ class JenkinsClient():
         self.view_depth = view_depth
 
     def latest_build(self, job_name):
-        return json.loads(self.http_client.open_and_read("/job/%s/lastBuild/api/json?depth=0" % job_name))
+        # a new job has no last build until it is built the first time
+        return json.loads(self.http_client.open_and_read("/job/%s/lastBuild/api/json?depth=0" % job_name, cache_not_found=False))
 
     def view(self, view_name):
         return json.loads(self.http_client.open_and_read("/view/%s/api/json?depth=%d" % (view_name, self.view_depth)))
@@ -429,18 +780,31 @@ class JenkinsClient():
     def multibranch_pipeline_standalone(self, multibranch_pipeline_name):
         return json.loads(self.http_client.open_and_read("/job/%s/api/json" % (multibranch_pipeline_name)))
 
+    def connect_events(self, client_id, read_timeout_sec=None):
+        # the sse gateway plugin requires a connect before listening, returns the open event stream
+        # reading the stream times out after read_timeout_sec without any event or heartbeat
+        self.http_client.open_and_read("/sse-gateway/connect?clientId=%s" % client_id)
+        return self.http_client.open("/sse-gateway/listen/%s" % client_id, timeout_sec=read_timeout_sec)
+
+    def subscribe_events(self, dispatcher_id, channel):
+        subscription = {"dispatcherId": dispatcher_id,
+                        "subscribe": [{"jenkins_channel": channel}],
+                        "unsubscribe": []}
+        return self.http_client.open_and_read("/sse-gateway/configure?batchId=%s" % uuid4().hex,
+                                              data=json.dumps(subscription).encode("utf-8"))
+
 
 class NameFromUrlPatternExtractor():
     def __init__(self,
                  name_from_url_pattern,
                  name_from_url_pattern_match_group):
-        self.name_from_url_pattern = name_from_url_pattern
+        self.name_from_url_pattern = re.compile(name_from_url_pattern)
         self.name_from_url_pattern_match_group = name_from_url_pattern_match_group
 
     def extract_name(self, url):
         if not url:
             return None
-        matcher = re.search(self.name_from_url_pattern, url)
+        matcher = self.name_from_url_pattern.search(url)
         if not matcher or len(matcher.groups()) < self.name_from_url_pattern_match_group:
             return None
         return matcher.group(self.name_from_url_pattern_match_group)
@@ -451,6 +815,10 @@ class NoNameFromUrlPatternExtractor():
         return None
 
 
+def intern_if_str(name):
+    return sys.intern(name) if isinstance(name, str) else name
+
+
 if __name__ == '__main__':
     base_url = sys.argv[1]
     build = sys.argv[2]
@@ -3,15 +3,17 @@
 __author__ = 'florianseidl'
 
 from urllib.request import urlopen, HTTPError, Request, URLError
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 from concurrent import futures
 import json
 import logging
 import sys
-from collector import HttpClient, create_http_client
+from collector import HttpClient, create_http_client, default_not_found_ttl_sec
 from configutil import decrypt
 from cimon import Health,RequestStatus,JobStatus
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs, quote
+from collections import deque
+from threading import Lock, Thread
 import re
 
 # Collect the status from new relic.
@@ -19,7 +21,19 @@ import re
 #
 # requires a preferably encrypted API key for new relic.
 #
+# follows the pagination of the new relic api (link headers), if the number of pages is known the pages are requested in parallel
+#
+# if filtered by application name the ids of the matching applications are loaded once and then refreshed in the background
+# every refreshApplicationsEvery times, the collection always uses the ids loaded last
+#
+# with incrementalSync the open alert violations are kept in a local table, only the violations since the last sync are
+# requested and applied (opened or closed). Every fullSyncEvery times all the open violations are requested and replace
+# the table, this also removes violations closed that were opened before the time range of the incremental syncs.
+#
 default_update_applications_every = 50
+default_max_parallel_requests = 4
+default_full_sync_every = 10
+default_sync_overlap_sec = 60
 
 logger = logging.getLogger(__name__)
 
@@ -30,14 +44,20 @@ def create(configuration, key=None):
                                        policy_name_pattern=configuration.get("policyNamePattern", None),
                                        condition_name_pattern=configuration.get("conditionNamePattern", None),
                                        name = configuration.get("name", None),
-                                       verify_ssl=configuration.get("verifySsl", True))
+                                       verify_ssl=configuration.get("verifySsl", True),
+                                       not_found_ttl_sec=configuration.get("notFoundCacheTtlSec", default_not_found_ttl_sec),
+                                       max_parallel_requests=configuration.get("maxParallelRequest", default_max_parallel_requests),
+                                       incremental_sync=configuration.get("incrementalSync", False),
+                                       full_sync_every=configuration.get("fullSyncEvery", default_full_sync_every))
     elif configuration["type"] == "applications":
         return NewRelicApplicationsCollector(base_url = configuration["url"],
                                          api_key = configuration.get("apiKey", None) or decrypt(configuration.get("apiKeyEncyrpted", None), key),
                                          application_name_pattern= configuration.get("applicationNamePattern", None),
                                          refresh_applications_every=configuration.get("refreshApplicationsEvery", default_update_applications_every),  # times
                                          name = configuration.get("name", None),
-                                         verify_ssl=configuration.get("verifySsl", True))
+                                         verify_ssl=configuration.get("verifySsl", True),
+                                         not_found_ttl_sec=configuration.get("notFoundCacheTtlSec", default_not_found_ttl_sec),
+                                         max_parallel_requests=configuration.get("maxParallelRequest", default_max_parallel_requests))
     else:
         raise ValueError("Unknown type of new relic collector: %s" % configuration["type"])
 
@@ -53,9 +73,19 @@ class NewRelicAlertsCollector:
                  policy_name_pattern=None,
                  condition_name_pattern=None,
                  name=None,
-                 verify_ssl=True):
-        self.new_relic_client=BaseNewRelicClient(
-            http_client=create_http_client(base_url=base_url,fixed_headers={'X-Api-Key':api_key},verify_ssl=verify_ssl))
+                 verify_ssl=True,
+                 not_found_ttl_sec=None,
+                 max_parallel_requests=default_max_parallel_requests,
+                 incremental_sync=False,
+                 full_sync_every=default_full_sync_every):
+        http_client=create_http_client(base_url=base_url,fixed_headers={'X-Api-Key':api_key},verify_ssl=verify_ssl,not_found_ttl_sec=not_found_ttl_sec)
+        if incremental_sync:
+            self.new_relic_client = IncrementalViolationsNewRelicClient(
+                http_client=http_client,
+                full_sync_every=full_sync_every,
+                max_parallel_requests=max_parallel_requests)
+        else:
+            self.new_relic_client=BaseNewRelicClient(http_client=http_client, max_parallel_requests=max_parallel_requests)
         self.policy_name_pattern=re.compile(policy_name_pattern if policy_name_pattern  else r'.*')
         self.condition_name_pattern=re.compile(condition_name_pattern if condition_name_pattern else r'.*')
         self.name = name if name else urlparse(base_url).netloc
@@ -122,15 +152,18 @@ class NewRelicApplicationsCollector:
                  application_name_pattern=None,
                  refresh_applications_every=default_update_applications_every,
                  name=None,
-                 verify_ssl=True):
-        http_client=create_http_client(base_url=base_url,fixed_headers={'X-Api-Key':api_key},verify_ssl=verify_ssl)
+                 verify_ssl=True,
+                 not_found_ttl_sec=None,
+                 max_parallel_requests=default_max_parallel_requests):
+        http_client=create_http_client(base_url=base_url,fixed_headers={'X-Api-Key':api_key},verify_ssl=verify_ssl,not_found_ttl_sec=not_found_ttl_sec)
         if application_name_pattern and application_name_pattern != r'.*':
             self.new_relic_client = ApplicationNameFilterNewRelicClient(
                 http_client=http_client,
                 application_name_pattern=application_name_pattern,
-                refresh_applications_every=refresh_applications_every)
+                refresh_applications_every=refresh_applications_every,
+                max_parallel_requests=max_parallel_requests)
         else:
-            self.new_relic_client= BaseNewRelicClient(http_client=http_client)
+            self.new_relic_client= BaseNewRelicClient(http_client=http_client, max_parallel_requests=max_parallel_requests)
         self.name = name if name else urlparse(base_url).netloc
 
     def collect(self):
@@ -164,46 +197,150 @@ class NewRelicApplicationsCollector:
         return self.health_status_to_cimon_health[app_health]
 
 class BaseNewRelicClient():
-    def __init__(self, http_client):
+    def __init__(self, http_client, max_parallel_requests=default_max_parallel_requests):
         self.http_client = http_client
+        self.max_parallel_requests = max_parallel_requests
 
     def applications_health(self):
         return self.__extract_health_status__(self.__load_all_applications__())
 
     def open_alert_violations(self):
-        return self.__extract_violations__(json.loads(self.http_client.open_and_read("/v2/alerts_violations.json?only_open=true")))
+        return list(self.load_pages("/v2/alerts_violations.json?only_open=true", "violations"))
 
     def __load_all_applications__(self):
-        return json.loads(self.http_client.open_and_read("/v2/applications.json"))
+        return self.load_pages("/v2/applications.json", "applications")
+
+    def load_pages(self, request_path, records_name):
+        """ Yields the records of all pages, following the link headers. The records are streamed page by page.
+        If the last page is known the pages are requested in parallel, at most max_parallel_requests pages ahead of the consumer. """
+        records, links = self.__load_page__(request_path, records_name)
+        yield from records
+        last_page_number = page_number(links["last"]) if "last" in links else None
+        if last_page_number:
+            yield from self.__load_pages_parallel__(request_path, records_name, range(2, last_page_number + 1))
+        else:
+            while "next" in links:
+                records, links = self.__load_page__(link_path(links["next"]), records_name)
+                yield from records
+
+    def __load_pages_parallel__(self, request_path, records_name, page_numbers):
+        with futures.ThreadPoolExecutor(max_workers=self.max_parallel_requests) as executor:
+            pages = deque()
+            for number in page_numbers:
+                pages.append(executor.submit(self.__load_page__, with_page(request_path, number), records_name))
+                if len(pages) >= self.max_parallel_requests:
+                    yield from pages.popleft().result()[0]
+            while pages:
+                yield from pages.popleft().result()[0]
 
-    def __extract_health_status__(self, result):
-        return {application['name']:application['health_status'] for application in result['applications']}
+    def __load_page__(self, request_path, records_name):
+        contents, headers = self.http_client.open_and_read_with_headers(request_path)
+        return json.loads(contents).get(records_name, []), parse_links(headers.get("Link", None))
+
+    def __extract_health_status__(self, applications):
+        return {application['name']:application['health_status'] for application in applications}
 
-    def __extract_violations__(self, alert_violations):
-        return alert_violations["violations"] if "violations" in alert_violations else []
 
 class ApplicationNameFilterNewRelicClient(BaseNewRelicClient):
-    def __init__(self, http_client, application_name_pattern, refresh_applications_every):
-        super().__init__(http_client=http_client)
+    def __init__(self, http_client, application_name_pattern, refresh_applications_every, max_parallel_requests=default_max_parallel_requests):
+        super().__init__(http_client=http_client, max_parallel_requests=max_parallel_requests)
         self.application_name_pattern = re.compile(application_name_pattern)
         self.refresh_applications_every = refresh_applications_every
-        self.request_count=refresh_applications_every
-        self.application_ids={}
+        self.request_count=0
+        self.application_ids=None
+        self.__refreshing = False
+        self.__refresh_lock = Lock()
 
     def applications_health(self):
-        if self.request_count >= (self.refresh_applications_every):
+        if self.application_ids is None: # nothing to collect without the ids, so the first time wait for them
             self.application_ids = self.__load_application_ids__()
             self.request_count=0
+        elif self.request_count >= (self.refresh_applications_every):
+            self.__refresh_application_ids_in_background__()
+            self.request_count=0
         result = self.__extract_health_status__(self.__load_applications_by_id__())
         self.request_count+=1
         return result
 
+    def __refresh_application_ids_in_background__(self):
+        with self.__refresh_lock:
+            if self.__refreshing:
+                return
+            self.__refreshing = True
+        Thread(target=self.__refresh_application_ids__, daemon=True).start()
+
+    def __refresh_application_ids__(self):
+        try:
+            # replaced as a whole, a collection running meanwhile keeps using the ids it started with
+            self.application_ids = self.__load_application_ids__()
+            logger.debug("Refreshed %d application ids", len(self.application_ids))
+        except Exception:
+            logger.exception("Error refreshing the application ids, keeping the current ones")
+        finally:
+            with self.__refresh_lock:
+                self.__refreshing = False
+
     def __load_application_ids__(self):
-        result=self.__load_all_applications__()
-        return [str(application['id']) for application in result['applications'] if self.application_name_pattern.match(application['name'])]
+        return [str(application['id']) for application in self.__load_all_applications__() if self.application_name_pattern.match(application['name'])]
 
     def __load_applications_by_id__(self):
-        return json.loads(self.http_client.open_and_read("/v2/applications.json?filter[ids]=%s" % ','.join(self.application_ids)))
+        return self.load_pages("/v2/applications.json?filter[ids]=%s" % ','.join(self.application_ids), "applications")
+
+class IncrementalViolationsNewRelicClient(BaseNewRelicClient):
+    def __init__(self, http_client, full_sync_every=default_full_sync_every, sync_overlap_sec=default_sync_overlap_sec,
+                 max_parallel_requests=default_max_parallel_requests, clock=None):
+        super().__init__(http_client=http_client, max_parallel_requests=max_parallel_requests)
+        self.full_sync_every = full_sync_every
+        self.sync_overlap = timedelta(seconds=sync_overlap_sec) # tolerate the clocks of new relic and cimon not being in sync
+        self.clock = clock if clock else lambda: datetime.now(timezone.utc)
+        self.violations = {} # id: violation
+        self.last_sync = None
+        self.sync_count = 0
+
+    def open_alert_violations(self):
+        now = self.clock()
+        if self.last_sync is None or self.sync_count >= self.full_sync_every:
+            self.violations = {violation["id"] : violation for violation in super().open_alert_violations()}
+            self.sync_count = 0
+            logger.debug("Full sync of alert violations, %d open", len(self.violations))
+        else:
+            self.__apply_changes__(self.__load_violations_since__(self.last_sync - self.sync_overlap))
+        # only after success, if a sync fails the next one requests the same time range again
+        self.last_sync = now
+        self.sync_count += 1
+        return list(self.violations.values())
+
+    def __load_violations_since__(self, start_date):
+        return self.load_pages("/v2/alerts_violations.json?start_date=%s" % quote(start_date.isoformat()), "violations")
+
+    def __apply_changes__(self, violations):
+        opened = closed = 0
+        for violation in violations:
+            if violation.get("closed_at", None):
+                if self.violations.pop(violation["id"], None):
+                    closed += 1
+            else:
+                if violation["id"] not in self.violations:
+                    opened += 1
+                self.violations[violation["id"]] = violation
+        logger.debug("Incremental sync of alert violations, %d opened, %d closed, %d open", opened, closed, len(self.violations))
+
+def parse_links(link_header):
+    """ parse a http link header '<url>; rel="next", <url>; rel="last"' to {"next" : url, "last" : url} """
+    if not link_header:
+        return {}
+    return {match.group(2) : match.group(1) for match in re.finditer(r'<([^>]*)>\s*;\s*rel="?([^",;]+)"?', link_header)}
+
+def page_number(url):
+    page = parse_qs(urlparse(url).query).get("page", None)
+    return int(page[0]) if page and page[0].isdigit() else None
+
+def link_path(url):
+    parsed = urlparse(url)
+    return "%s?%s" % (parsed.path, parsed.query) if parsed.query else parsed.path
+
+def with_page(request_path, number):
+    return "%s%spage=%d" % (request_path, "&" if "?" in request_path else "?", number)
 
 
 if  __name__ =='__main__':
@@ -3,11 +3,22 @@
 __author__ = 'florianseidl'
 
 from time import sleep
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from threading import Thread, Condition, Lock
 import logging
+import math
 import re
+import subprocess
+import time
 from cimon import RequestStatus,Health
 
 default_signal_error_threshold=3
+default_max_matched_keys=10000
+default_command_timeout_sec=10
+default_tick_sec=0.01
+default_wheel_size=512
+default_flash_on_ratio=0.8
 
 logger = logging.getLogger(__name__)
 
@@ -51,21 +62,74 @@ def is_building(status):
             return True
     return False
 
+class HealthSummary():
+    """ Aggregate of the status in one pass: the number of jobs per request status and per health (of the jobs with request
+    status OK) and whether jobs are active. """
+
+    def __init__(self, status=None):
+        self.request_status_counts = Counter()
+        self.health_counts = Counter()
+        self.max_health = None # of all jobs regardless of the request status
+        self.building = False # a job with request status OK is active
+        self.active = False # any job is active
+        for job_status in status.values() if status else ():
+            self.add(job_status)
+
+    def add(self, job_status):
+        self.request_status_counts[job_status.request_status] += 1
+        if job_status.request_status == RequestStatus.OK:
+            self.health_counts[job_status.health] += 1
+            self.building = self.building or job_status.active
+        if self.max_health is None or job_status.health.value > self.max_health.value:
+            self.max_health = job_status.health
+        self.active = self.active or job_status.active
+
+    def has_request_status(self, request_status):
+        return self.request_status_counts[request_status] > 0
+
+    def has_health(self, health):
+        return self.health_counts[health] > 0
+
+    def is_building(self):
+        return self.building
+
+    def max_request_status(self):
+        return max(self.request_status_counts, key=lambda request_status: request_status.value) if self.request_status_counts else None
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+def summarize(status, name_filter=None):
+    """ The health summary of the jobs in the status matching the filter (all if None).
+    If the status is a snapshot shared by the outputs (see cimon.StatusSnapshot) the summary is computed once per distinct filter. """
+    return cached_summary(status,
+                          ("health", name_filter.key() if name_filter else None),
+                          lambda: __summarize__(status, name_filter))
+
+def cached_summary(status, key, compute):
+    """ cache a summary on the status if it is a snapshot shared by the outputs, the key has to identify the computation """
+    summaries = getattr(status, "summaries", None)
+    return summaries.get_or_compute(key, compute) if summaries is not None else compute()
+
+def __summarize__(status, name_filter):
+    summary = HealthSummary()
+    for key, job_status in status.items():
+        if not name_filter or name_filter.matches_key(key):
+            summary.add(job_status)
+    return summary
+
 class NameFilter():
 
     def __init__(self, job_name_pattern=None, collector_pattern=None):
         self.job_name_pattern = re.compile(job_name_pattern) if job_name_pattern else None
         self.collector_pattern = re.compile(collector_pattern) if collector_pattern else None
+        self.__matched_keys = {} # key: matches, the patterns are evaluated once per key
 
     def filter_status(self, status):
-        logger.debug("unfiltered status: %s" % status)
-        filtered = status
-        if self.collector_pattern:
-           filtered = self.filter_by_pattern(filtered, self.collector_pattern, 0)
-           logger.debug("filtered by collector pattern %s: %s" % (self.collector_pattern, filtered))
-        if self.job_name_pattern:
-            filtered = self.filter_by_pattern(filtered, self.job_name_pattern, 1)
-            logger.debug("filtered by job name pattern %s: %s" % (self.job_name_pattern, filtered))
+        if not self.collector_pattern and not self.job_name_pattern:
+            return status
+        filtered = {k: v for k, v in status.items() if self.matches_key(k)}
+        logger.debug("filtered by collector pattern %s and job name pattern %s: %s" % (self.collector_pattern, self.job_name_pattern, filtered))
         return filtered
 
     def filter_by_pattern(self, status, pattern, index):
@@ -75,6 +139,20 @@ class NameFilter():
         return self.__match__(self.collector_pattern, url) and \
                self.__match__(self.job_name_pattern, jobName)
 
+    def matches_key(self, key):
+        matches = self.__matched_keys.get(key, None)
+        if matches is None:
+            if len(self.__matched_keys) >= default_max_matched_keys:
+                self.__matched_keys = {} # jobs come and go, start over instead of growing forever
+            matches = bool(self.matches(key[0], key[1]))
+            self.__matched_keys[key] = matches
+        return matches
+
+    def key(self):
+        """ filters with the same key filter the same jobs """
+        return (self.collector_pattern.pattern if self.collector_pattern else None,
+                self.job_name_pattern.pattern if self.job_name_pattern else None)
+
     def __match__(self, pattern, string):
         return not pattern or pattern.match(string)
 
@@ -87,16 +165,20 @@ class AbstractBuildOutput():
         self.error_count=0
         self.last_status=None
 
+    def route(self, key):
+        return self.build_filter.matches_key(key)
+
     def on_update(self, status):
-        self.on_update_filtered(self.build_filter.filter_status(status))
+        self.on_update_filtered(self.build_filter.filter_status(status), summarize(status, self.build_filter))
 
-    def on_update_filtered(self, status):
-        if has_request_status(status, RequestStatus.ERROR):
+    def on_update_filtered(self, status, summary=None):
+        summary = summary if summary else HealthSummary(status)
+        if summary.has_request_status(RequestStatus.ERROR):
             self.on_error(status)
             self.error_count+=1
         else:
             self.error_count=0
-            self.on_status(status)
+            self.on_status(status, summary)
 
     def on_error(self, status):
         # if there is at least one build in error
@@ -109,22 +191,23 @@ class AbstractBuildOutput():
             logger.debug("Signaling an error")
             self.signal_error()
 
-    def on_status(self, status):
-        building = is_building((status))
+    def on_status(self, status, summary=None):
+        summary = summary if summary else HealthSummary(status)
+        building = summary.is_building()
         # if there is at least one build failed, signal red
-        if has_health(status, Health.SICK):
+        if summary.has_health(Health.SICK):
             self.__signal_health_and_store__(Health.SICK, building)
             # if there is at least one build unstable in undefied state or not found, signal yellow
-        elif has_health(status, Health.UNWELL):
+        elif summary.has_health(Health.UNWELL):
             self.__signal_health_and_store__(Health.UNWELL, building)
         # if at least one in undefied state or not found, signal yellow
-        elif has_health(status, Health.OTHER):
+        elif summary.has_health(Health.OTHER):
             self.__signal_health_and_store__(Health.OTHER, building)
         # elseif at least one build has success, all is OK, signal green
         # this include request_status == "ok" and result == "successs"
         # as well as   request_status == "not_found"
         # but only if at least one build had request_status == "ok" and result == "success"
-        elif has_health(status, Health.HEALTHY):
+        elif summary.has_health(Health.HEALTHY):
             self.__signal_health_and_store__(Health.HEALTHY, building)
         # if all builds are request_status MOT_FOUND or result EMPTY, signal nothing
         elif self.last_status:
@@ -168,21 +251,288 @@ class AbstractBuildOutput():
         self.close()
         logger.info("Self check complete")
 
+# Device commands: outputs switching devices by command line tools (sispmctl, clewarecontrol) run the commands by a
+# DeviceCommandExecutor per device. It runs the commands of the device one after the other in a thread of its own, without
+# shell and with a timeout, so a hanging device does not block the output. Only the latest state of a device is relevant:
+# commands not started yet are replaced by newer ones for the same key (for instance the sockets switched by an output).
+def device_executor(device, timeout_sec=default_command_timeout_sec):
+    """ the executor of the device, shared by all outputs of the same device """
+    with __executors_lock:
+        if device not in __executors:
+            __executors[device] = DeviceCommandExecutor(device, timeout_sec=timeout_sec)
+        return __executors[device]
+
+__executors = {}
+__executors_lock = Lock()
+
+def run_command(command, timeout_sec=default_command_timeout_sec):
+    """ run the command (a list of arguments) without shell, returns True if successful """
+    logger.debug("Running %s", command)
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        logger.warning("Cannot run %s: %s", command[0], e)
+        return False
+    try:
+        stderr = process.communicate(timeout=timeout_sec)[1]
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        logger.warning("%s timed out after %s seconds", command[0], timeout_sec)
+        return False
+    if process.returncode != 0:
+        logger.warning("%s returned %s: %s", command[0], process.returncode, stderr.decode("utf-8", "replace").strip())
+        return False
+    return True
+
+class DeviceCommandExecutor():
+    """ Runs the commands of one device serially. A call of submit replaces the commands with the same key not started yet.
+    Records the latency of the commands of the device. """
+
+    def __init__(self, device, timeout_sec=default_command_timeout_sec, run=run_command):
+        self.device = device
+        self.timeout_sec = timeout_sec
+        self.run = run
+        self.condition = Condition()
+        self.pending = OrderedDict() # key: (commands, future), run in the order submitted
+        self.running = False
+        self.__stopped = True
+        self.__latency = {"commands": 0, "failed": 0, "superseded": 0, "total_sec": 0.0, "max_sec": 0.0, "last_sec": None}
+
+    def submit(self, *commands, key=None):
+        """ the commands are run one after the other until one fails. Returns a future of the result:
+        True if all succeeded, False if one failed or if the commands were replaced by newer ones with the same key before running """
+        future = Future()
+        with self.condition:
+            if key in self.pending:
+                logger.debug("Commands to %s superseded", self.device)
+                self.pending[key][1].set_result(False)
+                self.__latency["superseded"] += 1
+            self.pending[key] = (commands, future)
+            if self.__stopped:
+                self.__stopped = False
+                Thread(target=self.__run_loop__, daemon=True).start()
+            self.condition.notify_all()
+        return future
+
+    def call(self, *commands, key=None):
+        """ submit and wait for the result """
+        return self.submit(*commands, key=key).result()
+
+    def wait(self, timeout=None):
+        """ wait until all commands submitted are run """
+        end = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while (self.pending or self.running) and (end is None or time.monotonic() < end):
+                self.condition.wait(timeout=max(end - time.monotonic(), 0.01) if end is not None else None)
+
+    def stop(self):
+        with self.condition:
+            self.__stopped = True
+            for commands, future in self.pending.values():
+                future.set_result(False)
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.__latency)
+        stats["average_sec"] = stats["total_sec"] / stats["commands"] if stats["commands"] else None
+        return stats
+
+    def __run_loop__(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.__stopped:
+                    self.condition.wait()
+                if self.__stopped:
+                    return
+                commands, future = self.pending.popitem(last=False)[1]
+                self.running = True
+            try:
+                future.set_result(all(self.__run_timed__(command) for command in commands))
+            except Exception as e:
+                logger.exception("Error running commands to %s", self.device)
+                future.set_result(False)
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+
+    def __run_timed__(self, command):
+        start = time.monotonic()
+        success = self.run(command, self.timeout_sec)
+        latency = time.monotonic() - start
+        with self.condition:
+            self.__latency["commands"] += 1
+            self.__latency["failed"] += 0 if success else 1
+            self.__latency["total_sec"] += latency
+            self.__latency["max_sec"] = max(self.__latency["max_sec"], latency)
+            self.__latency["last_sec"] = latency
+        logger.debug("%s took %.3f seconds", command[0], latency)
+        return success
+
+# Flashing and periodic output: one FlashScheduler thread calls the outputs at the time given (flash on, flash off, absolute
+# output,...) for any number of devices. The timers are kept in a timer wheel of default_wheel_size slots of
+# default_tick_sec seconds on the monotonic clock. The callbacks run in the thread of the scheduler, they must not block.
+# Flash phases are computed from the time of the first flash, so all devices flashing with the same interval are in sync.
+def flash_scheduler():
+    """ the scheduler shared by all outputs """
+    global __scheduler
+    with __scheduler_lock:
+        if not __scheduler:
+            __scheduler = FlashScheduler()
+        return __scheduler
+
+__scheduler = None
+__scheduler_lock = Lock()
+
+class FlashScheduler():
+    """ Calls each callback at its deadline, one timer per key: scheduling a key again replaces its timer """
+
+    def __init__(self, tick_sec=default_tick_sec, wheel_size=default_wheel_size, clock=time.monotonic):
+        self.tick_sec = tick_sec
+        self.clock = clock
+        self.slots = [{} for i in range(wheel_size)] # key: (tick, callback)
+        self.timers = {} # key: tick
+        self.condition = Condition()
+        self.current_tick = self.__tick__(clock())
+        self.flash_origin = None
+        self.__stopped = True
+
+    def schedule(self, key, delay_sec, callback):
+        self.schedule_at(key, self.clock() + delay_sec, callback)
+
+    def schedule_at(self, key, deadline, callback):
+        with self.condition:
+            self.__remove__(key)
+            tick = max(int(math.ceil(deadline / self.tick_sec)), self.current_tick) # never before the deadline
+            self.slots[tick % len(self.slots)][key] = (tick, callback)
+            self.timers[key] = tick
+            if self.__stopped:
+                self.__stopped = False
+                Thread(target=self.__run_loop__, daemon=True).start()
+            self.condition.notify_all()
+
+    def cancel(self, key):
+        with self.condition:
+            self.__remove__(key)
+
+    def stop(self):
+        with self.condition:
+            self.__stopped = True
+            self.condition.notify_all()
+
+    def flash_phase(self, interval_sec, on_ratio=default_flash_on_ratio):
+        """ returns if the flash is on and the time it changes: on for on_ratio of the interval, then off """
+        now = self.clock()
+        with self.condition:
+            if self.flash_origin is None:
+                self.flash_origin = now
+            elapsed = (now - self.flash_origin) % interval_sec
+        start = now - elapsed
+        on = elapsed < interval_sec * on_ratio
+        return on, start + (interval_sec * on_ratio if on else interval_sec)
+
+    def __tick__(self, time_sec):
+        return int(math.floor(time_sec / self.tick_sec))
+
+    def __remove__(self, key):
+        if key in self.timers:
+            del self.slots[self.timers.pop(key) % len(self.slots)][key]
+
+    def __due__(self, now_tick):
+        """ remove and return the callbacks due, only the slots passed since the last call are visited """
+        due = []
+        if now_tick - self.current_tick >= len(self.slots):
+            slots = self.slots
+        else:
+            slots = [self.slots[tick % len(self.slots)] for tick in range(self.current_tick, now_tick + 1)]
+        for slot in slots:
+            for key, (tick, callback) in list(slot.items()):
+                if tick <= now_tick: # else due in a later round of the wheel
+                    del slot[key]
+                    del self.timers[key]
+                    due.append(callback)
+        self.current_tick = now_tick + 1
+        return due
+
+    def __run_loop__(self):
+        logger.debug("Flash scheduler started")
+        while True:
+            with self.condition:
+                due = []
+                while not self.__stopped and not due:
+                    due = self.__due__(self.__tick__(self.clock()))
+                    if not due:
+                        # skip the empty slots, wait for the next timer or a new one
+                        timeout = min(self.timers.values()) * self.tick_sec - self.clock() if self.timers else None
+                        self.condition.wait(timeout=max(timeout, 0) if timeout is not None else None)
+                if self.__stopped:
+                    logger.debug("Flash scheduler stopped")
+                    return
+            for callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Error in scheduled output")
+
 class AbstractBuildAmpel(AbstractBuildOutput):
-    """base class for ampel kind output. ampel has to implement the signal method """
+    """base class for ampel kind output. ampel has to implement the signal method
+    The last signal is kept, an unchanged signal is only repeated every refresh_every times (1: every time, 0: never) or
+    if refresh_every_sec passed since it was signaled (0: never), using refresh_signal. """
+
+    def __init__(self, signal_error_threshold=default_signal_error_threshold, build_filter_pattern=None, collector_filter_pattern=None,
+                 refresh_every=1, refresh_every_sec=0):
+        super().__init__(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern, collector_filter_pattern=collector_filter_pattern)
+        self.refresh_every = refresh_every
+        self.refresh_every_sec = refresh_every_sec
+        self.last_signal = None
+        self.last_signal_at = None
+        self.unchanged_count = 0
 
     def signal_health(self, result, building=False):
         if(result == Health.HEALTHY):
-            self.signal(red=False, yellow=False, green=True, flash=building)
+            self.__signal_if_changed__(red=False, yellow=False, green=True, flash=building)
         elif(result == Health.UNWELL):
-            self.signal(red=False, yellow=True, green=False, flash=building)
+            self.__signal_if_changed__(red=False, yellow=True, green=False, flash=building)
         elif(result == Health.SICK):
-            self.signal(red=True, yellow=False, green=False, flash=building)
+            self.__signal_if_changed__(red=True, yellow=False, green=False, flash=building)
         else: # Health.OTHER or Health.EMPTY
-            self.signal(red=False, yellow=True, green=False, flash=building)
+            self.__signal_if_changed__(red=False, yellow=True, green=False, flash=building)
+
+    def invalidate_last_signal(self):
+        """ the next signal is output even if unchanged, for instance if the output failed """
+        self.last_signal = None
 
     def signal_error(self):
-        self.signal(red=True, yellow=True, green=True, flash=False)
+        self.__signal_if_changed__(red=True, yellow=True, green=True, flash=False)
 
     def signal_off(self):
-        self.signal(red=False, yellow=False, green=False, flash=False)
+        self.__signal_if_changed__(red=False, yellow=False, green=False, flash=False)
+
+    def refresh_signal(self, red, yellow, green, flash=False):
+        """ repeat the unchanged signal, same as signal if not overridden """
+        self.signal(red=red, yellow=yellow, green=green, flash=flash)
+
+    def __signal_if_changed__(self, red, yellow, green, flash):
+        signal = (red, yellow, green, flash)
+        self.unchanged_count += 1
+        if signal != self.last_signal:
+            self.__signal__(self.signal, red, yellow, green, flash)
+        elif (self.refresh_every > 0 and self.unchanged_count >= self.refresh_every) \
+                or (self.refresh_every_sec > 0 and time.monotonic() - self.last_signal_at >= self.refresh_every_sec):
+            self.__signal__(self.refresh_signal, red, yellow, green, flash)
+        else:
+            logger.debug("Signal unchanged, not repeated")
+
+    def __signal__(self, output, red, yellow, green, flash):
+        # remembered before the output, so the output can invalidate it if it fails
+        self.last_signal = (red, yellow, green, flash)
+        self.last_signal_at = time.monotonic()
+        self.unchanged_count = 0
+        try:
+            output(red=red, yellow=yellow, green=green, flash=flash)
+        except Exception:
+            self.invalidate_last_signal()
+            raise
@@ -15,34 +15,55 @@ class ReScheduler:
         self.__lock= Lock()
         self.__timer = None
         self.__stopped = True
+        self.__running = False
+        self.__triggered = False
         self.__method = method
         self.__interval_sec = interval_sec
 
     def run(self):
-        interval_override_sec = self.__method()
-        self.__lock.acquire()
-        if not self.__stopped:
-            self.__timer = Timer(interval_override_sec if interval_override_sec else self.__interval_sec, self.run, ())
-            self.__timer.start()
-        self.__lock.release()
+        with self.__lock:
+            if self.__running: # triggered while running, run again after the current run
+                self.__triggered = True
+                return
+            self.__running = True
+        interval_override_sec = None
+        try:
+            interval_override_sec = self.__method()
+        finally:
+            with self.__lock:
+                self.__running = False
+                if not self.__stopped:
+                    interval_sec = 0 if self.__triggered else interval_override_sec if interval_override_sec else self.__interval_sec
+                    self.__triggered = False
+                    self.__timer = Timer(interval_sec, self.run, ())
+                    self.__timer.start()
+
+    def trigger(self):
+        """ run now instead of waiting for the interval, if currently running run again right afterwards """
+        with self.__lock:
+            if not self.__stopped:
+                if self.__running:
+                    self.__triggered = True
+                else:
+                    if self.__timer:
+                        self.__timer.cancel()
+                    self.__timer = Timer(0, self.run, ())
+                    self.__timer.start()
 
     def start(self):
-        self.__lock.acquire()
-        if self.__stopped:
+        with self.__lock:
+            if not self.__stopped:
+                return self
             self.__stopped = False
-            self.__lock.release()
-            self.run()
-        else:
-            self.__lock.release()
+        self.run()
         return self
 
     def stop(self):
-        self.__lock.acquire()
-        self.__stopped = True
-        if self.__timer:
-            self.__timer.cancel()
-            self.__timer = None
-        self.__lock.release()
+        with self.__lock:
+            self.__stopped = True
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
 
 def foo():
     print("bar");
@@ -0,0 +1,221 @@
+# Copyright (C) Schweizerische Bundesbahnen SBB, 2016
+# Python 3.4
+__author__ = 'florianseidl'
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from datetime import datetime
+from time import sleep
+from urllib.parse import urlparse
+import json
+import logging
+import sys
+from cimon import JobStatus, RequestStatus, Health
+
+# Collect build status pushed by the CI server instead of polling it.
+#
+# Runs a small HTTP server accepting build notifications via POST:
+# - the format of the jenkins notification plugin (https://plugins.jenkins.io/notification)
+#   { "name" : "<job_name>", "build" : { "phase" : "STARTED" | "COMPLETED" | "FINALIZED", "status" : "SUCCESS" | ..., "number" : 42, "full_url" : "..."} }
+# - a generic format
+#   { "job" : "<job_name>", "result" : "SUCCESS" | "UNSTABLE" | "FAILURE" | ..., "building" : true | false, "number" : 42, "timestamp" : <millis>, "url" : "...", "collector" : "<name>" }
+#
+# collect() returns the latest status of each job notified so far without any request, in the usual format
+# { (<collector_name>, <job_name>) : JobStatus }
+#
+default_host = "localhost"
+default_port = 8081
+default_name = "webhook"
+
+logger = logging.getLogger(__name__)
+
+def create(configuration, key=None):
+    return WebhookCollector(host=configuration.get("host", default_host),
+                            port=configuration.get("port", default_port),
+                            name=configuration.get("name", None),
+                            trigger_on_event=configuration.get("triggerOnEvent", True))
+
+class WebhookCollector():
+    def __init__(self, host=default_host, port=default_port, name=None, trigger_on_event=True):
+        self.host = host
+        self.port = port
+        self.trigger_on_event = trigger_on_event
+        self.store = StatusStore()
+        self.ingest = WebhookIngest(store=self.store, name=name, on_change=self.__on_change__)
+        self.server = None
+        self.__server_lock = Lock()
+        self.__trigger = None
+        # notifications are accepted as soon as the collector is created, not only after the first collect
+        self.start_http_server_if_not_started()
+
+    def set_trigger(self, trigger):
+        self.__trigger = trigger
+
+    def collect(self):
+        self.start_http_server_if_not_started() # again after close
+        return self.store.snapshot()
+
+    def start_http_server_if_not_started(self):
+        with self.__server_lock:
+            if not self.server:
+                self.server = WebhookHttpServer((self.host, self.port), WebhookRequestHandler)
+                self.server.ingest = self.ingest
+                logger.info("Starting webhook http server at %s:%d", *self.server.server_address[:2])
+                Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        with self.__server_lock:
+            if self.server:
+                self.server.shutdown()
+                self.server.server_close()
+                logger.info("Stopped webhook http server")
+            self.server = None
+
+    def __on_change__(self):
+        if self.trigger_on_event and self.__trigger:
+            self.__trigger()
+
+class StatusStore():
+    """ Thread safe store of the latest status per job. A published snapshot is never modified (copy on write),
+    so reading it is O(1) and does not need a lock """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__snapshot = {}
+
+    def snapshot(self):
+        return self.__snapshot
+
+    def get(self, key):
+        return self.__snapshot.get(key, None)
+
+    def update(self, key, job_status):
+        with self.__lock:
+            if key in self.__snapshot and self.__snapshot[key] == job_status:
+                return False
+            snapshot = dict(self.__snapshot)
+            snapshot[key] = job_status
+            self.__snapshot = snapshot
+            return True
+
+class WebhookIngest():
+    """ A delegate to the delegate (HTTPRequestHander) as is easy to test """
+    jenkins_result_to_health = {"SUCCESS" : Health.HEALTHY,
+                                "UNSTABLE" : Health.UNWELL,
+                                "FAILURE" : Health.SICK,
+                                "ABORTED" : Health.UNDEFINED,
+                                "NOT_BUILT" : Health.UNDEFINED}
+
+    def __init__(self, store, name=None, on_change=None):
+        self.store = store
+        self.name = name
+        self.on_change = on_change
+
+    def handle_post(self, body):
+        try:
+            notification = json.loads(body.decode("utf-8") if isinstance(body, bytes) else body)
+            if not isinstance(notification, dict):
+                return (400, "Notification is not a json object")
+            if "name" in notification and "build" in notification:
+                key, job_status = self.__from_jenkins_notification__(notification)
+            elif "job" in notification:
+                key, job_status = self.__from_generic_notification__(notification)
+            else:
+                return (400, "Unknown notification format")
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.info("Invalid notification: %s", e)
+            return (400, "Invalid notification: %s" % e)
+        if job_status and self.store.update(key, job_status):
+            logger.debug("Notification changed status of %s to %s", key, job_status)
+            if self.on_change:
+                self.on_change()
+        return (200, "OK")
+
+    def __from_jenkins_notification__(self, notification):
+        build = notification["build"]
+        collector_name = self.name or urlparse(build.get("full_url", "")).netloc or default_name
+        key = (collector_name, self.__job_name__(notification["name"]))
+        phase = build.get("phase", None)
+        previous = self.store.get(key)
+        if phase == "STARTED":
+            health = previous.health if previous else Health.OTHER
+            active = True
+        elif phase in ("COMPLETED", "FINALIZED"):
+            health = self.__to_health__(build.get("status", None))
+            active = False
+        else: # for instance QUEUED, does not change the status
+            return key, None
+        return key, JobStatus(request_status=RequestStatus.OK,
+                              health=health,
+                              active=active,
+                              timestamp=self.__to_timestamp__(build.get("timestamp", None)),
+                              number=build.get("number", None),
+                              url=build.get("full_url", None))
+
+    def __from_generic_notification__(self, notification):
+        key = (self.name or notification.get("collector", None) or default_name, self.__job_name__(notification["job"]))
+        if "health" in notification:
+            if notification["health"] not in Health.__members__:
+                raise ValueError("Unknown health %s" % notification["health"])
+            health = Health[notification["health"]]
+        else:
+            health = self.__to_health__(notification.get("result", None))
+        return key, JobStatus(request_status=RequestStatus.OK,
+                              health=health,
+                              active=bool(notification.get("building", False)),
+                              timestamp=self.__to_timestamp__(notification.get("timestamp", None)),
+                              number=notification.get("number", None),
+                              url=notification.get("url", None))
+
+    def __job_name__(self, job_name):
+        if not job_name or not isinstance(job_name, str):
+            raise ValueError("Invalid job name %s" % job_name)
+        return job_name
+
+    def __to_health__(self, result):
+        return self.jenkins_result_to_health.get(result.upper(), Health.OTHER) if result else Health.OTHER
+
+    def __to_timestamp__(self, millis):
+        try:
+            return datetime.fromtimestamp(millis / 1000.0) if millis else None
+        except (OverflowError, OSError) as e: # out of the range of the platform
+            raise ValueError("Invalid timestamp %s: %s" % (millis, e))
+
+class WebhookHttpServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """ A shallow adapter to the Python http request handler as it is hard to test"""
+
+    def do_POST(self):
+        try:
+            length = self.__content_length__()
+            result = self.server.ingest.handle_post(self.rfile.read(length)) if length is not None \
+                else (400, "Missing or invalid Content-Length")
+            if result[0] < 300:
+                self.send_response(result[0])
+                self.send_header("Content-Type", "text/plain;charset=utf-8")
+                self.end_headers()
+                self.wfile.write(result[1].encode("utf-8"))
+            else:
+                self.send_error(code=result[0], message=result[1])
+        finally:
+            self.wfile.flush()
+
+    def __content_length__(self):
+        try:
+            length = int(self.headers["Content-Length"])
+            return length if length >= 0 else None
+        except (TypeError, ValueError):
+            return None
+
+if  __name__ =='__main__':
+    """smoke test"""
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+    collector = WebhookCollector()
+    collector.collect()
+    logging.info("test: serving for 30 seconds, post notifications to http://%s:%d", collector.host, collector.port)
+    sleep(30)
+    print(collector.collect())
+    collector.close()
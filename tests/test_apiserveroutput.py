@@ -1,7 +1,11 @@
 __author__ = 'florianseidl'
 
 import collections
+from concurrent.futures import ThreadPoolExecutor
+import http.client
 import os
+import socket
+import time
 from types import SimpleNamespace
 from unittest import TestCase
 
@@ -114,3 +118,84 @@ class TestApiServerOutput(TestCase):
         out.on_update({("ci.sbb.ch","all") : JobStatus(RequestStatus.ERROR)})
         result = api.handle_get("/job/%s/lastBuild/api/json?depth=0"% self.job_name_success )
         self.assertEqual(result[0], 500)
+
+class TestApiHttpServer(TestCase):
+    job_name = "job.a"
+
+    def setUp(self):
+        set_shared_status({self.job_name : JobStatus(RequestStatus.OK, Health.HEALTHY, number=42)})
+
+    def start_server(self, server):
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def start_api_server(self, max_workers=4, keep_alive_timeout_sec=5):
+        return self.start_server(ApiHttpServer(("localhost", 0), ApiServerRequestHandler, max_workers=max_workers, keep_alive_timeout_sec=keep_alive_timeout_sec))
+
+    def get_job(self, connection):
+        connection.request("GET", "/job/%s/lastBuild/api/json" % self.job_name)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode("utf-8"))
+
+    def test_keep_alive(self):
+        connection = http.client.HTTPConnection("localhost", self.start_api_server())
+        self.addCleanup(connection.close)
+        for i in range(0, 3):
+            self.assertEqual((200, {"result" : "SUCCESS", "building" : False, "number" : 42}), self.get_job(connection))
+        connection.request("GET", "/job/gibtsgarnicht/lastBuild/api/json")
+        response = connection.getresponse()
+        response.read()
+        self.assertEqual(404, response.status)
+        self.assertEqual((200, {"result" : "SUCCESS", "building" : False, "number" : 42}), self.get_job(connection))
+
+    def test_idle_connection_does_not_block_worker(self):
+        port = self.start_api_server(max_workers=1, keep_alive_timeout_sec=0.2)
+        idle = socket.create_connection(("localhost", port))
+        self.addCleanup(idle.close)
+        connection = http.client.HTTPConnection("localhost", port, timeout=5)
+        self.addCleanup(connection.close)
+        self.assertEqual(200, self.get_job(connection)[0])
+
+    def test_connection_without_request_closed_before_keep_alive_timeout(self):
+        port = self.start_api_server(max_workers=1, keep_alive_timeout_sec=30)
+        idle = socket.create_connection(("localhost", port), timeout=10)
+        self.addCleanup(idle.close)
+        started = time.monotonic()
+        self.assertEqual(b"", idle.recv(1)) # closed by the server
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_idle_kept_alive_connection_closed_for_waiting(self):
+        port = self.start_api_server(max_workers=1, keep_alive_timeout_sec=5)
+        kept_alive = http.client.HTTPConnection("localhost", port, timeout=5)
+        self.addCleanup(kept_alive.close)
+        self.assertEqual(200, self.get_job(kept_alive)[0])
+        started = time.monotonic()
+        waiting = http.client.HTTPConnection("localhost", port, timeout=5)
+        self.addCleanup(waiting.close)
+        self.assertEqual(200, self.get_job(waiting)[0])
+        self.assertLess(time.monotonic() - started, 2) # not the keep alive timeout
+
+    def test_load_benchmark(self):
+        # benchmark: compares to the single threaded HTTP/1.0 server as used before, only logs the requests/s
+        class SingleRequestHandler(ApiServerRequestHandler):
+            protocol_version = "HTTP/1.0"
+        single = self.load(self.start_server(HTTPServer(("localhost", 0), SingleRequestHandler)))
+        pooled = self.load(self.start_api_server())
+        logging.getLogger(__name__).info("Single threaded HTTP/1.0: %.0f requests/s, pooled keep alive: %.0f requests/s", single, pooled)
+
+    def load(self, port, clients=4, requests=100):
+        def run_client():
+            connection = http.client.HTTPConnection("localhost", port, timeout=5)
+            try:
+                return [self.get_job(connection)[0] for i in range(0, requests)]
+            finally:
+                connection.close()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            results = [executor.submit(run_client) for i in range(0, clients)]
+            statuses = [status for result in results for status in result.result()]
+        requests_per_sec = clients * requests / (time.perf_counter() - started)
+        self.assertEqual([200] * clients * requests, statuses)
+        return requests_per_sec
@@ -7,6 +7,7 @@ from unittest import TestCase
 from unittest.mock import MagicMock, Mock
 from types import SimpleNamespace
 from datetime import datetime
+from time import sleep
 import yaml
 
 class CimonTest(TestCase):
@@ -60,6 +61,60 @@ class CimonTest(TestCase):
         c.outputs[0].close.assert_called_once_with()
         c.outputs[2].close.assert_called_once_with()
 
+    def test_set_trigger_on_collector(self):
+        collector = self.__mock_collector__("a", {})
+        collector.set_trigger = MagicMock(spec=(""))
+        c = Cimon(collectors=(collector,))
+        collector.set_trigger.assert_called_once_with(c.trigger)
+
+    def test_trigger_runs_now(self):
+        collector = self.__mock_collector__("a", {})
+        collector.set_trigger = MagicMock(spec=(""))
+        c = Cimon(polling_interval_sec=3600, collectors=(collector,), outputs=(self.__mock_output__(),))
+        c.start()
+        try:
+            collector.set_trigger.call_args[0][0]()
+            end = datetime.now().timestamp() + 5
+            while collector.collect.call_count < 2 and datetime.now().timestamp() < end:
+                sleep(0.01)
+            self.assertEqual(2, collector.collect.call_count)
+        finally:
+            c.stop()
+
+    def test_trigger_not_started(self):
+        Cimon().trigger() # ignored
+
+    def test_route_to_outputs(self):
+        routed = self.__mock_output__()
+        routed.route = MagicMock(spec=(""), side_effect=lambda key: key[1] == "a")
+        c = Cimon(collectors=(self.__mock_collector__("mock", {("mock","a") : JobStatus(), ("mock","e") : JobStatus()}),),
+                  outputs=(routed, self.__mock_output__()))
+        c.run()
+        routed.on_update.assert_called_once_with({("mock","a") : JobStatus()})
+        c.outputs[1].on_update.assert_called_once_with({("mock","a") : JobStatus(), ("mock","e") : JobStatus()})
+
+    def test_route_once_per_key(self):
+        output = self.__mock_output__()
+        output.route = MagicMock(spec=(""), return_value=True)
+        index = RoutingIndex((output,))
+        for i in range(3):
+            index.route({("mock","a") : JobStatus(), ("mock","e") : JobStatus()})
+        self.assertEqual(2, output.route.call_count)
+
+    def test_routes_of_keys_gone_dropped(self):
+        output = self.__mock_output__()
+        output.route = MagicMock(spec=(""), return_value=True)
+        index = RoutingIndex((output,))
+        index.route({("mock", str(i)) : JobStatus() for i in range(10)})
+        index.route({("mock","a") : JobStatus()})
+        index.route({("mock","0") : JobStatus()})
+        self.assertEqual(12, output.route.call_count)
+
+    def test_routed_share_summaries(self):
+        index = RoutingIndex((self.__mock_output__(), self.__mock_output__()))
+        routed = index.route({("mock","a") : JobStatus()})
+        self.assertIs(routed[0].summaries, routed[1].summaries)
+
 
     def __do_run__(self, nr_outputs=1, **collector_status):
         c = Cimon(collectors = tuple(self.__mock_collector__(name, self.__qualify_status__(name, status)) for name, status in collector_status.items()),
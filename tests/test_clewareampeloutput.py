@@ -1,8 +1,13 @@
 import env
 from unittest import TestCase
 from clewareampeloutput import *
+from output import FlashScheduler, DeviceCommandExecutor
+from cimon import Health
 from unittest.mock import MagicMock, Mock, patch, call
 from time import sleep
+from threading import Event
+import os
+import tempfile
 
 
 class TestClewarecontrolClewareAmpel(TestCase):
@@ -96,19 +101,21 @@ class TestClewarecontrolClewareAmpel(TestCase):
         # last display is not shown because it is the same value
         self.assertIn(self.ampel.__call_clewarecontrol__.call_count, [3,4])
 
-    def test_output_called_display_green_ten_times(self):
-        self.ampel = self.create_cleware_ampel(absoulte_every_sec=1)
-        for i in range(0,2):
-            self.ampel.display(green=True)
-            sleep(1)
-        self.assertIn(self.ampel.__call_clewarecontrol__.call_count, [1,2])
-
-    def test_output_called_display_green_twice_absolute_every(self):
-        self.ampel = self.create_cleware_ampel(absoulte_every_sec=0)
+    def test_output_called_display_green_twice_absolute(self):
+        self.ampel = self.create_cleware_ampel()
         for i in range(0,2):
-            self.ampel.display(green=True)
+            self.ampel.display(green=True, absolute=True)
             sleep(0.2)
         self.assertEqual(2, self.ampel.__call_clewarecontrol__.call_count)
+        self.ampel.__call_clewarecontrol__.assert_called_with((self.red,False), (self.yellow,False), (self.green,True))
+
+    def test_failed_output_all_next_time(self):
+        self.ampel = self.create_cleware_ampel(retval=False)
+        self.ampel.on_failure = Mock()
+        self.ampel.display(green=True)
+        self.ampel.wait_for_display(timeout=0.2)
+        self.assertEqual((None, None, None), self.ampel.current_display)
+        self.ampel.on_failure.assert_called_once_with()
 
     def test_wait_for_display(self):
         self.ampel = self.create_cleware_ampel()
@@ -127,7 +134,156 @@ class TestClewarecontrolClewareAmpel(TestCase):
             self.ampel.display(yellow=True, flash=(i%2 == 0))
             self.ampel.wait_for_display()
 
-    def create_cleware_ampel(self, flash_interval_sec=0.2, retval=True, absoulte_every_sec=42):
-        ampel = ClewarecontrolClewareAmpel(flash_interval_sec=flash_interval_sec, absoulte_every_sec=absoulte_every_sec)
+    def create_cleware_ampel(self, flash_interval_sec=0.2, retval=True):
+        scheduler = FlashScheduler() # flash phases start with the first display
+        self.addCleanup(scheduler.stop)
+        ampel = ClewarecontrolClewareAmpel(flash_interval_sec=flash_interval_sec, scheduler=scheduler)
         ampel.__call_clewarecontrol__ = MagicMock(spec=(""), return_value=retval)
         return ampel
+
+
+class TestHidrawClewareDevice(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.device = os.path.join(self.dir.name, "hidraw0")
+        open(self.device, "wb").close()
+
+    def written(self):
+        with open(self.device, "rb") as f:
+            return f.read()
+
+    def test_write_reports(self):
+        hidraw = HidrawClewareDevice(self.device)
+        self.assertTrue(hidraw.write((0, False), (1, True), (2, True)))
+        hidraw.close()
+        self.assertEqual(bytes((0, 0x10, 0, 0, 0x11, 1, 0, 0x12, 1)), self.written())
+
+    def test_kept_open(self):
+        hidraw = HidrawClewareDevice(self.device)
+        with patch("clewareampeloutput.os.open", wraps=os.open) as os_open:
+            hidraw.write((0, True))
+            hidraw.write((0, False))
+        hidraw.close()
+        self.assertEqual(1, os_open.call_count)
+        self.assertEqual(bytes((0, 0x10, 1, 0, 0x10, 0)), self.written())
+
+    def test_device_missing(self):
+        hidraw = HidrawClewareDevice(os.path.join(self.dir.name, "nothing"))
+        self.assertFalse(hidraw.write((0, True)))
+        self.assertFalse(hidraw.opened)
+
+    def test_ampel_with_hidraw(self):
+        ampel = ClewarecontrolClewareAmpel(flash_interval_sec=-1, backend="hidraw", hidraw_device=self.device)
+        ampel.__run_clewarecontrol__ = MagicMock(spec=(""), return_value=True)
+        ampel.display(green=True)
+        sleep(0.2)
+        ampel.stop()
+        ampel.close()
+        self.assertEqual(bytes((0, 0x10, 0, 0, 0x11, 0, 0, 0x12, 1)), self.written())
+        ampel.__run_clewarecontrol__.assert_not_called()
+
+    def test_fallback_to_clewarecontrol(self):
+        ampel = ClewarecontrolClewareAmpel(backend="auto", hidraw_device=os.path.join(self.dir.name, "nothing"))
+        ampel.__run_clewarecontrol__ = MagicMock(spec=(""), return_value=True)
+        self.assertTrue(ampel.__call_clewarecontrol__((2, True)))
+        ampel.__run_clewarecontrol__.assert_called_once_with((2, True))
+        self.assertIsNone(ampel.hidraw)
+
+    def test_no_fallback_for_hidraw(self):
+        ampel = ClewarecontrolClewareAmpel(backend="hidraw", hidraw_device=os.path.join(self.dir.name, "nothing"))
+        ampel.__run_clewarecontrol__ = MagicMock(spec=(""), return_value=True)
+        self.assertFalse(ampel.__call_clewarecontrol__((2, True)))
+        ampel.__run_clewarecontrol__.assert_not_called()
+
+    def test_find_cleware_hidraw(self):
+        sys_class_hidraw = os.path.join(self.dir.name, "sys")
+        for name, hid_id in (("hidraw0", "0003:0000046D:0000C52B"), ("hidraw1", "0003:00000D50:00000008")):
+            os.makedirs(os.path.join(sys_class_hidraw, name, "device"))
+            with open(os.path.join(sys_class_hidraw, name, "device", "uevent"), "w") as f:
+                f.write("DRIVER=hid-generic\nHID_ID=%s\nHID_NAME=Device\n" % hid_id)
+        self.assertEqual("/dev/hidraw1", find_cleware_hidraw(sys_class_hidraw))
+
+    def test_find_cleware_hidraw_none(self):
+        self.assertIsNone(find_cleware_hidraw(os.path.join(self.dir.name, "sys")))
+
+class TestClewarecontrolCommand(TestCase):
+
+    def test_commands(self):
+        ampel = ClewarecontrolClewareAmpel(device=901880)
+        ampel.executor = Mock()
+        self.assertTrue(ampel.__call_clewarecontrol__((0, False), (2, True)))
+        ampel.executor.submit.assert_called_once_with(["clewarecontrol", "-d", "901880", "-c", "1", "-as", "0", "0"],
+                                                      ["clewarecontrol", "-d", "901880", "-c", "1", "-as", "2", "1"])
+
+    def test_failed_command_outputs_all_next_time(self):
+        ampel = ClewarecontrolClewareAmpel()
+        ampel.executor = DeviceCommandExecutor("test", run=lambda command, timeout_sec: False)
+        ampel.current_display = (False, False, True)
+        ampel.__call_clewarecontrol__((0, True))
+        ampel.executor.wait(timeout=10)
+        self.assertEqual((None, None, None), ampel.current_display)
+
+    def test_superseded_command_all_lights_switched(self):
+        release = Event()
+        run = []
+        scheduler = FlashScheduler()
+        self.addCleanup(scheduler.stop)
+        ampel = ClewarecontrolClewareAmpel(flash_interval_sec=-1, scheduler=scheduler)
+        ampel.executor = DeviceCommandExecutor("test", run=lambda command, timeout_sec: release.wait(timeout=10) and not run.append(command))
+        self.addCleanup(ampel.executor.stop)
+        ampel.executor.submit(["blocking"])
+        ampel.display(red=True)
+        ampel.wait_for_display(timeout=1)
+        ampel.display(red=True, yellow=True, green=True)
+        ampel.wait_for_display(timeout=1)
+        release.set()
+        ampel.executor.wait(timeout=10)
+        lights = {int(command[-2]): command[-1] for command in run if command[0] == "clewarecontrol"}
+        self.assertEqual({0: "1", 1: "1", 2: "1"}, lights)
+        self.assertEqual((True, True, True), ampel.current_display)
+
+class TestClewareBuildAmpel(TestCase):
+
+    def test_unchanged_signal_absolute_output(self):
+        ampel = self.create_ampel(absoulte_every_sec=0)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY)
+        self.assertEqual([call(red=False, yellow=False, green=True, flash=False),
+                          call(red=False, yellow=False, green=True, flash=False, absolute=True)],
+                         ampel.cleware_ampel.display.call_args_list)
+
+    def test_unchanged_signal_not_output(self):
+        ampel = self.create_ampel()
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.cleware_ampel.display.assert_called_once_with(red=False, yellow=False, green=True, flash=False)
+
+    def test_failed_output_repeated_with_next_signal(self):
+        ampel = ClewareBuildAmpel(backend="clewarecontrol")
+        ampel.cleware_ampel.executor = DeviceCommandExecutor("test", run=lambda command, timeout_sec: False)
+        ampel.cleware_ampel.scheduler = FlashScheduler()
+        self.addCleanup(ampel.cleware_ampel.scheduler.stop)
+        ampel.signal_health(Health.SICK)
+        ampel.cleware_ampel.wait_for_display(timeout=0.5)
+        ampel.cleware_ampel.executor.wait(timeout=10)
+        self.assertIsNone(ampel.last_signal)
+        ampel.cleware_ampel.display = Mock()
+        ampel.signal_health(Health.SICK)
+        ampel.cleware_ampel.display.assert_called_once_with(red=True, yellow=False, green=False, flash=False)
+
+    def test_close_waits_for_commands(self):
+        run = []
+        ampel = ClewareBuildAmpel(backend="clewarecontrol")
+        ampel.cleware_ampel.executor = DeviceCommandExecutor("test", run=lambda command, timeout_sec: sleep(0.3) or not run.append(command))
+        ampel.cleware_ampel.scheduler = FlashScheduler()
+        self.addCleanup(ampel.cleware_ampel.scheduler.stop)
+        ampel.signal_off()
+        ampel.close()
+        self.assertEqual(3, len(run))
+
+    def create_ampel(self, absoulte_every_sec=300):
+        ampel = ClewareBuildAmpel(backend="clewarecontrol", absoulte_every_sec=absoulte_every_sec)
+        ampel.cleware_ampel.display = Mock()
+        return ampel
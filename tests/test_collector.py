@@ -6,6 +6,9 @@ from unittest import TestCase
 from unittest.mock import Mock, DEFAULT
 from types import SimpleNamespace
 from concurrent import futures
+from threading import Lock
+from time import sleep
+from itertools import count
 
 class TestHttpClient(TestCase):
     json_str = '{ "foo": "bar" }'
@@ -103,10 +106,54 @@ class TestHttpClient(TestCase):
         request = self.__get_request__(h.__open__)
         self.assertEqual(request.get_header("Authorization"), "bla")
 
-    def create_http_client(self, response_str="", http_error_codes=None, authentication_handler=EmptyAuthenticationHandler(), header=None):
+    def test_not_found_cached(self):
+        h = self.create_http_client(http_error_codes=[404, None], not_found_cache=NotFoundCache(ttl_sec=300))
+        for i in range(3):
+            with self.assertRaises(HTTPError) as e:
+                h.open_and_read("/mypath")
+            self.assertEqual(404, e.exception.code)
+        self.assertEqual(h.__open__.call_count, 1)
+
+    def test_not_found_cached_other_path(self):
+        h = self.create_http_client(http_error_codes=[404, None], not_found_cache=NotFoundCache(ttl_sec=300))
+        with self.assertRaises(HTTPError):
+            h.open_and_read("/mypath")
+        h.open_and_read("/otherpath")
+        self.assertEqual(h.__open__.call_count, 2)
+
+    def test_not_found_not_cached_if_requested(self):
+        h = self.create_http_client(http_error_codes=[404, 404, None], not_found_cache=NotFoundCache(ttl_sec=300))
+        for i in range(2):
+            with self.assertRaises(HTTPError):
+                h.open_and_read("/mypath", cache_not_found=False)
+        h.open_and_read("/mypath", cache_not_found=False)
+        self.assertEqual(h.__open__.call_count, 3)
+
+    def test_not_found_revalidated(self):
+        now = [0]
+        h = self.create_http_client(http_error_codes=[404, None], not_found_cache=NotFoundCache(ttl_sec=300, clock=lambda: now[0]))
+        with self.assertRaises(HTTPError):
+            h.open_and_read("/mypath")
+        now[0] = 299
+        with self.assertRaises(HTTPError):
+            h.open_and_read("/mypath")
+        now[0] = 301
+        h.open_and_read("/mypath")
+        self.assertEqual(h.__open__.call_count, 2)
+
+    def test_not_found_cache_shared_per_host(self):
+        self.assertIs(shared_not_found_cache("https://ci.sbb.ch", 300), shared_not_found_cache("https://ci.sbb.ch/jenkins", 300))
+        self.assertIsNot(shared_not_found_cache("https://ci.sbb.ch", 300), shared_not_found_cache("https://api.newrelic.com", 300))
+
+    def test_create_http_client_not_found_cache(self):
+        self.assertIsNone(create_http_client("https://ci.sbb.ch").not_found_cache)
+        self.assertIs(shared_not_found_cache("https://ci.sbb.ch", 60), create_http_client("https://ci.sbb.ch", not_found_ttl_sec=60).not_found_cache)
+
+    def create_http_client(self, response_str="", http_error_codes=None, authentication_handler=EmptyAuthenticationHandler(), header=None, not_found_cache=None):
         h = HttpClient(base_url="http://irgendw.as",
                        authentication_handler= authentication_handler,
-                       retry_delay_sec=0)
+                       retry_delay_sec=0,
+                       not_found_cache=not_found_cache)
         response = SimpleNamespace()
         response.read = Mock(spec=(""), return_value=response_str.encode("UTF-8"))
         response.headers = SimpleNamespace()
@@ -121,4 +168,173 @@ class TestHttpClient(TestCase):
         return h
 
     def __get_request__(self, open):
-        return open.call_args[0][0]
\ No newline at end of file
+        return open.call_args[0][0]
+
+class TestBoundedCache(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = BoundedCache(max_size=3, ttl_sec=10, clock=lambda: self.now)
+
+    def test_put_get(self):
+        self.cache.put("a", 1)
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(42, self.cache.get("b", 42))
+
+    def test_evict_least_recently_used(self):
+        for key in ("a", "b", "c"):
+            self.cache.put(key, key)
+        self.cache.get("a")
+        self.cache.put("d", "d")
+        self.assertEqual(3, len(self.cache))
+        self.assertNotIn("b", self.cache)
+        self.assertIn("a", self.cache)
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_expire(self):
+        self.cache.put("a", 1)
+        self.now = 11
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.expirations)
+        self.assertEqual(0, len(self.cache))
+
+    def test_get_renews(self):
+        self.cache.put("a", 1)
+        self.now = 8
+        self.assertEqual(1, self.cache.get("a"))
+        self.now = 16
+        self.assertEqual(1, self.cache.get("a"))
+
+    def test_put_expires_unused(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.now = 11
+        self.cache.put("c", 3)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual({"size" : 1, "maxSize" : 3, "evictions" : 0, "expirations" : 2}, self.cache.stats())
+
+    def test_no_ttl(self):
+        cache = BoundedCache(max_size=3, ttl_sec=None, clock=lambda: self.now)
+        cache.put("a", 1)
+        self.now = 10**9
+        self.assertEqual(1, cache.get("a"))
+
+class TestKeyCache(TestCase):
+
+    def test_get_put(self):
+        cache = KeyCache()
+        cache.put("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+    def test_used_in_last_collection_kept(self):
+        cache = KeyCache()
+        cache.put("a", 1)
+        cache.next_collection()
+        self.assertEqual(1, cache.get("a"))
+        cache.next_collection()
+        self.assertEqual(1, cache.get("a"))
+
+    def test_not_used_in_last_collection_dropped(self):
+        cache = KeyCache()
+        cache.put("a", 1)
+        cache.next_collection()
+        cache.next_collection()
+        self.assertIsNone(cache.get("a"))
+
+class TestServerSentEvents(TestCase):
+
+    def test_events(self):
+        lines = [b"event: open\n", b'data: {"a": 1}\n', b"\n", b"event: job\r\n", b"data: 42\r\n", b"\r\n"]
+        self.assertEqual([("open", '{"a": 1}'), ("job", "42")], list(server_sent_events(lines)))
+
+    def test_default_event_name(self):
+        self.assertEqual([("message", "foo")], list(server_sent_events(["data: foo", ""])))
+
+    def test_multiline_data(self):
+        self.assertEqual([("message", "foo\nbar")], list(server_sent_events(["data: foo", "data:bar", ""])))
+
+    def test_comment_ignored(self):
+        self.assertEqual([("job", "foo")], list(server_sent_events([": heartbeat", "", "event: job", "data: foo", ""])))
+
+    def test_incomplete_event_ignored(self):
+        self.assertEqual([], list(server_sent_events(["event: job", "data: foo"])))
+
+class TestTaskQueue(TestCase):
+
+    def test_merge_results(self):
+        result = self.run_tasks(lambda tasks: [tasks.submit(lambda x: {x: x}, i) for i in range(10)])
+        self.assertEqual({i: i for i in range(10)}, result)
+
+    def test_nested_submit_does_not_block(self):
+        # a single worker would deadlock if the tasks waited for their nested tasks
+        def nested(tasks, depth):
+            if depth > 0:
+                tasks.submit(nested, tasks, depth - 1)
+            return {depth: True}
+        result = self.run_tasks(lambda tasks: tasks.submit(nested, tasks, 5), max_workers=1)
+        self.assertEqual(6, len(result))
+
+    def test_none_result_is_ignored(self):
+        result = self.run_tasks(lambda tasks: tasks.submit(lambda: None))
+        self.assertEqual({}, result)
+
+    def test_error_is_raised_on_join(self):
+        def fail():
+            raise ValueError("kaputt")
+        with self.assertRaises(ValueError):
+            self.run_tasks(lambda tasks: tasks.submit(fail))
+
+    def test_no_tasks(self):
+        self.assertEqual({}, self.run_tasks(lambda tasks: None))
+
+    def run_tasks(self, submit, max_workers=3):
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tasks = TaskQueue(executor)
+            submit(tasks)
+            return tasks.join()
+
+class TestLimitedTaskQueue(TestCase):
+
+    def test_all_tasks_run(self):
+        result = self.run_limited_tasks(lambda tasks: [tasks.submit(lambda x: {x: x}, i) for i in range(20)])
+        self.assertEqual({i: i for i in range(20)}, result)
+
+    def test_limit(self):
+        lock = Lock()
+        running = [0, 0] # running, max running
+        def task(i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            sleep(0.001)
+            with lock:
+                running[0] -= 1
+            return {i: True}
+        result = self.run_limited_tasks(lambda tasks: [tasks.submit(task, i) for i in range(20)], max_parallel=2)
+        self.assertEqual(20, len(result))
+        self.assertLessEqual(running[1], 2)
+
+    def test_nested_submit_does_not_block(self):
+        task_ids = count()
+        def nested(tasks, depth):
+            if depth > 0:
+                tasks.submit(nested, tasks, depth - 1)
+                tasks.submit(nested, tasks, depth - 1)
+            return {next(task_ids): depth}
+        result = self.run_limited_tasks(lambda tasks: tasks.submit(nested, tasks, 4), max_parallel=1)
+        self.assertEqual(31, len(result))
+
+    def test_error_is_raised_on_join(self):
+        def fail():
+            raise ValueError("kaputt")
+        with self.assertRaises(ValueError):
+            self.run_limited_tasks(lambda tasks: [tasks.submit(fail) for i in range(3)])
+
+    def run_limited_tasks(self, submit, max_workers=5, max_parallel=3):
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tasks = TaskQueue(executor)
+            submit(LimitedTaskQueue(tasks, max_parallel))
+            return tasks.join()
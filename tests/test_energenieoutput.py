@@ -3,6 +3,10 @@ from unittest import TestCase
 from unittest.mock import MagicMock, Mock, patch, call
 from energenieoutput import *
 from types import SimpleNamespace
+from output import FlashScheduler, DeviceCommandExecutor
+from threading import Event
+from cimon import Health
+from time import sleep
 
 class TestEnergenieBuildAmpel(TestCase):
 
@@ -57,8 +61,80 @@ class TestEnergenieBuildAmpel(TestCase):
         e.signal(red=True, yellow=False, green=False, flash=False)
         e.energenie.switch.assert_called_once_with([])
 
-    def create_ampel(self, colors=None):
-        a = EnergenieBuildAmpel(colors=colors) if colors else EnergenieBuildAmpel()
+    def test_signal_flash(self):
+        e = self.create_ampel()
+        e.flash_interval_sec = 0.2
+        e.scheduler = FlashScheduler()
+        self.addCleanup(e.scheduler.stop)
+        e.signal(red=False, yellow=False, green=True, flash=True)
+        sleep(0.3)
+        e.scheduler.cancel(e)
+        e.energenie.switch.assert_has_calls([call([(1,False), (2,False), (3,True), (4,False)]),
+                                             call([(1,False), (2,False), (3,False), (4,False)]),
+                                             call([(1,False), (2,False), (3,True), (4,False)])])
+
+    def test_signal_no_flash_stops_flashing(self):
+        e = self.create_ampel()
+        e.flash_interval_sec = 0.2
+        e.scheduler = FlashScheduler()
+        self.addCleanup(e.scheduler.stop)
+        e.signal(red=False, yellow=False, green=True, flash=True)
+        e.signal(red=True, yellow=False, green=False, flash=False)
+        sleep(0.3)
+        e.energenie.switch.assert_called_once_with([(1,True), (2,False), (3,False), (4,True)])
+
+    def test_two_same_signals(self):
+        e = self.create_ampel(repeat_every=3)
+        for i in range(0,2):
+            e.signal_health(Health.HEALTHY)
+        e.energenie.switch.assert_called_once_with([(1,False), (2,False), (3,True), (4,False)])
+
+    def test_two_different_signals(self):
+        e = self.create_ampel(repeat_every=3)
+        e.signal_health(Health.HEALTHY)
+        e.signal_health(Health.UNWELL)
+        e.energenie.switch.assert_called_with([(1,False), (2,True), (3,False), (4,False)])
+        self.assertEqual(2, e.energenie.switch.call_count)
+
+    def test_four_same_signals(self):
+        e = self.create_ampel(repeat_every=3)
+        for i in range(0,4):
+            e.signal_health(Health.HEALTHY)
+        e.energenie.switch.assert_called_with([(1,False), (2,False), (3,True), (4,False)])
+        self.assertEqual(2, e.energenie.switch.call_count)
+
+    def test_seven_same_signals(self):
+        e = self.create_ampel(repeat_every=3)
+        for i in range(0,7):
+            e.signal_health(Health.UNWELL)
+        e.energenie.switch.assert_called_with([(1,False), (2,True), (3,False), (4,False)])
+        self.assertEqual(3, e.energenie.switch.call_count)
+
+    def test_three_different_signals(self):
+        e = self.create_ampel(repeat_every=3)
+        e.signal_health(Health.HEALTHY)
+        e.signal_health(Health.UNWELL)
+        e.signal_health(Health.HEALTHY)
+        e.energenie.switch.assert_called_with([(1,False), (2,False), (3,True), (4,False)])
+        self.assertEqual(3, e.energenie.switch.call_count)
+
+    def test_two_same_signals_repeat_every_time_0(self):
+        self.do_two_same_signals_repeat_every_time(0)
+
+    def test_two_same_signals_repeat_every_time_1(self):
+        self.do_two_same_signals_repeat_every_time(1)
+
+    def test_two_same_signals_repeat_every_time_minus_1(self):
+        self.do_two_same_signals_repeat_every_time(-1)
+
+    def do_two_same_signals_repeat_every_time(self, repeat_every):
+        e = self.create_ampel(repeat_every=repeat_every)
+        for i in range(0,2):
+            e.signal_health(Health.HEALTHY)
+        self.assertEqual(2, e.energenie.switch.call_count)
+
+    def create_ampel(self, colors=None, repeat_every=default_repeat_every):
+        a = EnergenieBuildAmpel(colors=colors, repeat_every=repeat_every) if colors else EnergenieBuildAmpel(repeat_every=repeat_every)
         a.energenie = SimpleNamespace()
         a.energenie.switch = MagicMock(spec=(""))
         return a
@@ -110,59 +186,37 @@ class EnergenieTest(TestCase):
         e.switch([])
         self.assertEqual(0, e.__call_sispmctl__.call_count)
 
-    def test_two_same_calls(self):
-        e = self.create_energenie()
-        for i in range(0,2):
-            e.switch([(1,False), (2,False), (3,True), (4,False)])
-        e.__call_sispmctl__.assert_called_once_with((1, False),(2, False), (3, True), (4, False))
-        self.assertEqual(1, e.__call_sispmctl__.call_count)
-
-    def test_two_different_calls(self):
-        e = self.create_energenie()
-        e.switch([(1,False), (2,False), (3,True), (4,False)])
-        e.switch([(1,False), (2,True), (3,False), (4,False)])
-        e.__call_sispmctl__.assert_called_with((1, False),(2, True), (3, False), (4, False))
-        self.assertEqual(2, e.__call_sispmctl__.call_count)
-
-    def test_four_same_calls(self):
-        e = self.create_energenie()
-        for i in range(0,4):
-            e.switch([(1,False), (2,False), (3,True), (4,False)])
-        e.__call_sispmctl__.assert_called_with((1, False),(2, False), (3, True), (4, False))
-        self.assertEqual(2, e.__call_sispmctl__.call_count)
-
-    def test_seven_same_calls(self):
-        e = self.create_energenie()
-        for i in range(0,7):
-            e.switch([(1,False), (2,True), (3,False), (4,False)])
-        e.__call_sispmctl__.assert_called_with((1, False),(2, True), (3, False), (4, False))
-        self.assertEqual(3, e.__call_sispmctl__.call_count)
-
-    def test_three_different_calls(self):
-        e = self.create_energenie()
-        e.switch([(1,False), (2,False), (3,True), (4,False)])
-        e.switch([(1,False), (2,True), (3,False), (4,False)])
-        e.switch([(1,False), (2,False), (3,True), (4,False)])
-        e.__call_sispmctl__.assert_called_with((1, False),(2, False), (3, True), (4, False))
-        self.assertEqual(3, e.__call_sispmctl__.call_count)
-
-    def test_two_same_calls_repeat_every_time_0(self):
-        self.do_two_same_calls_repeat_every_time(0)
-
-    def test_two_same_calls_repeat_every_time_1(self):
-        self.do_two_same_calls_repeat_every_time(1)
-
-    def test_two_same_calls_repeat_every_time_minus_1(self):
-        self.do_two_same_calls_repeat_every_time(-1)
-
-    def do_two_same_calls_repeat_every_time(self, repeat_every):
-        e = self.create_energenie(repeat_every=repeat_every)
-        for i in range(0,2):
-            e.switch([(1,False), (2,False), (3,True), (4,False)])
-        self.assertEqual(2, e.__call_sispmctl__.call_count)
-
-    def create_energenie(self, repeat_every=3):
-        e = Energenie(repeat_every=repeat_every)
+    def create_energenie(self):
+        e = Energenie()
         e.__call_sispmctl__ = MagicMock(spec=(""))
         return e
 
+class EnergenieCommandTest(TestCase):
+
+    def test_command(self):
+        e = Energenie(device_nr=2)
+        e.executor = Mock()
+        e.switch([(1, True), (2, False)])
+        e.executor.submit.assert_called_once_with(["sispmctl", "-q", "-d", "2", "-o", "1", "-f", "2"], key=(1, 2))
+
+    def test_command_without_device_nr(self):
+        e = Energenie()
+        e.executor = Mock()
+        e.switch([(3, True)])
+        e.executor.submit.assert_called_once_with(["sispmctl", "-q", "-o", "3"], key=(3,))
+
+    def test_outputs_of_same_device_not_superseded(self):
+        release = Event()
+        run = []
+        executor = DeviceCommandExecutor(("sispmctl", 1), run=lambda command, timeout_sec: release.wait(timeout=10) and not run.append(command))
+        self.addCleanup(executor.stop)
+        outputs = [Energenie(device_nr=1) for i in range(0, 3)]
+        for output in outputs:
+            output.executor = executor
+        outputs[0].switch([(1, True)])
+        outputs[1].switch([(2, False)])
+        outputs[2].switch([(3, True), (4, False)])
+        release.set()
+        executor.wait(timeout=10)
+        self.assertEqual([["sispmctl", "-q", "-d", "1", "-o", "1"], ["sispmctl", "-q", "-d", "1", "-f", "2"],
+                          ["sispmctl", "-q", "-d", "1", "-o", "3", "-f", "4"]], run)
@@ -0,0 +1,541 @@
+__author__ = 'florianseidl'
+
+import env
+from unittest import TestCase, main
+from unittest.mock import patch, Mock
+from copy import deepcopy
+from threading import Event, Thread
+import time
+from time import sleep
+from cimon import JobStatus, RequestStatus, Health, StatusSnapshot
+import hueoutput
+from hueoutput import HueOutput, TokenBucket, LAMP_OFF, COLOUR_WHITE, FLASHING_15SEC, FLASHING_SEC
+
+
+class FakeBridge():
+    """ records the commands sent instead of sending them to a hue bridge """
+
+    def __init__(self, groups=None, clock=None):
+        self.groups = groups if groups is not None else {}
+        self.clock = clock
+        self.commands = [] # (type, id, parameter, time)
+        self.error = None
+
+    def get_group(self):
+        return {group_id: dict(group) for group_id, group in self.groups.items()}
+
+    def create_group(self, name, lights):
+        if len(name) > 32: # as the bridge
+            return [{"error": {"type": 7, "address": "/groups/name", "description": "invalid value, %s, for parameter, name" % name}}]
+        group_id = str(len(self.groups) + 1)
+        self.groups[group_id] = {"name": name, "lights": [str(light) for light in lights]}
+        self.__record__("create_group", group_id, lights)
+        return [{"success": {"id": group_id}}]
+
+    def set_group(self, group_id, parameter, value=None):
+        if parameter == "lights":
+            self.groups[str(group_id)]["lights"] = [str(light) for light in value]
+        self.__record__("set_group", group_id, parameter)
+
+    def set_light(self, light_id, parameter):
+        self.__record__("set_light", light_id, parameter)
+
+    def lamps_sent(self):
+        """ lamp: colour of the lights and groups sent """
+        sent = {}
+        for type, command_id, parameter, time in self.commands:
+            if type == "set_light":
+                sent[command_id] = parameter
+            elif type == "set_group" and isinstance(parameter, dict):
+                for light in self.groups[str(command_id)]["lights"]:
+                    sent[int(light)] = parameter
+        return sent
+
+    def reset(self):
+        self.commands = []
+
+    def __record__(self, type, command_id, parameter):
+        if self.error:
+            raise self.error
+        self.commands.append((type, command_id, parameter, self.clock() if self.clock else None))
+
+
+def create_hue_output(test, lamps=(1, 2, 3, 4), unused=(4,), mappings={}, bridge=None, **kwargs):
+    bridge = bridge if bridge else FakeBridge()
+    for patcher in (patch("hueoutput.Bridge", return_value=bridge), patch("hueoutput.time.sleep")):
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    output = HueOutput(ipaddress="127.0.0.1", lamps=list(lamps), unused=list(unused), mappings=mappings,
+                       transitiontimeMillis=400, **kwargs)
+    test.addCleanup(output.stopSender)
+    output.waitForLamps() # connected
+    return output
+
+
+def wait_for(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        sleep(0.001)
+
+
+def update(output, status):
+    """ update and wait for the sender thread to send the lamps """
+    output.on_update(status)
+    output.waitForLamps()
+
+
+def lamps_sent(output):
+    return output.bridges[0].bridge.lamps_sent()
+
+
+class TestHueOutputMappings(TestCase):
+    mappings = {"group a": {"builds": ["job.a1", "job.a2"], "collectorFilterPattern": "nomatch", "lamps": [1]},
+                "group b": {"buildFilterPattern": r"job\.b.*", "lamps": [2, 3]}}
+
+    def setUp(self):
+        self.output = create_hue_output(self, mappings=self.mappings)
+
+    def test_worst_per_mapping(self):
+        states = self.output.mappingStates({("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+                                            ("ci.sbb.ch", "job.a2"): JobStatus(RequestStatus.OK, Health.SICK),
+                                            ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.NOT_FOUND, Health.UNDEFINED),
+                                            ("ci.sbb.ch", "job.b2"): JobStatus(RequestStatus.OK, Health.UNWELL, active=True)})
+        self.assertEqual({"lamps": [1], "status": RequestStatus.OK, "health": Health.SICK, "active": False},
+                         states[0]["group a"])
+        self.assertEqual({"lamps": [2, 3], "status": RequestStatus.NOT_FOUND, "health": Health.UNWELL, "active": True},
+                         states[0]["group b"])
+
+    def test_mapping_without_jobs(self):
+        states = self.output.mappingStates({("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY)})
+        self.assertEqual(["group a"], list(states[0]))
+
+    def test_route(self):
+        self.assertTrue(self.output.route(("ci.sbb.ch", "job.a1")))
+        self.assertTrue(self.output.route(("ci.sbb.ch", "job.b9")))
+        self.assertFalse(self.output.route(("ci.sbb.ch", "other")))
+
+    def test_mapping_evaluated_once_per_key(self):
+        with patch.object(self.output, "mappingsForJob", wraps=self.output.mappingsForJob) as mapping_for_job:
+            for i in range(3):
+                self.output.mappingStates({("ci.sbb.ch", "job.a1"): JobStatus(), ("ci.sbb.ch", "other"): JobStatus()})
+        self.assertEqual(2, mapping_for_job.call_count)
+
+    def test_cached_on_snapshot(self):
+        snapshot = StatusSnapshot({("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)})
+        with patch.object(self.output, "summarizeMappings", wraps=self.output.summarizeMappings) as summarize_mappings:
+            self.output.mappingStates(deepcopy(snapshot))
+            self.output.mappingStates(deepcopy(snapshot))
+        self.assertEqual(1, summarize_mappings.call_count)
+
+    def test_outputs_with_other_mapping_names_not_cached_together(self):
+        other = create_hue_output(self, mappings={"other a": self.mappings["group a"], "other b": self.mappings["group b"]})
+        snapshot = StatusSnapshot({("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.SICK)})
+        self.output.mappingStates(deepcopy(snapshot))
+        states = other.mappingStates(deepcopy(snapshot))
+        self.assertEqual(Health.SICK, states[0]["other b"]["health"])
+
+
+class TestHueOutputLampStates(TestCase):
+    mappings = {"group a": {"buildFilterPattern": r"job\.a.*", "lamps": [1, 2]},
+                "group b": {"buildFilterPattern": r"job\.b.*", "lamps": [3]}}
+    healthy = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+               ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)}
+    b_sick = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.SICK)}
+    active = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY, active=True),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)}
+
+    def setUp(self):
+        self.output = create_hue_output(self, lamps=(1, 2, 3, 4, 5), unused=(5,), mappings=self.mappings)
+        self.output.bridges[0].bridge.reset()
+
+    def test_first_update_sends_all_but_unused(self):
+        update(self.output, self.healthy)
+        sent = lamps_sent(self.output)
+        self.assertEqual([1, 2, 3, 4], sorted(sent)) # unused allready turned off on init
+        self.assertEqual(COLOUR_WHITE, sent[4])
+
+
+    def test_unchanged_not_sent(self):
+        update(self.output, self.healthy)
+        self.output.bridges[0].bridge.reset()
+        update(self.output, self.healthy)
+        self.assertEqual([], self.output.bridges[0].bridge.commands)
+
+    def test_only_changed_sent(self):
+        update(self.output, self.healthy)
+        self.output.bridges[0].bridge.reset()
+        update(self.output, self.b_sick)
+        self.assertEqual([3], list(lamps_sent(self.output)))
+
+    def test_active_not_sent_again(self):
+        update(self.output, self.active)
+        self.output.bridges[0].bridge.reset()
+        update(self.output, self.active)
+        self.assertEqual([], self.output.bridges[0].bridge.commands)
+        self.assertEqual([1, 2], sorted(self.output.bridges[0].rearmAt))
+        for rearm_at in self.output.bridges[0].rearmAt.values():
+            self.assertAlmostEqual(time.monotonic() + FLASHING_SEC, rearm_at, delta=1)
+
+    def test_active_rearmed_when_flashing_expires(self):
+        update(self.output, self.active)
+        states = dict(self.output.bridges[0].lampStates)
+        self.output.bridges[0].bridge.reset()
+        with self.output.bridges[0].condition:
+            self.output.bridges[0].rearmAt = {lamp: 0 for lamp in self.output.bridges[0].rearmAt}
+            self.output.bridges[0].condition.notify_all()
+        wait_for(lambda: len(lamps_sent(self.output)) == 2)
+        self.assertEqual({1: FLASHING_15SEC, 2: FLASHING_15SEC}, lamps_sent(self.output))
+        self.assertEqual(states, self.output.bridges[0].lampStates)
+        self.assertTrue(all(rearm_at > time.monotonic() for rearm_at in self.output.bridges[0].rearmAt.values()))
+
+    def test_rearm_timed_by_scheduler(self):
+        update(self.output, self.active)
+        self.output.bridges[0].bridge.reset()
+        with self.output.bridges[0].condition:
+            self.output.bridges[0].rearmAt = {lamp: time.monotonic() + 0.05 for lamp in self.output.bridges[0].rearmAt}
+            self.output.bridges[0].scheduleRearm()
+        wait_for(lambda: len(lamps_sent(self.output)) == 2)
+        self.assertEqual({1: FLASHING_15SEC, 2: FLASHING_15SEC}, lamps_sent(self.output))
+
+    def test_not_rearmed_when_no_longer_active(self):
+        update(self.output, self.active)
+        update(self.output, self.healthy)
+        self.assertEqual({}, self.output.bridges[0].rearmAt)
+
+    def test_absolute_sends_all(self):
+        update(self.output, self.healthy)
+        self.output.bridges[0].bridge.reset()
+        self.output.bridges[0].absoluteNext = 0
+        update(self.output, self.healthy)
+        self.assertEqual([1, 2, 3, 4, 5], sorted(lamps_sent(self.output)))
+
+    def test_absolute_every_time(self):
+        output = create_hue_output(self, lamps=(1,), unused=(), absoluteEverySec=0)
+        update(output, {})
+        update(output, {})
+        self.assertEqual(2, len([command for command in output.bridges[0].bridge.commands if command[1] == 1]))
+
+    def test_failed_lamps_sent_again(self):
+        self.output.bridges[0].bridge.error = OSError("bridge not reachable")
+        with self.assertLogs("hueoutput", level="ERROR"):
+            update(self.output, self.healthy)
+        self.output.bridges[0].bridge.error = None
+        self.output.bridges[0].bridge.reset()
+        update(self.output, self.healthy)
+        self.assertEqual([1, 2, 3, 4], sorted(lamps_sent(self.output)))
+
+    def test_after_close_sent_again(self):
+        update(self.output, self.healthy)
+        self.output.close()
+        self.output.bridges[0].bridge.reset()
+        update(self.output, self.healthy)
+        self.assertEqual([1, 2, 3, 4], sorted(lamps_sent(self.output)))
+
+class BlockingBridge(FakeBridge):
+    """ blocks each light command until released """
+
+    def __init__(self):
+        super().__init__()
+        self.started = Event()
+        self.released = Event()
+        self.blocking = False
+
+    def set_light(self, light_id, parameter):
+        if self.blocking:
+            self.started.set()
+            self.released.wait(timeout=10)
+        super().set_light(light_id, parameter)
+
+
+class TestHueOutputSender(TestCase):
+    mappings = {"group a": {"buildFilterPattern": r"job\.a.*", "lamps": [1]},
+                "group b": {"buildFilterPattern": r"job\.b.*", "lamps": [2, 3]}}
+    healthy = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+               ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)}
+    b_sick = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.SICK)}
+    a_sick = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.SICK),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)}
+
+    def setUp(self):
+        self.bridge = BlockingBridge()
+        self.output = create_hue_output(self, mappings=self.mappings, bridge=self.bridge, useGroups=False)
+        self.addCleanup(self.bridge.released.set)
+        self.bridge.reset()
+        self.bridge.blocking = True
+
+    def test_on_update_does_not_wait_for_bridge(self):
+        self.output.on_update(self.healthy)
+        self.assertTrue(self.bridge.started.wait(timeout=10))
+        self.output.on_update(self.b_sick) # returns while the bridge is still blocked
+        self.assertEqual([], self.bridge.commands)
+        self.bridge.released.set()
+        self.output.waitForLamps()
+        self.assertEqual(3, len(lamps_sent(self.output)))
+
+    def test_newer_status_supersedes_queued(self):
+        self.output.on_update(self.healthy)
+        self.assertTrue(self.bridge.started.wait(timeout=10))
+        self.output.on_update(self.b_sick)
+        self.output.on_update(self.a_sick)
+        self.bridge.released.set()
+        self.output.waitForLamps()
+        # the lamp being sent is completed, the rest of healthy and b_sick are never sent
+        self.assertEqual([1, 1, 2, 3], [command[1] for command in self.bridge.commands])
+        green, red = self.bridge.commands[0][2], self.bridge.commands[1][2]
+        self.assertNotEqual(green, red)
+        self.assertEqual({1: red, 2: green, 3: green}, lamps_sent(self.output))
+
+    def test_stop_does_not_wait_for_blocked_bridge(self):
+        self.output.on_update(self.healthy)
+        self.assertTrue(self.bridge.started.wait(timeout=10))
+        blocked = self.output.bridges[0].sender
+        with patch("hueoutput.STOP_SENDER_TIMEOUT_SEC", 0.1), self.assertLogs("hueoutput", level="WARNING"):
+            self.output.stopSender()
+        self.assertTrue(blocked.is_alive())
+        self.bridge.blocking = False
+        self.output.on_update(self.b_sick) # sent by the blocked sender after its command, not by a second one
+        self.bridge.released.set()
+        self.output.waitForLamps()
+        self.assertIs(blocked, self.output.bridges[0].sender)
+        sent = lamps_sent(self.output)
+        self.assertEqual(sent[2], sent[3])
+        self.assertNotEqual(sent[1], sent[2])
+
+    def test_close_drops_queued(self):
+        self.output.on_update(self.healthy)
+        self.assertTrue(self.bridge.started.wait(timeout=10))
+        self.output.on_update(self.b_sick)
+        closing = Thread(target=self.output.close)
+        closing.start()
+        while self.output.bridges[0].toSend is not None:
+            sleep(0.001)
+        self.bridge.blocking = False
+        self.bridge.released.set()
+        closing.join(timeout=10)
+        self.assertEqual({1: LAMP_OFF, 2: LAMP_OFF, 3: LAMP_OFF, 4: LAMP_OFF}, lamps_sent(self.output))
+        self.assertEqual(5, len(self.bridge.commands))
+
+
+class TestHueOutputBridges(TestCase):
+    bridges = [{"ipaddress": "10.0.0.1", "lamps": [1, 2], "unused": [2],
+                "mappings": {"group a": {"buildFilterPattern": r"job\.a.*", "lamps": [1]}}},
+               {"ipaddress": "10.0.0.2", "lamps": [1, 2], "useGroups": False, "transitiontimeMillis": 1000,
+                "mappings": {"group b": {"buildFilterPattern": r"job\.b.*", "lamps": [1]},
+                             "all": {"buildFilterPattern": r"job\..*", "lamps": [2]}}}]
+    status = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.SICK),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY)}
+
+    def setUp(self):
+        self.fake_bridges = {"10.0.0.1": BlockingBridge(), "10.0.0.2": FakeBridge()}
+        patcher = patch("hueoutput.Bridge", side_effect=lambda ipaddress: self.fake_bridges[ipaddress])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.fake_bridges["10.0.0.1"].released.set)
+        self.output = hueoutput.create({"transitiontimeMillis": 200, "bridges": self.bridges})
+        self.addCleanup(self.output.stopSender)
+        self.output.waitForLamps()
+
+    def test_one_sender_per_bridge(self):
+        self.assertEqual(["10.0.0.1", "10.0.0.2"], [bridge.ipaddress for bridge in self.output.bridges])
+        self.assertEqual([self.fake_bridges["10.0.0.1"], self.fake_bridges["10.0.0.2"]],
+                         [bridge.bridge for bridge in self.output.bridges])
+        self.assertIsNot(self.output.bridges[0].lightLimiter, self.output.bridges[1].lightLimiter)
+
+    def test_settings_per_bridge(self):
+        self.assertEqual([{"transitiontime": 2}, {"transitiontime": 10}],
+                         [bridge.transitiontime for bridge in self.output.bridges])
+        self.assertEqual([True, False], [bridge.useGroups for bridge in self.output.bridges])
+
+    def test_job_mapped_on_each_bridge(self):
+        states = self.output.mappingStates(self.status)
+        self.assertEqual(Health.SICK, states[0]["group a"]["health"])
+        self.assertEqual(Health.HEALTHY, states[1]["group b"]["health"])
+        self.assertEqual(Health.SICK, states[1]["all"]["health"])
+
+    def test_mappings_evaluated_once(self):
+        with patch.object(self.output, "mappingsForJob", wraps=self.output.mappingsForJob) as mappings_for_job:
+            self.output.mappingStates(self.status)
+            self.output.mappingStates(self.status)
+        self.assertEqual(2, mappings_for_job.call_count)
+
+    def test_bridges_sent_in_parallel(self):
+        blocked, other = self.fake_bridges["10.0.0.1"], self.fake_bridges["10.0.0.2"]
+        blocked.reset()
+        blocked.blocking = True
+        self.output.on_update(self.status)
+        self.assertTrue(blocked.started.wait(timeout=10))
+        self.output.bridges[1].waitForLamps()
+        self.assertEqual([1, 2], sorted(other.lamps_sent()))
+        self.assertEqual([], blocked.commands)
+        blocked.released.set()
+        self.output.waitForLamps()
+        self.assertEqual([1], sorted(blocked.lamps_sent()))
+
+
+class TestHueOutputConnect(TestCase):
+    mappings = {"group a": {"buildFilterPattern": r"job\.a.*", "lamps": [1]}}
+    status = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.SICK)}
+
+    def create_output(self, connect, connectRetries=2):
+        patcher = patch("hueoutput.Bridge", side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        output = HueOutput(ipaddress="127.0.0.1", lamps=[1, 2], unused=[2], mappings=self.mappings,
+                           connectRetries=connectRetries, connectRetryDelaySec=0)
+        self.addCleanup(output.stopSender)
+        return output
+
+    def test_init_does_not_wait_for_bridge(self):
+        connecting = Event()
+        bridge = FakeBridge()
+        output = self.create_output(lambda ipaddress: bridge if connecting.wait(timeout=10) else None)
+        self.addCleanup(connecting.set)
+        self.assertIsNone(output.bridges[0].bridge)
+        output.on_update(self.status) # buffered until connected
+        connecting.set()
+        output.waitForLamps()
+        self.assertIs(bridge, output.bridges[0].bridge)
+        self.assertEqual([1, 2], sorted(bridge.lamps_sent()))
+
+    def test_connect_retried(self):
+        bridge = FakeBridge()
+        attempts = [OSError("not reachable"), OSError("not reachable"), bridge]
+        def connect(ipaddress):
+            attempt = attempts.pop(0)
+            if isinstance(attempt, Exception):
+                raise attempt
+            return attempt
+        with self.assertLogs("hueoutput", level="ERROR"):
+            output = self.create_output(connect)
+            output.waitForLamps()
+        self.assertIs(bridge, output.bridges[0].bridge)
+        self.assertEqual({2: LAMP_OFF}, bridge.lamps_sent())
+
+    def test_connect_retries_bounded(self):
+        connect = Mock(side_effect=OSError("not reachable"))
+        with self.assertLogs("hueoutput", level="ERROR"):
+            output = self.create_output(connect)
+            output.waitForLamps()
+        self.assertEqual(3, connect.call_count)
+        self.assertIsNone(output.bridges[0].bridge)
+        with self.assertLogs("hueoutput", level="ERROR"):
+            update(output, self.status) # tries again
+        self.assertEqual(6, connect.call_count)
+
+    def test_close_not_connected(self):
+        with self.assertLogs("hueoutput", level="ERROR"):
+            output = self.create_output(Mock(side_effect=OSError("not reachable")), connectRetries=0)
+            output.waitForLamps()
+        output.close()
+        self.assertIsNone(output.bridges[0].bridge)
+
+
+class TestHueOutputGroups(TestCase):
+    mappings = {"group a": {"buildFilterPattern": r"job\.a.*", "lamps": [1, 2]},
+                "group b": {"buildFilterPattern": r"job\.b.*", "lamps": [3]},
+                "group c": {"buildFilterPattern": r"job\.c.*", "lamps": [4, 5, 6]}}
+    status = {("ci.sbb.ch", "job.a1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+              ("ci.sbb.ch", "job.b1"): JobStatus(RequestStatus.OK, Health.HEALTHY),
+              ("ci.sbb.ch", "job.c1"): JobStatus(RequestStatus.OK, Health.SICK)}
+
+    def test_groups_created(self):
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings)
+        self.assertEqual({"group a": 1, "group c": 2}, output.bridges[0].groups)
+        self.assertEqual({"1": {"name": "cimon group a", "lights": ["1", "2"]},
+                          "2": {"name": "cimon group c", "lights": ["4", "5", "6"]}}, output.bridges[0].bridge.groups)
+
+    def test_existing_group_updated(self):
+        bridge = FakeBridge(groups={"7": {"name": "cimon group a", "lights": ["1", "9"]},
+                                    "8": {"name": "cimon group c", "lights": ["4", "5", "6"]}})
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings, bridge=bridge)
+        self.assertEqual({"group a": 7, "group c": 8}, output.bridges[0].groups)
+        self.assertEqual(["1", "2"], bridge.groups["7"]["lights"])
+        self.assertEqual([("set_group", 7, "lights")], [command[:3] for command in bridge.commands])
+
+    def test_switched_by_group(self):
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings)
+        output.bridges[0].bridge.reset()
+        update(output, self.status)
+        self.assertEqual([("set_group", 1), ("set_light", 3), ("set_group", 2)],
+                         [command[:2] for command in output.bridges[0].bridge.commands])
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(lamps_sent(output)))
+
+    def test_partly_changed_by_light(self):
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings)
+        update(output, self.status)
+        output.bridges[0].lampStates[5] = LAMP_OFF # as if switched by someone else
+        output.bridges[0].bridge.reset()
+        update(output, self.status)
+        self.assertEqual([("set_light", 5)], [command[:2] for command in output.bridges[0].bridge.commands])
+
+    def test_without_groups(self):
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings, useGroups=False)
+        update(output, self.status)
+        self.assertEqual({}, output.bridges[0].groups)
+        self.assertEqual(6, len([command for command in output.bridges[0].bridge.commands if command[0] == "set_light"]))
+
+    def test_group_creation_fails(self):
+        bridge = FakeBridge()
+        bridge.error = OSError("kaputt")
+        output = create_hue_output(self, lamps=(1, 2, 3, 4, 5, 6), unused=(), mappings=self.mappings, bridge=bridge)
+        self.assertEqual({}, output.bridges[0].groups)
+
+
+    def test_group_creation_error_only_skips_group(self):
+        mappings = {"a group name longer than the bridge allows": {"buildFilterPattern": r"job\.a.*", "lamps": [1, 2]},
+                    "group c": {"buildFilterPattern": r"job\.c.*", "lamps": [4, 5, 6]}}
+        with self.assertLogs("hueoutput", level="ERROR"):
+            output = create_hue_output(self, lamps=(1, 2, 4, 5, 6), unused=(), mappings=mappings)
+        self.assertEqual({"group c": 1}, output.bridges[0].groups)
+        output.bridges[0].bridge.reset()
+        update(output, self.status)
+        self.assertEqual([("set_light", 1), ("set_light", 2), ("set_group", 1)],
+                         [command[:2] for command in output.bridges[0].bridge.commands])
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+    def sleep(self, sec):
+        self.now += sec
+
+    def clock(self):
+        return self.now
+
+    def test_burst_without_waiting(self):
+        bucket = TokenBucket(10, clock=self.clock, sleep=self.sleep)
+        for i in range(10):
+            bucket.acquire()
+        self.assertEqual(0.0, self.now)
+
+    def test_rate(self):
+        bucket = TokenBucket(10, clock=self.clock, sleep=self.sleep)
+        for i in range(30):
+            bucket.acquire()
+        self.assertAlmostEqual(2.0, self.now)
+
+    def test_refill(self):
+        bucket = TokenBucket(1, clock=self.clock, sleep=self.sleep)
+        bucket.acquire()
+        self.now += 5
+        bucket.acquire()
+        self.assertEqual(5.0, self.now) # not more than the burst size is saved up
+        bucket.acquire()
+        self.assertEqual(6.0, self.now)
+
+    def test_fake_bridge_commands_limited(self):
+        bridge = FakeBridge(clock=self.clock)
+        output = create_hue_output(self, lamps=list(range(1, 31)), unused=(), bridge=bridge)
+        output.bridges[0].lightLimiter = TokenBucket(10, clock=self.clock, sleep=self.sleep)
+        update(output, {})
+        times = [command[3] for command in bridge.commands]
+        self.assertEqual(30, len(times))
+        for i in range(len(times)):
+            self.assertGreaterEqual(times[i] + 1e-9, (i + 1 - 10) / 10) # a burst of 10, then 10 per second
+
+if __name__ == '__main__':
+    main()
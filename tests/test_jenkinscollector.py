@@ -3,13 +3,21 @@ __author__ = 'florianseidl'
 import os
 import re
 from datetime import datetime
+from time import sleep, time
+from threading import current_thread, Thread, Lock
 from unittest import TestCase, main
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 from urllib.error import HTTPError, URLError
 
-from cimon import Health, RequestStatus
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from queue import Queue, Empty
+import json
+
+from cimon import Health, RequestStatus, JobStatus
 from collector import HttpClient
-from jenkinscollector import JenkinsClient, JenkinsCollector
+from jenkinscollector import JenkinsClient, JenkinsCollector, JenkinsPushCollector, FederatedJenkinsCollector, JobTiers, \
+    NoNameFromUrlPatternExtractor, create
 
 
 def read(file_name):
@@ -29,7 +37,7 @@ class TestJenkinsClient(TestCase):
         c.http_client.open_and_read = MagicMock(spec=(""), return_value=self.json_str)
         res = c.latest_build("myjob")
         self.assertEqual(res, {"foo": "bar"})
-        c.http_client.open_and_read.assert_called_with("/job/myjob/lastBuild/api/json?depth=0")
+        c.http_client.open_and_read.assert_called_with("/job/myjob/lastBuild/api/json?depth=0", cache_not_found=False)
 
     def test_http_exception_500(self):
         c = JenkinsClient(HttpClient("http://foo.bar"))
@@ -59,7 +67,7 @@ class TestJenkinsCollectorJobs(TestCase):
     def do_collect_jobs_error(self, job_name, error):
         return self.do_collect_jobs(job_name=job_name, mock_open_and_read=MagicMock(spec=(""), side_effect=error))
 
-    def mock_open_and_read(self, request_path, folder=""):
+    def mock_open_and_read(self, request_path, folder="", cache_not_found=True):
         match = re.match("/job/(.*)/lastBuild/api/json", request_path)
         return read(folder + to_filename(match.group(1).strip("/")))
 
@@ -151,6 +159,16 @@ class TestJenkinsCollectorJobs(TestCase):
         self.assertEqual(Health.SICK, status[("ci.sbb.ch", self.job_name_building)].health)
         self.assertFalse(status[("ci.sbb.ch", self.job_name_building)].active)
 
+    def test_last_results_bounded(self):
+        job_names = (self.job_name_success, self.job_name_failed, self.job_name_unstable)
+        col = JenkinsCollector(mock_jenkins_client(self.url, self.mock_open_and_read),
+                               self.url,
+                               job_names=job_names,
+                               cache_max_size=2)
+        col.collect()
+        self.assertEqual(2, len(col.job_reader.last_results))
+        self.assertEqual(1, col.cache_stats()["lastResults"]["evictions"])
+
     def test_job_name_from_url(self):
         col = JenkinsCollector(mock_jenkins_client(self.url, self.mock_open_and_read),
                                self.url,
@@ -160,6 +178,66 @@ class TestJenkinsCollectorJobs(TestCase):
         self.assertIsNotNone(status[("ci.sbb.ch", 'pt.cisi.orga/job/common-check/job/develop')])
 
 
+class TestJenkinsCollectorJobTiers(TestCase):
+    url = "https://ci.sbb.ch"
+
+    def setUp(self):
+        self.testJobs = TestJenkinsCollectorJobs()
+        self.requested = []
+
+    def mock_open_and_read(self, request_path, cache_not_found=True):
+        self.requested.append(request_path)
+        return self.testJobs.mock_open_and_read(request_path)
+
+    def test_default_polls_every_job_every_time(self):
+        self.collect_cycles(20, 1, 1)
+        self.assertEqual(20, self.count_requests(self.testJobs.job_name_success))
+        self.assertEqual(20, self.count_requests(self.testJobs.job_name_building))
+
+    def test_building_polled_every_time(self):
+        self.collect_cycles(30, 2, 4)
+        self.assertEqual(30, self.count_requests(self.testJobs.job_name_building))
+
+    def test_stable_polled_less(self):
+        self.collect_cycles(30, 2, 4)
+        # hot for 3 cycles, warm for 7, cold for 20
+        self.assertLessEqual(self.count_requests(self.testJobs.job_name_success), 3 + 4 + 5)
+        self.assertGreaterEqual(self.count_requests(self.testJobs.job_name_success), 3 + 3 + 5)
+
+    def test_failed_stays_warm(self):
+        self.collect_cycles(30, 2, 10)
+        self.assertGreaterEqual(self.count_requests(self.testJobs.job_name_failed), 3 + 13)
+
+    def test_not_polled_status_returned(self):
+        status = self.collect_cycles(30, 2, 4)
+        self.assertEqual(3, len(status))
+        self.assertEqual(Health.HEALTHY, status[("ci.sbb.ch", self.testJobs.job_name_success)].health)
+
+    def test_tiers(self):
+        tiers = JobTiers(warm_poll_every=2, cold_poll_every=4)
+        tiers.record("a", {("ci", "a"): JobStatus(health=Health.HEALTHY)}, 0)
+        self.assertEqual(JobTiers.hot, tiers.tier(tiers.history.get("a"), 2))
+        self.assertEqual(JobTiers.warm, tiers.tier(tiers.history.get("a"), 3))
+        self.assertEqual(JobTiers.cold, tiers.tier(tiers.history.get("a"), 10))
+        tiers.record("a", {("ci", "a"): JobStatus(health=Health.HEALTHY)}, 10)
+        self.assertEqual(JobTiers.cold, tiers.tier(tiers.history.get("a"), 10))
+        tiers.record("a", {("ci", "a"): JobStatus(health=Health.SICK)}, 11)
+        self.assertEqual(JobTiers.hot, tiers.tier(tiers.history.get("a"), 11))
+
+    def collect_cycles(self, cycles, warm_poll_every, cold_poll_every):
+        col = JenkinsCollector(mock_jenkins_client(self.url, self.mock_open_and_read),
+                               self.url,
+                               job_names=(self.testJobs.job_name_success, self.testJobs.job_name_building, self.testJobs.job_name_failed),
+                               warm_poll_every=warm_poll_every,
+                               cold_poll_every=cold_poll_every)
+        for i in range(cycles):
+            status = col.collect()
+        return status
+
+    def count_requests(self, job_name):
+        return len([path for path in self.requested if job_name in path])
+
+
 class TestJenkinsCollectorViews(TestCase):
     view_name_1 = "mvp/view/mct-new/view/mct-develop/view/continuous"
     view_name_2 = "kd/view/esta.integrate"
@@ -256,6 +334,42 @@ class TestJenkinsCollectorViews(TestCase):
         print(str(builds))
 
 
+class TestJenkinsCollectorKeys(TestCase):
+    url = "https://ci.sbb.ch"
+
+    def test_view_keys_identical_each_cycle(self):
+        views = TestJenkinsCollectorViews()
+        self.assert_keys_identical(JenkinsCollector(mock_jenkins_client(self.url, views.mock_open_and_read),
+                                                    self.url,
+                                                    view_names=(views.view_name_noname,),
+                                                    job_name_from_url_pattern='https://ci.sbb.ch/job/(.+)'))
+
+    def test_folder_keys_identical_each_cycle(self):
+        folders = TestJenkinsCollectorFolders()
+        self.assert_keys_identical(JenkinsCollector(mock_jenkins_client(self.url, folders.mock_open_and_read),
+                                                    self.url,
+                                                    folder_names=(folders.folder_name_1,)))
+
+    def test_keys_not_bounded_by_cache_size(self):
+        col = JenkinsCollector(mock_jenkins_client(self.url, TestJenkinsCollectorViews().mock_open_and_read),
+                               self.url,
+                               view_names=(TestJenkinsCollectorViews.view_name_1,),
+                               cache_max_size=5)
+        builds = col.collect()
+        self.assertTrue(len(builds) > 5)
+        self.assertEqual(len(builds), col.cache_stats()["keys"]["views"]["size"])
+        self.assert_keys_identical(col)
+
+    def assert_keys_identical(self, col):
+        first = col.collect()
+        second = col.collect()
+        self.assertTrue(len(first) > 0)
+        self.assertEqual(set(first), set(second))
+        first_keys = {key: key for key in first}
+        for key in second:
+            self.assertIs(first_keys[key], key)
+
+
 class TestJenkinsCollectorNestedViews(TestCase):
     view_name_nested = "mvp/view/zvs-drittgeschaeft"
     view_name_nested_loop = "mvp/view/zvs-drittgeschaeft-fake-broken-with-loop"
@@ -274,6 +388,24 @@ class TestJenkinsCollectorNestedViews(TestCase):
         self.testViews.do_collect_views(124, view_name=self.view_name_nested_loop,
                                         mock_open_and_read=self.mock_open_and_read_for_nested_view)
 
+    def test_nested_view_loop_each_view_requested_once(self):
+        mock_open_and_read = Mock(spec=(""), side_effect=self.mock_open_and_read_for_nested_view)
+        self.testViews.do_collect_views(124, view_name=self.view_name_nested_loop,
+                                        mock_open_and_read=mock_open_and_read)
+        requested = [call[0][0] for call in mock_open_and_read.call_args_list]
+        self.assertEqual(len(requested), len(set(requested)))
+
+    def test_nested_view_parallel(self):
+        def slow_open_and_read(request_path):
+            sleep(0.2)
+            return self.mock_open_and_read_for_nested_view(request_path)
+        mock_open_and_read = Mock(spec=(""), side_effect=slow_open_and_read)
+        start = time()
+        self.testViews.do_collect_views(124, view_name=self.view_name_nested,
+                                        mock_open_and_read=mock_open_and_read)
+        # sequential would take 0.2 sec per view, parallel is bounded by the depth of the view tree
+        self.assertLess(time() - start, 0.2 * mock_open_and_read.call_count * 0.75)
+
 
 class TestJenkinsCollectorJobsAndViews(TestCase):
 
@@ -287,7 +419,7 @@ class TestJenkinsCollectorJobsAndViews(TestCase):
             self.testJobs.job_name_failed: read(to_filename(self.testJobs.job_name_failed)),
             self.testViews.view_name_2: read(to_filename(self.testViews.view_name_2))
         }
-        col = JenkinsCollector(jenkins=mock_jenkins_client(self.testJobs.url, Mock(spec=(""), side_effect=lambda x:
+        col = JenkinsCollector(jenkins=mock_jenkins_client(self.testJobs.url, Mock(spec=(""), side_effect=lambda x, cache_not_found=True:
         [content_by_key[k] for k in content_by_key if k in x][0])),
                                base_url=self.testJobs.url,
                                job_names=(self.testJobs.job_name_success, self.testJobs.job_name_failed),
@@ -336,17 +468,103 @@ class TestJenkinsCollectorFolders(TestCase):
         self.assertEqual(datetime.fromtimestamp(1592443260.226),
                          build[("ci.sbb.ch", "pt.cisi.orga/angebot/develop")].timestamp)
 
+    def test_collect_folder_bounded_threads(self):
+        threads = set()
+        def mock_open_and_read(request_path):
+            threads.add(current_thread())
+            return self.mock_open_and_read(request_path)
+        col = JenkinsCollector(mock_jenkins_client(self.url, mock_open_and_read),
+                               self.url,
+                               folder_names=(self.folder_name_1, self.folder_name_1),
+                               max_parallel_requests=2)
+        self.assertEqual(101 + 41, len(col.collect()))
+        self.assertLessEqual(len(threads), 2)
+
+    def test_collect_folder_error(self):
+        def mock_open_and_read(request_path, cache_not_found=True):
+            if request_path == "/job/%s/api/json?tree=jobs[name]" % self.folder_name_1:
+                raise HTTPError("http://foo.bar", 500, None, None, None)
+            return self.mock_open_and_read(request_path)
+        col = JenkinsCollector(mock_jenkins_client(self.url, mock_open_and_read),
+                               self.url,
+                               folder_names=(self.folder_name_1,))
+        status = col.collect()
+        self.assertEqual({("ci.sbb.ch", self.folder_name_1)}, set(status))
+        self.assertEqual(RequestStatus.ERROR, status[("ci.sbb.ch", self.folder_name_1)].request_status)
+
     def do_collect_folder(self, folder_name):
         col = JenkinsCollector(mock_jenkins_client(self.url, self.mock_open_and_read),
                                self.url,
                                folder_names=(folder_name,))
         return col.collect()
 
-    def mock_open_and_read(self, request_path):
+    def mock_open_and_read(self, request_path, cache_not_found=True):
         match = re.match("/job/(.*)/api/json", request_path)
         return read("folder/" + to_filename(match.group(1).strip("/")))
 
 
+class TestFederatedJenkinsCollector(TestCase):
+    folder_name = "PN_ES"
+    urls = ("https://ci.sbb.ch", "https://ci2.sbb.ch", "https://ci3.sbb.ch")
+
+    def setUp(self):
+        self.running = {}
+        self.max_running = {}
+        self.lock = Lock()
+
+    def test_collect_all_hosts(self):
+        builds = self.create_federated_collector().collect()
+        self.assertEqual(3 * 142, len(builds))
+        self.assertEqual({"ci.sbb.ch", "ci2.sbb.ch", "ci3.sbb.ch"}, {key[0] for key in builds})
+
+    def test_limit_per_host(self):
+        self.create_federated_collector(max_parallel_requests=6, max_parallel_requests_per_host=2).collect()
+        self.assertEqual(3, len(self.max_running))
+        for url in self.urls:
+            self.assertLessEqual(self.max_running[url], 2)
+
+    def test_names_not_unique(self):
+        with self.assertRaises(ValueError):
+            FederatedJenkinsCollector([self.create_collector(self.urls[0]), self.create_collector(self.urls[0])])
+
+    def test_create_federated(self):
+        collector = create({"implementation": "jenkinscollector",
+                            "maxParallelRequest": 9,
+                            "views": ["default_view"],
+                            "jenkins": [{"url": self.urls[0]}, {"url": self.urls[1], "views": ["other_view"]}]})
+        self.assertIsInstance(collector, FederatedJenkinsCollector)
+        self.assertEqual(9, collector.max_parallel_requests)
+        self.assertEqual([("default_view",), ("other_view",)], [c.view_names for c in collector.collectors])
+
+    def test_create_not_found_cache_off(self):
+        collector = create({"implementation": "jenkinscollector", "jenkins": [{"url": self.urls[0]}, {"url": self.urls[1]}]})
+        self.assertEqual([None, None], [c.job_reader.jenkins.http_client.not_found_cache for c in collector.collectors])
+
+    def test_create_federated_push_not_supported(self):
+        with self.assertRaises(ValueError):
+            create({"mode": "push", "jenkins": [{"url": self.urls[0]}]})
+
+    def create_federated_collector(self, max_parallel_requests=7, max_parallel_requests_per_host=4):
+        return FederatedJenkinsCollector([self.create_collector(url) for url in self.urls],
+                                         max_parallel_requests=max_parallel_requests,
+                                         max_parallel_requests_per_host=max_parallel_requests_per_host,
+                                         stagger_start_sec=0.01)
+
+    def create_collector(self, url):
+        def mock_open_and_read(request_path):
+            with self.lock:
+                self.running[url] = self.running.get(url, 0) + 1
+                self.max_running[url] = max(self.max_running.get(url, 0), self.running[url])
+            try:
+                sleep(0.001)
+                match = re.match("/job/(.*)/api/json", request_path)
+                return read("folder/" + to_filename(match.group(1).strip("/")))
+            finally:
+                with self.lock:
+                    self.running[url] -= 1
+        return JenkinsCollector(mock_jenkins_client(url, mock_open_and_read), url, folder_names=(self.folder_name,))
+
+
 class TestJenkinsCollectorMultibranch(TestCase):
     multibranch_pipeline_name = 'mvp.bats.vermittler-automat-tvm.ui-tests'
     url = "https://ci.sbb.ch"
@@ -375,11 +593,183 @@ class TestJenkinsCollectorMultibranch(TestCase):
                                multibranch_pipeline_names=(multibranch_pipeline_name,))
         return col.collect()
 
-    def mock_open_and_read(self, request_path):
+    def mock_open_and_read(self, request_path, cache_not_found=True):
         match = re.match("/job/(.*)/api/json", request_path)
         return read("multibranch/" + to_filename(match.group(1).strip("/")))
 
 
+class StandInJenkinsServer(ThreadingMixIn, HTTPServer):
+    """ a local stand in for jenkins with the sse gateway plugin, serves the job testdata and the events put into the queue """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), StandInJenkinsRequestHandler)
+        self.events = Queue()
+        self.subscriptions = []
+        self.job_requests = []
+        self.closed = False
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self):
+        return "http://localhost:%d" % self.server_address[1]
+
+    def send_event(self, event, data):
+        self.events.put(("event: %s\ndata: %s\n\n" % (event, json.dumps(data))).encode("utf-8"))
+
+    def close(self):
+        self.closed = True
+        self.shutdown()
+        self.server_close()
+
+
+class StandInJenkinsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith("/sse-gateway/connect"):
+            self.send_json({"status": "OK"})
+        elif self.path.startswith("/sse-gateway/listen/"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            self.write_event(b': heartbeat\n\nevent: open\ndata: {"dispatcherId": "4711"}\n\n')
+            while not self.server.closed:
+                try:
+                    self.write_event(self.server.events.get(timeout=0.05))
+                except Empty:
+                    pass
+        else:
+            match = re.match("/job/(.*)/lastBuild/api/json", self.path)
+            self.server.job_requests.append(match.group(1))
+            self.send_json(json.loads(read(to_filename(match.group(1)))))
+
+    def do_POST(self):
+        self.server.subscriptions.append(json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")))
+        self.send_json({"status": "OK"})
+
+    def write_event(self, event):
+        self.wfile.write(event)
+        self.wfile.flush()
+
+    def send_json(self, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestJenkinsPushCollector(TestCase):
+    job_name = "mvp.mct.vermittler-produkt.continuous"
+
+    def setUp(self):
+        self.server = StandInJenkinsServer()
+        self.trigger = Mock()
+        self.col = JenkinsPushCollector(JenkinsClient(http_client=HttpClient(self.server.url(), retry_delay_sec=0)),
+                                        self.server.url(),
+                                        job_names=(self.job_name,),
+                                        reconnect_delay_sec=0.05)
+        self.col.set_trigger(self.trigger)
+        self.key = (self.col.job_reader.name, self.job_name)
+
+    def tearDown(self):
+        self.col.close()
+        self.server.close()
+
+    def test_poll_when_not_connected(self):
+        status = self.col.collect()
+        self.assertEqual(Health.HEALTHY, status[self.key].health)
+        self.assertFalse(status[self.key].active)
+
+    def test_subscribe_job_events(self):
+        self.connect()
+        self.assertEqual([{"dispatcherId": "4711", "subscribe": [{"jenkins_channel": "job"}], "unsubscribe": []}],
+                         self.server.subscriptions)
+
+    def test_no_polling_while_connected(self):
+        self.connect()
+        requests = len(self.server.job_requests)
+        self.col.collect()
+        self.col.collect()
+        self.assertEqual(requests, len(self.server.job_requests))
+
+    def test_job_started_event(self):
+        self.connect()
+        self.send_and_wait_for_trigger({"jenkins_event": "job_run_started", "job_name": self.job_name, "jenkins_object_id": "516"})
+        status = self.col.collect()
+        self.assertTrue(status[self.key].active)
+        self.assertEqual(Health.HEALTHY, status[self.key].health)
+        self.assertEqual(516, status[self.key].number)
+
+    def test_job_ended_event(self):
+        self.connect()
+        self.send_and_wait_for_trigger({"jenkins_event": "job_run_started", "job_name": self.job_name})
+        self.send_and_wait_for_trigger({"jenkins_event": "job_run_ended", "job_name": self.job_name, "job_run_status": "FAILURE"}, 2)
+        status = self.col.collect()
+        self.assertFalse(status[self.key].active)
+        self.assertEqual(Health.SICK, status[self.key].health)
+
+    def test_untracked_job_event_ignored(self):
+        self.connect()
+        self.server.send_event("job", {"jenkins_event": "job_run_started", "job_name": "foo"})
+        self.send_and_wait_for_trigger({"jenkins_event": "job_run_started", "job_name": self.job_name})
+        self.assertEqual(1, self.trigger.call_count)
+        self.assertNotIn((self.col.job_reader.name, "foo"), self.col.collect())
+
+    def test_event_keyed_by_name_from_url(self):
+        self.col = JenkinsPushCollector(JenkinsClient(http_client=HttpClient(self.server.url(), retry_delay_sec=0)),
+                                        self.server.url(),
+                                        job_names=(self.job_name,),
+                                        job_name_from_url_pattern="/job/([^/]+)/",
+                                        reconnect_delay_sec=0.05)
+        self.col.set_trigger(self.trigger)
+        self.connect()
+        key = (self.col.job_reader.name, "mvp.mct.vermittler-produkt.continuous")
+        self.assertIn(key, self.col.collect())
+        self.send_and_wait_for_trigger({"jenkins_event": "job_run_started", "job_name": "renamed",
+                                        "jenkins_object_url": "job/%s/516/" % self.job_name})
+        self.assertTrue(self.col.collect()[key].active)
+
+    def test_event_keyed_by_branch_of_pipeline(self):
+        self.col.job_reader.name_from_url_pattern_extractor = NoNameFromUrlPatternExtractor()
+        key = self.col.__event_key__({"jenkins_event": "job_run_started", "job_name": "folder/pipeline/feature%2Fa",
+                                      "jenkins_object_url": "job/folder/job/pipeline/job/feature%252Fa/3/"})
+        self.assertEqual((self.col.job_reader.name, "folder/pipeline/feature/a"), key)
+
+    def test_reconnect_on_read_timeout(self):
+        self.col.event_read_timeout_sec = 0.2
+        self.connect()
+        self.wait_for(lambda: len(self.server.subscriptions) >= 2)
+
+    def test_poll_retried_after_error(self):
+        self.col.collect()
+        self.wait_for(lambda: self.server.subscriptions)
+        with patch.object(JenkinsCollector, "collect", side_effect=URLError("boom")):
+            with self.assertRaises(URLError):
+                self.col.collect()
+        requests = len(self.server.job_requests)
+        self.col.collect()
+        self.assertEqual(requests + 1, len(self.server.job_requests))
+
+    def connect(self):
+        self.col.collect()
+        self.wait_for(lambda: self.server.subscriptions)
+        self.col.collect() # polls once after connecting
+
+    def send_and_wait_for_trigger(self, data, call_count=1):
+        self.server.send_event("job", data)
+        self.wait_for(lambda: self.trigger.call_count >= call_count)
+
+    def wait_for(self, condition, timeout=5):
+        end = time() + timeout
+        while not condition() and time() < end:
+            sleep(0.01)
+        self.assertTrue(condition())
+
+
 def mock_jenkins_client(base_url, mock_open_and_read):
     jenkins = JenkinsClient(http_client=HttpClient(base_url=base_url))
     jenkins.http_client.open_and_read = mock_open_and_read
@@ -1,7 +1,12 @@
 __author__ = 'florianseidl'
 
 import env
-from newreliccollector import NewRelicApplicationsCollector, NewRelicAlertsCollector
+from newreliccollector import NewRelicApplicationsCollector, NewRelicAlertsCollector, IncrementalViolationsNewRelicClient, \
+    parse_links
+from datetime import datetime, timezone, timedelta
+from threading import Lock, Event
+from time import sleep
+import re
 from urllib.request import HTTPError, URLError
 from unittest import TestCase, main
 from unittest.mock import MagicMock, Mock
@@ -23,7 +28,7 @@ class TestAlertsCollector(TestCase):
                                       policy_name_pattern=policy_name_pattern,
                                       condition_name_pattern=condition_name_pattern)
         self.jsonStr = self.__override__(read("alerts_violations.json"), overrideById)
-        col.new_relic_client.http_client.open_and_read = self.mock_open_and_read
+        col.new_relic_client.http_client.open_and_read_with_headers = lambda request_path: (self.mock_open_and_read(request_path), {})
         return col.collect()
 
     def __override__(self, jsonStr, overrideById):
@@ -39,7 +44,7 @@ class TestAlertsCollector(TestCase):
 
     def do_collect_jobs_error(self, error):
         col = NewRelicAlertsCollector(base_url=self.url, api_key="sometoken")
-        col.new_relic_client.http_client.open_and_read = MagicMock(spec=(""),side_effect=error)
+        col.new_relic_client.http_client.open_and_read_with_headers = MagicMock(spec=(""),side_effect=error)
         return col.collect()
 
     def mock_open_and_read(self, request_path):
@@ -93,18 +98,81 @@ class TestAlertsCollector(TestCase):
         self.assertNotIn(("api.newrelic.com", "touri-tour_dev-monitor"), status)
         self.assertIn(("api.newrelic.com", "touri-cus-ftp_prod-monitor"), status)
 
+class TestIncrementalViolations(TestCase):
+    url = "https://api.newrelic.com"
+
+    def setUp(self):
+        self.violations = json.loads(read("alerts_violations.json"))["violations"]
+        self.changed_violations = []
+        self.requests = []
+        self.now = datetime(2020, 6, 1, 12, 0, 0, tzinfo=timezone.utc)
+        self.col = NewRelicAlertsCollector(base_url=self.url, api_key="sometoken", incremental_sync=True, full_sync_every=3)
+        self.col.new_relic_client.clock = lambda: self.now
+        self.col.new_relic_client.http_client.open_and_read_with_headers = self.mock_open_and_read_with_headers
+
+    def mock_open_and_read_with_headers(self, request_path):
+        self.requests.append(request_path)
+        violations = self.violations if "only_open=true" in request_path else self.changed_violations
+        return json.dumps({"violations": violations}), {}
+
+    def test_incremental_client(self):
+        self.assertIsInstance(self.col.new_relic_client, IncrementalViolationsNewRelicClient)
+
+    def test_first_sync_full(self):
+        self.col.collect()
+        self.assertEqual(["/v2/alerts_violations.json?only_open=true"], self.requests)
+
+    def test_incremental_since_last_sync(self):
+        status = self.col.collect()
+        self.now += timedelta(minutes=5)
+        self.assertEqual(status, self.col.collect())
+        self.assertEqual("/v2/alerts_violations.json?start_date=2020-06-01T11%3A59%3A00%2B00%3A00", self.requests[-1])
+
+    def test_incremental_closed(self):
+        self.col.collect()
+        self.changed_violations = [dict(v, closed_at=1592443260226) for v in self.violations_of("touri-tour_dev-monitor")]
+        self.assertNotIn(("api.newrelic.com", "touri-tour_dev-monitor"), self.col.collect())
+
+    def test_incremental_opened(self):
+        opened = self.violations_of("touri-tour_dev-monitor")
+        self.violations = [v for v in self.violations if v not in opened]
+        self.assertNotIn(("api.newrelic.com", "touri-tour_dev-monitor"), self.col.collect())
+        self.changed_violations = opened
+        self.assertEqual(Health.SICK, self.col.collect()[("api.newrelic.com", "touri-tour_dev-monitor")].health)
+
+    def test_full_sync_reconciles(self):
+        self.col.collect()
+        closed = self.violations_of("touri-tour_dev-monitor")
+        self.violations = [v for v in self.violations if v not in closed]
+        self.assertIn(("api.newrelic.com", "touri-tour_dev-monitor"), self.col.collect()) # close not seen incrementally
+        self.col.collect()
+        self.assertNotIn(("api.newrelic.com", "touri-tour_dev-monitor"), self.col.collect())
+        self.assertEqual(2, len([r for r in self.requests if "only_open=true" in r]))
+
+    def test_failed_sync_repeats_time_range(self):
+        self.col.collect()
+        self.now += timedelta(minutes=5)
+        self.col.new_relic_client.http_client.open_and_read_with_headers = MagicMock(side_effect=URLError("kaputt"))
+        self.assertEqual(RequestStatus.ERROR, self.col.collect()[("api.newrelic.com", "all")].request_status)
+        self.col.new_relic_client.http_client.open_and_read_with_headers = self.mock_open_and_read_with_headers
+        self.col.collect()
+        self.assertEqual("/v2/alerts_violations.json?start_date=2020-06-01T11%3A59%3A00%2B00%3A00", self.requests[-1])
+
+    def violations_of(self, condition_name):
+        return [v for v in self.violations if v["condition_name"] == condition_name]
+
 class TestNewRelicApplicationsCollector(TestCase):
     result_file = "application.json"
     url = "https://api.newrelic.com"
 
     def do_collect_health(self, application_name_pattern=None):
         col = NewRelicApplicationsCollector(base_url=self.url, api_key="sometoken", application_name_pattern=application_name_pattern)
-        col.new_relic_client.http_client.open_and_read = self.mock_open_and_read
+        col.new_relic_client.http_client.open_and_read_with_headers = lambda request_path: (self.mock_open_and_read(request_path), {})
         return col.collect()
 
     def do_collect_jobs_error(self, error):
         col = NewRelicApplicationsCollector(base_url=self.url, api_key="sometoken", application_name_pattern=r'.*')
-        col.new_relic_client.http_client.open_and_read = MagicMock(spec=(""),side_effect=error)
+        col.new_relic_client.http_client.open_and_read_with_headers = MagicMock(spec=(""),side_effect=error)
         return col.collect()
 
     def mock_open_and_read(self, request_path):
@@ -157,5 +225,127 @@ class TestNewRelicApplicationsCollector(TestCase):
         status = self.do_collect_jobs_error(URLError("kaputt"))
         self.assertEqual(RequestStatus.ERROR, status[("api.newrelic.com", "all")].request_status)
 
+class TestNewRelicApplicationIdRefresh(TestCase):
+    url = "https://api.newrelic.com"
+
+    def setUp(self):
+        self.all_applications_requested = Event()
+        self.all_applications_released = Event()
+        self.all_applications_released.set()
+        self.all_applications = read("application.json")
+        self.col = NewRelicApplicationsCollector(base_url=self.url, api_key="sometoken",
+                                                 application_name_pattern="touri-archiv_prod",
+                                                 refresh_applications_every=2)
+        self.col.new_relic_client.http_client.open_and_read_with_headers = self.mock_open_and_read_with_headers
+
+    def mock_open_and_read_with_headers(self, request_path):
+        if '?' not in request_path:
+            self.all_applications_requested.set()
+            self.all_applications_released.wait(5)
+            return self.all_applications, {}
+        return TestNewRelicApplicationsCollector().mock_open_and_read(request_path), {}
+
+    def test_first_load_synchronous(self):
+        self.assertEqual(1, len(self.col.collect()))
+
+    def test_refresh_in_background(self):
+        self.col.collect()
+        self.col.collect()
+        self.all_applications_requested.clear()
+        self.all_applications_released.clear()
+        self.all_applications = self.all_applications.replace("touri-archiv_prod", "touri-archiv_renamed")
+        # the refresh is blocked, still the collection returns with the ids loaded before
+        self.assertIn(("api.newrelic.com", "touri-archiv_prod"), self.col.collect())
+        self.assertTrue(self.all_applications_requested.wait(5))
+        self.all_applications_released.set()
+        self.wait_for_ids([])
+        self.assertEqual({}, self.col.collect())
+
+    def test_refresh_error_keeps_ids(self):
+        self.col.collect()
+        self.col.collect()
+        ids = self.col.new_relic_client.application_ids
+        self.all_applications = "kaputt"
+        self.col.collect()
+        self.assertTrue(self.all_applications_requested.wait(5))
+        sleep(0.05)
+        self.assertEqual(ids, self.col.new_relic_client.application_ids)
+
+    def wait_for_ids(self, ids):
+        for i in range(100):
+            if self.col.new_relic_client.application_ids == ids:
+                return
+            sleep(0.01)
+        self.fail("application ids not refreshed")
+
+class TestNewRelicPaging(TestCase):
+    url = "https://api.newrelic.com"
+    page_size = 10
+
+    def setUp(self):
+        self.applications = json.loads(read("application.json"))["applications"]
+        self.requested_pages = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = Lock()
+
+    def do_collect_health(self, with_last, application_name_pattern=None, max_parallel_requests=4):
+        col = NewRelicApplicationsCollector(base_url=self.url, api_key="sometoken",
+                                            application_name_pattern=application_name_pattern,
+                                            max_parallel_requests=max_parallel_requests)
+        col.new_relic_client.http_client.open_and_read_with_headers = \
+            lambda request_path: self.mock_open_and_read_with_headers(request_path, with_last)
+        return col.collect()
+
+    def mock_open_and_read_with_headers(self, request_path, with_last):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+        try:
+            sleep(0.001)
+            match = re.search(r"[?&]page=(\d+)", request_path)
+            page = int(match.group(1)) if match else 1
+            self.requested_pages.append(page)
+            ids = re.search(r"filter\[ids\]=([^&]*)", request_path)
+            applications = [app for app in self.applications if not ids or str(app["id"]) in ids.group(1).split(",")]
+            last = (len(applications) - 1) // self.page_size + 1
+            links = []
+            if page < last:
+                links.append('<%s/v2/applications.json?page=%d>; rel="next"' % (self.url, page + 1))
+                if with_last:
+                    links.append('<%s/v2/applications.json?page=%d>; rel="last"' % (self.url, last))
+            contents = {"applications": applications[(page - 1) * self.page_size:page * self.page_size]}
+            return json.dumps(contents), {"Link": ", ".join(links)} if links else {}
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def test_all_pages_following_next(self):
+        status = self.do_collect_health(with_last=False)
+        self.assertEqual(59, len(status))
+        self.assertEqual([1, 2, 3, 4, 5, 6], self.requested_pages)
+
+    def test_all_pages_parallel(self):
+        status = self.do_collect_health(with_last=True)
+        self.assertEqual(59, len(status))
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(self.requested_pages))
+
+    def test_parallel_bounded(self):
+        self.do_collect_health(with_last=True, max_parallel_requests=2)
+        self.assertLessEqual(self.max_running, 2)
+
+    def test_filtered_all_pages(self):
+        status = self.do_collect_health(with_last=True, application_name_pattern=".*_dev")
+        self.assertEqual(20, len(status))
+
+    def test_parse_links(self):
+        self.assertEqual({"next": "https://api.newrelic.com/v2/applications.json?filter[ids]=1,2&page=2",
+                          "last": "https://api.newrelic.com/v2/applications.json?filter[ids]=1,2&page=3"},
+                         parse_links('<https://api.newrelic.com/v2/applications.json?filter[ids]=1,2&page=2>; rel="next", '
+                                     '<https://api.newrelic.com/v2/applications.json?filter[ids]=1,2&page=3>; rel="last"'))
+
+    def test_parse_links_empty(self):
+        self.assertEqual({}, parse_links(None))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
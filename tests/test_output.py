@@ -4,7 +4,12 @@ import env
 from output import *
 from unittest import TestCase, main
 from unittest.mock import MagicMock, Mock
-from cimon import JobStatus,RequestStatus,Health
+from cimon import JobStatus,RequestStatus,Health,StatusSnapshot
+from copy import deepcopy
+from threading import Event
+import sys
+import time
+from time import sleep
 
 class AbstractBuildAmpelTest(TestCase):
 
@@ -132,6 +137,19 @@ class AbstractBuildAmpelTest(TestCase):
         status = {"another.a" : {("ci.sbb.ch","job.a") :JobStatus(RequestStatus.OK, Health.HEALTHY)}}
         self.assertEqual(status, filter.filter_status(status))
 
+    def test_matches_key_evaluated_once(self):
+        filter = NameFilter(job_name_pattern="job.*")
+        filter.matches = Mock(spec=(""), return_value=True)
+        status = {("ci.sbb.ch","job.a") : JobStatus(), ("ci.sbb.ch","job.b") : JobStatus()}
+        self.assertEqual(status, filter.filter_status(status))
+        self.assertEqual(status, filter.filter_status(status))
+        self.assertEqual(2, filter.matches.call_count)
+
+    def test_route(self):
+        ampel = self.__create_ampel__(signal_error_threshold=1, build_filter_pattern="bla.*")
+        self.assertTrue(ampel.route(("ci.sbb.ch", "bla.b")))
+        self.assertFalse(ampel.route(("ci.sbb.ch", "job.a")))
+
     def test_filter_with_ampel(self):
         ampel = self.__create_ampel__(signal_error_threshold=1, build_filter_pattern="bla.*") # threshold is pointless here as no previosu status exists
         ampel.on_update({("ci.sbb.ch","job.a") :JobStatus(RequestStatus.OK, Health.HEALTHY)})
@@ -142,10 +160,314 @@ class AbstractBuildAmpelTest(TestCase):
         ampel.on_update({("ci.sbb.ch","job.a") : JobStatus(RequestStatus.OK, Health.SICK), ("ci.sbb.ch", "bla.b") : JobStatus(RequestStatus.OK, Health.HEALTHY)})
         ampel.signal.assert_called_once_with(red=False, yellow=False, green=True, flash=False)
 
-    def __create_ampel__(self,signal_error_threshold, build_filter_pattern=None):
-        ampel = AbstractBuildAmpel(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern)
+    def test_unchanged_signal_repeated_every_time(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY)
+        self.assertEqual(2, ampel.signal.call_count)
+
+    def test_unchanged_signal_never_repeated(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=0)
+        for i in range(0, 5):
+            ampel.signal_health(Health.HEALTHY)
+        ampel.signal.assert_called_once_with(red=False, yellow=False, green=True, flash=False)
+
+    def test_changed_signal_not_repeated(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=0)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY, building=True)
+        ampel.signal_error()
+        ampel.signal_off()
+        self.assertEqual(4, ampel.signal.call_count)
+        ampel.signal.assert_called_with(red=False, yellow=False, green=False, flash=False)
+
+    def test_unchanged_signal_repeated_every_3(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=3)
+        for i in range(0, 7):
+            ampel.signal_health(Health.SICK)
+        self.assertEqual(3, ampel.signal.call_count)
+
+    def test_unchanged_signal_repeated_after_sec(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=0, refresh_every_sec=60)
+        ampel.signal_health(Health.UNWELL)
+        ampel.signal_health(Health.UNWELL)
+        self.assertEqual(1, ampel.signal.call_count)
+        ampel.last_signal_at -= 60
+        ampel.signal_health(Health.UNWELL)
+        ampel.signal_health(Health.UNWELL)
+        self.assertEqual(2, ampel.signal.call_count)
+
+    def test_unchanged_signal_repeated_by_refresh_signal(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0)
+        ampel.refresh_signal = Mock(spec=(""))
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.signal.assert_called_once_with(red=False, yellow=False, green=True, flash=False)
+        ampel.refresh_signal.assert_called_once_with(red=False, yellow=False, green=True, flash=False)
+
+    def test_invalidated_signal_repeated(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=0)
+        ampel.signal_health(Health.HEALTHY)
+        ampel.invalidate_last_signal()
+        ampel.signal_health(Health.HEALTHY)
+        self.assertEqual(2, ampel.signal.call_count)
+
+    def test_failed_signal_repeated(self):
+        ampel = self.__create_ampel__(signal_error_threshold=0, refresh_every=0)
+        ampel.signal.side_effect = [OSError("kaputt"), None]
+        with self.assertRaises(OSError):
+            ampel.signal_health(Health.HEALTHY)
+        ampel.signal_health(Health.HEALTHY)
+        self.assertEqual(2, ampel.signal.call_count)
+
+    def __create_ampel__(self,signal_error_threshold, build_filter_pattern=None, refresh_every=1, refresh_every_sec=0):
+        ampel = AbstractBuildAmpel(signal_error_threshold=signal_error_threshold, build_filter_pattern=build_filter_pattern,
+                                   refresh_every=refresh_every, refresh_every_sec=refresh_every_sec)
         ampel.signal = Mock(spec=(""))
         return ampel
 
+class HealthSummaryTest(TestCase):
+    status = {("ci.sbb.ch","job.a") : JobStatus(RequestStatus.OK, Health.HEALTHY),
+              ("ci.sbb.ch","job.b") : JobStatus(RequestStatus.OK, Health.SICK, active=True),
+              ("ci.sbb.ch","bla.c") : JobStatus(RequestStatus.NOT_FOUND, Health.UNWELL),
+              ("other","job.d") : JobStatus(RequestStatus.ERROR, active=True)}
+
+    def test_counts(self):
+        summary = summarize(self.status)
+        self.assertEqual(2, summary.request_status_counts[RequestStatus.OK])
+        self.assertTrue(summary.has_health(Health.SICK))
+        self.assertTrue(summary.has_request_status(RequestStatus.ERROR))
+
+    def test_health_only_request_status_ok(self):
+        summary = summarize(self.status)
+        self.assertFalse(summary.has_health(Health.UNWELL))
+        self.assertEqual(Health.SICK, summary.max_health)
+
+    def test_building(self):
+        self.assertTrue(summarize(self.status).is_building())
+        summary = summarize(self.status, NameFilter(collector_pattern="other"))
+        self.assertFalse(summary.is_building())
+        self.assertTrue(summary.active)
+
+    def test_max_request_status(self):
+        self.assertEqual(RequestStatus.ERROR, summarize(self.status).max_request_status())
+        self.assertEqual(RequestStatus.NOT_FOUND, summarize(self.status, NameFilter(job_name_pattern="bla.*")).max_request_status())
+        self.assertIsNone(summarize({}).max_request_status())
+
+    def test_filter(self):
+        summary = summarize(self.status, NameFilter(collector_pattern="ci.sbb.ch", job_name_pattern="job.*"))
+        self.assertEqual(2, sum(summary.request_status_counts.values()))
+
+    def test_same_as_functions(self):
+        summary = summarize(self.status)
+        for health in Health:
+            self.assertEqual(has_health(self.status, health), summary.has_health(health))
+        for request_status in RequestStatus:
+            self.assertEqual(has_request_status(self.status, request_status), summary.has_request_status(request_status))
+        self.assertEqual(is_building(self.status), summary.is_building())
+
+    def test_cached_on_snapshot_shared_by_copies(self):
+        snapshot = StatusSnapshot(self.status)
+        copy_a = deepcopy(snapshot)
+        copy_b = deepcopy(snapshot)
+        self.assertIsNot(copy_a[("ci.sbb.ch","job.a")], copy_b[("ci.sbb.ch","job.a")])
+        self.assertIs(summarize(copy_a, NameFilter(job_name_pattern="job.*")),
+                      summarize(copy_b, NameFilter(job_name_pattern="job.*")))
+        self.assertIsNot(summarize(copy_a), summarize(copy_b, NameFilter(job_name_pattern="job.*")))
+
+    def test_not_cached_on_dict(self):
+        self.assertIsNot(summarize(self.status), summarize(self.status))
+
+    def test_ampel_uses_shared_summary(self):
+        snapshot = StatusSnapshot(self.status)
+        summary = summarize(snapshot, NameFilter(collector_pattern="ci.sbb.ch"))
+        summary.health_counts.clear() # prove the ampel did use the cached summary: nothing to signal
+        ampel = AbstractBuildAmpel(collector_filter_pattern="ci.sbb.ch")
+        ampel.signal = Mock(spec=(""))
+        ampel.on_update(deepcopy(snapshot))
+        self.assertFalse(ampel.signal.called)
+
+class DeviceCommandExecutorTest(TestCase):
+
+    def setUp(self):
+        self.run = []
+        self.started = Event()
+        self.release = Event()
+        self.release.set()
+
+    def fake_run(self, command, timeout_sec):
+        self.started.set()
+        self.release.wait(timeout=10)
+        self.run.append(command)
+        return command[0] != "fail"
+
+    def create_executor(self):
+        executor = DeviceCommandExecutor("device", run=self.fake_run)
+        self.addCleanup(executor.stop)
+        return executor
+
+    def test_call(self):
+        executor = self.create_executor()
+        self.assertTrue(executor.call(["ok", "1"], ["ok", "2"]))
+        self.assertEqual([["ok", "1"], ["ok", "2"]], self.run)
+
+    def test_stops_at_failure(self):
+        executor = self.create_executor()
+        self.assertFalse(executor.call(["fail"], ["ok"]))
+        self.assertEqual([["fail"]], self.run)
+
+    def test_pending_superseded(self):
+        executor = self.create_executor()
+        self.release.clear()
+        running = executor.submit(["ok", "running"])
+        self.assertTrue(self.started.wait(timeout=10))
+        superseded = executor.submit(["ok", "superseded"])
+        latest = executor.submit(["ok", "latest"])
+        self.release.set()
+        self.assertTrue(running.result(timeout=10))
+        self.assertFalse(superseded.result(timeout=10))
+        self.assertTrue(latest.result(timeout=10))
+        self.assertEqual([["ok", "running"], ["ok", "latest"]], self.run)
+        self.assertEqual(1, executor.stats()["superseded"])
+
+    def test_pending_with_other_key_not_superseded(self):
+        executor = self.create_executor()
+        self.release.clear()
+        executor.submit(["ok", "running"])
+        self.assertTrue(self.started.wait(timeout=10))
+        a = executor.submit(["ok", "a"], key="a")
+        b = executor.submit(["ok", "b"], key="b")
+        latest_a = executor.submit(["ok", "latest a"], key="a")
+        self.release.set()
+        self.assertFalse(a.result(timeout=10))
+        self.assertTrue(b.result(timeout=10))
+        self.assertTrue(latest_a.result(timeout=10))
+        self.assertEqual([["ok", "running"], ["ok", "latest a"], ["ok", "b"]], self.run)
+
+    def test_latency_stats(self):
+        executor = self.create_executor()
+        executor.call(["ok"])
+        executor.call(["fail"])
+        stats = executor.stats()
+        self.assertEqual(2, stats["commands"])
+        self.assertEqual(1, stats["failed"])
+        self.assertGreaterEqual(stats["max_sec"], stats["average_sec"])
+
+    def test_wait(self):
+        executor = self.create_executor()
+        executor.submit(["ok"])
+        executor.wait(timeout=10)
+        self.assertEqual([["ok"]], self.run)
+
+    def test_shared_per_device(self):
+        self.assertIs(device_executor(("test", 1)), device_executor(("test", 1)))
+        self.assertIsNot(device_executor(("test", 1)), device_executor(("test", 2)))
+
+class RunCommandTest(TestCase):
+
+    def test_success(self):
+        self.assertTrue(run_command([sys.executable, "-c", "pass"]))
+
+    def test_failure(self):
+        self.assertFalse(run_command([sys.executable, "-c", "import sys; sys.exit(3)"]))
+
+    def test_timeout(self):
+        self.assertFalse(run_command([sys.executable, "-c", "import time; time.sleep(10)"], timeout_sec=0.2))
+
+    def test_not_found(self):
+        self.assertFalse(run_command(["no-such-command-for-cimon"]))
+
+    def test_no_shell(self):
+        self.assertTrue(run_command([sys.executable, "-c", "import sys; sys.exit(sys.argv[1] != '&& exit 1')", "&& exit 1"]))
+
+class FlashSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.called = []
+        self.done = Event()
+
+    def create_scheduler(self, **kwargs):
+        scheduler = FlashScheduler(**kwargs)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def callback(self, name, last=False):
+        def callback():
+            self.called.append((name, time.monotonic()))
+            if last:
+                self.done.set()
+        return callback
+
+    def test_called_at_deadline(self):
+        scheduler = self.create_scheduler()
+        deadline = time.monotonic() + 0.05
+        scheduler.schedule_at("a", deadline, self.callback("a", last=True))
+        self.assertTrue(self.done.wait(timeout=10))
+        self.assertEqual("a", self.called[0][0])
+        self.assertGreaterEqual(self.called[0][1], deadline)
+
+    def test_called_in_order(self):
+        scheduler = self.create_scheduler()
+        scheduler.schedule("c", 0.06, self.callback("c", last=True))
+        scheduler.schedule("a", 0.02, self.callback("a"))
+        scheduler.schedule("b", 0.04, self.callback("b"))
+        self.assertTrue(self.done.wait(timeout=10))
+        self.assertEqual(["a", "b", "c"], [name for name, called in self.called])
+
+    def test_schedule_again_replaces(self):
+        scheduler = self.create_scheduler()
+        scheduler.schedule("a", 0.02, self.callback("replaced"))
+        scheduler.schedule("a", 0.04, self.callback("a", last=True))
+        self.assertTrue(self.done.wait(timeout=10))
+        sleep(0.05)
+        self.assertEqual(["a"], [name for name, called in self.called])
+
+    def test_cancel(self):
+        scheduler = self.create_scheduler()
+        scheduler.schedule("a", 0.02, self.callback("a"))
+        scheduler.schedule("b", 0.04, self.callback("b", last=True))
+        scheduler.cancel("a")
+        self.assertTrue(self.done.wait(timeout=10))
+        self.assertEqual(["b"], [name for name, called in self.called])
+
+    def test_later_round_of_wheel(self):
+        scheduler = self.create_scheduler(tick_sec=0.01, wheel_size=4)
+        deadline = time.monotonic() + 0.1
+        scheduler.schedule_at("a", deadline, self.callback("a", last=True))
+        scheduler.schedule("b", 0.02, self.callback("b"))
+        self.assertTrue(self.done.wait(timeout=10))
+        self.assertEqual(["b", "a"], [name for name, called in self.called])
+        self.assertGreaterEqual(self.called[1][1], deadline)
+
+    def test_error_in_callback(self):
+        scheduler = self.create_scheduler()
+        scheduler.schedule("a", 0, Mock(side_effect=Exception("kaputt")))
+        scheduler.schedule("b", 0.02, self.callback("b", last=True))
+        with self.assertLogs("output", level="ERROR"):
+            self.assertTrue(self.done.wait(timeout=10))
+
+    def test_flash_phase(self):
+        now = [100.0]
+        scheduler = FlashScheduler(clock=lambda: now[0])
+        self.assertEqual((True, 100.8), scheduler.flash_phase(1))
+        now[0] = 100.9
+        self.assertEqual((False, 101.0), scheduler.flash_phase(1))
+        now[0] = 102.5
+        on, next_change = scheduler.flash_phase(1)
+        self.assertTrue(on)
+        self.assertAlmostEqual(102.8, next_change)
+
+    def test_flash_phase_in_sync(self):
+        now = [100.0]
+        scheduler = FlashScheduler(clock=lambda: now[0])
+        scheduler.flash_phase(1) # first device starts flashing
+        now[0] = 103.3
+        on, next_change = scheduler.flash_phase(1) # second device
+        self.assertTrue(on)
+        self.assertAlmostEqual(103.8, next_change)
+
+    def test_shared(self):
+        self.assertIs(flash_scheduler(), flash_scheduler())
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,34 @@
+__author__ = 'florianseidl'
+
+import env
+from unittest import TestCase
+from unittest.mock import MagicMock
+from threading import Thread
+from time import sleep
+from rescheduler import ReScheduler
+
+class ReSchedulerTest(TestCase):
+
+    def test_rescheduled_after_error(self):
+        method = MagicMock(spec=(""), side_effect=[Exception("boom")] + [None] * 1000)
+        scheduler = ReScheduler(method, 0.01)
+        self.addCleanup(scheduler.stop)
+        with self.assertRaises(Exception):
+            scheduler.start()
+        self.__wait_for__(lambda: method.call_count >= 3)
+
+    def test_stop_after_error(self):
+        scheduler = ReScheduler(MagicMock(spec=(""), side_effect=Exception("boom")), 10)
+        with self.assertRaises(Exception):
+            scheduler.start()
+        stop = Thread(target=scheduler.stop)
+        stop.start()
+        stop.join(2)
+        self.assertFalse(stop.is_alive())
+
+    def __wait_for__(self, condition):
+        for i in range(0, 200):
+            if condition():
+                return
+            sleep(0.01)
+        self.fail("condition not met")
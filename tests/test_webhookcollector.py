@@ -0,0 +1,166 @@
+__author__ = 'florianseidl'
+
+import env
+import json
+from unittest import TestCase, main
+from unittest.mock import Mock
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from http.client import HTTPConnection
+from datetime import datetime
+from webhookcollector import *
+from cimon import JobStatus, RequestStatus, Health
+
+class TestWebhookIngest(TestCase):
+
+    def setUp(self):
+        self.on_change = Mock()
+        self.store = StatusStore()
+        self.ingest = WebhookIngest(store=self.store, on_change=self.on_change)
+
+    def test_jenkins_started(self):
+        self.assertEqual(200, self.post_jenkins("STARTED")[0])
+        status = self.store.snapshot()[("ci.sbb.ch", "job.a")]
+        self.assertTrue(status.active)
+        self.assertEqual(Health.OTHER, status.health)
+        self.assertEqual(42, status.number)
+
+    def test_jenkins_completed(self):
+        self.post_jenkins("COMPLETED", "FAILURE")
+        status = self.store.snapshot()[("ci.sbb.ch", "job.a")]
+        self.assertFalse(status.active)
+        self.assertEqual(Health.SICK, status.health)
+        self.assertEqual(RequestStatus.OK, status.request_status)
+
+    def test_jenkins_started_keeps_previous_health(self):
+        self.post_jenkins("COMPLETED", "SUCCESS")
+        self.post_jenkins("STARTED")
+        status = self.store.snapshot()[("ci.sbb.ch", "job.a")]
+        self.assertTrue(status.active)
+        self.assertEqual(Health.HEALTHY, status.health)
+
+    def test_jenkins_queued_ignored(self):
+        self.post_jenkins("QUEUED")
+        self.assertEqual({}, self.store.snapshot())
+        self.on_change.assert_not_called()
+
+    def test_generic_result(self):
+        self.post({"job": "job.b", "result": "unstable", "timestamp": 1467131487090, "number": 7})
+        status = self.store.snapshot()[("webhook", "job.b")]
+        self.assertEqual(Health.UNWELL, status.health)
+        self.assertEqual(datetime.fromtimestamp(1467131487.090), status.timestamp)
+        self.assertEqual(7, status.number)
+
+    def test_generic_health_and_collector(self):
+        self.post({"job": "job.b", "health": "SICK", "building": True, "collector": "gitlab"})
+        status = self.store.snapshot()[("gitlab", "job.b")]
+        self.assertEqual(Health.SICK, status.health)
+        self.assertTrue(status.active)
+
+    def test_configured_name(self):
+        self.ingest.name = "myci"
+        self.post_jenkins("COMPLETED", "SUCCESS")
+        self.assertIn(("myci", "job.a"), self.store.snapshot())
+
+    def test_on_change_only_if_changed(self):
+        self.post_jenkins("COMPLETED", "SUCCESS")
+        self.post_jenkins("COMPLETED", "SUCCESS")
+        self.assertEqual(1, self.on_change.call_count)
+        self.post_jenkins("COMPLETED", "FAILURE")
+        self.assertEqual(2, self.on_change.call_count)
+
+    def test_snapshot_not_modified(self):
+        self.post_jenkins("COMPLETED", "SUCCESS")
+        snapshot = self.store.snapshot()
+        self.post({"job": "job.b", "result": "SUCCESS"})
+        self.assertEqual(1, len(snapshot))
+        self.assertEqual(2, len(self.store.snapshot()))
+
+    def test_invalid_json(self):
+        self.assertEqual(400, self.ingest.handle_post(b"{kaputt")[0])
+
+    def test_unknown_format(self):
+        self.assertEqual(400, self.post({"foo": "bar"})[0])
+
+    def test_invalid_health(self):
+        self.assertEqual(400, self.post({"job": "job.b", "health": "kaputt"})[0])
+
+    def test_invalid_timestamp(self):
+        self.assertEqual(400, self.post({"job": "job.a", "timestamp": 10 ** 20})[0])
+        self.assertEqual(400, self.post({"job": "job.a", "timestamp": "yesterday"})[0])
+
+    def test_invalid_job_name(self):
+        self.assertEqual(400, self.post({"job": 42, "result": "SUCCESS"})[0])
+        self.assertEqual({}, self.store.snapshot())
+
+    def post_jenkins(self, phase, status=None):
+        build = {"phase": phase, "number": 42, "full_url": "https://ci.sbb.ch/job/job.a/42/"}
+        if status:
+            build["status"] = status
+        return self.post({"name": "job.a", "url": "job/job.a/", "build": build})
+
+    def post(self, notification):
+        return self.ingest.handle_post(json.dumps(notification).encode("utf-8"))
+
+class TestWebhookCollector(TestCase):
+
+    def setUp(self):
+        self.collector = WebhookCollector(port=0)
+        self.trigger = Mock()
+        self.collector.set_trigger(self.trigger)
+
+    def tearDown(self):
+        self.collector.close()
+
+    def test_collect_empty(self):
+        self.assertEqual({}, self.collector.collect())
+
+    def test_post_and_collect(self):
+        self.collector.collect()
+        self.assertEqual(200, self.post({"job": "job.a", "result": "SUCCESS"}))
+        self.assertEqual({("webhook", "job.a"): JobStatus(health=Health.HEALTHY)}, self.collector.collect())
+        self.trigger.assert_called_once_with()
+
+    def test_no_trigger(self):
+        self.collector.trigger_on_event = False
+        self.collector.collect()
+        self.post({"job": "job.a", "result": "SUCCESS"})
+        self.trigger.assert_not_called()
+
+    def test_started_before_collect(self):
+        self.assertEqual(200, self.post({"job": "job.a", "result": "SUCCESS"}))
+        self.assertEqual({("webhook", "job.a"): JobStatus(health=Health.HEALTHY)}, self.collector.collect())
+
+    def test_restarted_after_close(self):
+        self.collector.close()
+        self.collector.collect()
+        self.assertEqual(200, self.post({"job": "job.a", "result": "SUCCESS"}))
+
+    def test_post_invalid(self):
+        self.collector.collect()
+        with self.assertRaises(HTTPError) as e:
+            self.post({"foo": "bar"})
+        self.assertEqual(400, e.exception.code)
+
+    def test_invalid_content_length(self):
+        for content_length in (None, "foo", "-1"):
+            self.assertEqual(400, self.post_raw(b'{"job": "job.a"}', content_length))
+        self.assertEqual({}, self.collector.collect())
+
+    def post_raw(self, body, content_length):
+        connection = HTTPConnection(*self.collector.server.server_address[:2], timeout=10)
+        self.addCleanup(connection.close)
+        connection.putrequest("POST", "/")
+        if content_length is not None:
+            connection.putheader("Content-Length", content_length)
+        connection.endheaders(body)
+        return connection.getresponse().status
+
+    def post(self, notification):
+        host, port = self.collector.server.server_address[:2]
+        request = Request("http://%s:%d/" % (host, port), data=json.dumps(notification).encode("utf-8"))
+        with urlopen(request) as response:
+            return response.status
+
+if __name__ == '__main__':
+    main()